@@ -137,7 +137,10 @@ def main():
 
     logger.info("Firewall started, blocking traffic port 80")
     test_utils.vxlan_firewall(sf_floating_ip, port=80)
-    cmd = "python vxlan_tool.py --metadata -i eth0 -d forward -v off -b 80"
+    # A single worker: the connection and RST template state is per worker
+    # and the control socket is only created under this name without a
+    # worker suffix
+    cmd = "python vxlan_tool.py --metadata -i eth0 -d forward -v off -b 80 --workers 1 --control-socket /root/vxlan_tool.sock"
 
     cmd = "sh -c 'cd /root;nohup " + cmd + " > /dev/null 2>&1 &'"
     test_utils.run_cmd_remote(sf_floating_ip, cmd)
@@ -0,0 +1,41 @@
+#
+# Copyright (c) 2015 All rights reserved
+# This program and the accompanying materials
+# are made available under the terms of the Apache License, Version 2.0
+# which accompanies this distribution, and is available at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+
+"""
+Runs the --self-check of vxlan_harness.py, which needs no root, so that
+the probe frames and filter of the harness keep matching the tool:
+
+    python -m unittest test_vxlan_harness
+"""
+
+import argparse
+import unittest
+
+import vxlan_harness
+import vxlan_tool as vt
+
+
+class SelfCheckTest(unittest.TestCase):
+
+    def test_self_check(self):
+        for nsp, nsi in [(23, 255), (0xFFFFFF, 1)]:
+            self.assertEqual(vxlan_harness.self_check(vt, argparse.Namespace(nsp=nsp, nsi=nsi)), [])
+
+    def test_self_check_finds_a_broken_filter(self):
+        probe_filter = vxlan_harness.probe_filter
+        try:
+            vxlan_harness.probe_filter = lambda vt: vt.assemble_bpf([(vt.BPF_RET_K, 0, 0, vt.BPF_ACCEPT)])
+            self.assertEqual(vxlan_harness.self_check(vt, argparse.Namespace(nsp=23, nsi=255)),
+                             ["the probe filter takes frames without the probe magic"])
+        finally:
+            vxlan_harness.probe_filter = probe_filter
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,570 @@
+#
+# Copyright (c) 2015 All rights reserved
+# This program and the accompanying materials
+# are made available under the terms of the Apache License, Version 2.0
+# which accompanies this distribution, and is available at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+
+"""
+Known-answer tests for the vxlan_tool.py frame parser, checksums, firewall
+and the flow, connection and reset tables.
+
+The frames are built byte by byte here, not with the tool's own codecs,
+so that the offsets and fields the tool finds can be checked against the
+layout the frames were built with. Run them next to vxlan_tool.py, no root
+or interface is needed:
+
+    python -m unittest test_vxlan_tool
+"""
+
+import random
+import socket
+import struct
+import time
+import unittest
+
+import vxlan_tool as vt
+
+VXLAN_GPE_UDP_PORTS = [4790]
+VXLAN_UDP_PORTS = [4789] + VXLAN_GPE_UDP_PORTS
+OUTER_DMAC = b'\xfa\x16\x3e\x00\x00\x02'
+OUTER_SMAC = b'\xfa\x16\x3e\x00\x00\x01'
+INNER_DMAC = b'\x10\x11\x12\x13\x14\x15'
+INNER_SMAC = b'\x20\x21\x22\x23\x24\x25'
+CONTEXT = (0x0b000001, 0x1234, 24, 0x87654321)
+
+
+def checksum(data):
+    """ The one's complement sum of data, 0 if data carries a valid checksum """
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def ip_address(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def ipv4(src, dst, proto, payload, options=b''):
+    """ An IPv4 header with a valid checksum followed by payload """
+    ihl = 5 + len(options) // 4
+    header = struct.pack('!BBHHHBBH4s4s', 0x40 | ihl, 0, ihl * 4 + len(payload), 1, 0, 64, proto, 0,
+                         socket.inet_aton(src), socket.inet_aton(dst)) + options
+    return header[:10] + struct.pack('!H', checksum(header)) + header[12:] + payload
+
+
+def tcp(sport, dport, seq=1000, ack=0, flags=vt.TCP_SYN, payload=b''):
+    return struct.pack('!HHIIBBHHH', sport, dport, seq, ack, 0x50, flags, 1024, 0, 0) + payload
+
+
+def udp(src, dst, sport, dport, payload):
+    """ A UDP header with a valid checksum for the IP addresses src and dst """
+    header = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0)
+    pseudo = struct.pack('!4s4sBBH', socket.inet_aton(src), socket.inet_aton(dst), 0, 17, 8 + len(payload))
+    return header[:6] + struct.pack('!H', checksum(pseudo + header + payload) or 0xFFFF) + payload
+
+
+def nsh(nsp, nsi, md_type=vt.NSH_MD_TYPE1, next_protocol=vt.NSH_NEXT_PROTO_ETH, metadata=None):
+    """ An NSH header, with the CONTEXT header for MD type 1 unless metadata is given """
+    if metadata is None:
+        metadata = struct.pack('!4I', *CONTEXT)
+    return struct.pack('!HBBI', (63 << 6) | (2 + len(metadata) // 4), md_type, next_protocol,
+                       (nsp << 8) | nsi) + metadata
+
+
+def inner_packet(sport=40000, dport=80, seq=1000, flags=vt.TCP_SYN, src='11.0.0.5', dst='11.0.0.6',
+                 ip_options=b'', payload=b'x' * 40):
+    """ The inner Eth + IP + TCP frame """
+    return (INNER_DMAC + INNER_SMAC + b'\x08\x00' +
+            ipv4(src, dst, socket.IPPROTO_TCP, tcp(sport, dport, seq, 0, flags, payload), ip_options))
+
+
+def vxlan_frame(inner, nsp=23, nsi=255, inserted_eth=True, udp_dport=4790, ip_options=b'',
+                md_type=vt.NSH_MD_TYPE1, metadata=None, next_protocol=vt.NSH_NEXT_PROTO_ETH):
+    """
+    Eth + IP + UDP + VxLAN-gpe (+ inserted Eth) + NSH + inner, or plain
+    VxLAN + inner when udp_dport is not a VxLAN-gpe port
+    """
+    if udp_dport in VXLAN_GPE_UDP_PORTS:
+        payload = struct.pack('!BHBI', 0x0c, 0, 4, 0x1234 << 8)
+        if inserted_eth:
+            payload += INNER_DMAC + INNER_SMAC + b'\x89\x4f'
+        payload += nsh(nsp, nsi, md_type, next_protocol, metadata) + inner
+    else:
+        payload = struct.pack('!BHBI', 0x08, 0, 0, 0x1234 << 8) + inner
+    return (OUTER_DMAC + OUTER_SMAC + b'\x08\x00' +
+            ipv4('192.168.0.1', '192.168.0.2', socket.IPPROTO_UDP,
+                 udp('192.168.0.1', '192.168.0.2', 5000, udp_dport, payload), ip_options))
+
+
+def eth_nsh_frame(inner, nsp=23, nsi=255):
+    return OUTER_DMAC + OUTER_SMAC + b'\x89\x4f' + nsh(nsp, nsi) + inner
+
+
+def parse(frame, inner=True):
+    return vt.parse_frame(frame, len(frame), VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS, inner)
+
+
+def frame_flow(frame):
+    offsets = parse(frame)
+    return offsets, vt.decode_flow(frame, offsets)
+
+
+class ParseFrameTest(unittest.TestCase):
+
+    def assertOffsets(self, offsets, **expected):
+        for name, value in expected.items():
+            self.assertEqual(getattr(offsets, name), value, name)
+
+    def test_md1_with_inserted_eth(self):
+        frame = vxlan_frame(inner_packet())
+        self.assertOffsets(parse(frame), length=len(frame), ip=14, udp=34, vxlan=42, inserted_eth=50,
+                           nsh=64, nsh_length=24, md_type=vt.NSH_MD_TYPE1,
+                           next_protocol=vt.NSH_NEXT_PROTO_ETH, path=(23 << 8) | 255,
+                           inner_eth=88, inner_ip=102, inner_proto=socket.IPPROTO_TCP, l4=122)
+        self.assertEqual(vt.frame_nsh_context_offset(parse(frame)), 72)
+        self.assertEqual(vt.frame_tcp_offset(parse(frame)), 122)
+
+    def test_md1_without_inserted_eth(self):
+        frame = vxlan_frame(inner_packet(), nsp=7, nsi=3, inserted_eth=False)
+        self.assertOffsets(parse(frame), inserted_eth=None, nsh=50, path=(7 << 8) | 3,
+                           inner_eth=74, inner_ip=88, l4=108)
+
+    def test_md2_skips_tlvs(self):
+        tlvs = struct.pack('!HBB', 0x0101, 1, 3) + b'abc\x00' + struct.pack('!HBB', 0x0102, 2, 4) + b'defg'
+        frame = vxlan_frame(inner_packet(), md_type=vt.NSH_MD_TYPE2, metadata=tlvs)
+        offsets = parse(frame)
+        self.assertOffsets(offsets, nsh=64, nsh_length=24, md_type=vt.NSH_MD_TYPE2,
+                           inner_eth=88, inner_ip=102, l4=122)
+        self.assertEqual(vt.decode_nsh_tlvs(frame, offsets), [(0x0101, 1, b'abc'), (0x0102, 2, b'defg')])
+        self.assertIsNone(vt.frame_nsh_context_offset(offsets))
+
+    def test_md2_without_tlvs(self):
+        frame = vxlan_frame(inner_packet(), md_type=vt.NSH_MD_TYPE2, metadata=b'')
+        self.assertOffsets(parse(frame), nsh_length=8, inner_eth=72, inner_ip=86, l4=106)
+
+    def test_eth_nsh(self):
+        frame = eth_nsh_frame(inner_packet(), nsi=9)
+        self.assertOffsets(parse(frame), ip=None, udp=None, vxlan=None, nsh=14, nsh_length=24,
+                           path=(23 << 8) | 9, inner_eth=38, inner_ip=52, l4=72)
+
+    def test_nsh_carrying_ipv4(self):
+        packet = inner_packet()[14:]
+        frame = vxlan_frame(packet, next_protocol=vt.NSH_NEXT_PROTO_IPV4)
+        self.assertOffsets(parse(frame), inner_eth=None, inner_ip=88, l4=108)
+
+    def test_ip_options(self):
+        options = b'\x01\x01\x01\x00'
+        frame = vxlan_frame(inner_packet(ip_options=options * 2), ip_options=options)
+        self.assertOffsets(parse(frame), ip=14, udp=38, vxlan=46, inserted_eth=54, nsh=68,
+                           inner_eth=92, inner_ip=106, l4=134)
+        self.assertEqual(vt.decode_flow(frame, parse(frame)),
+                         (ip_address('11.0.0.5'), ip_address('11.0.0.6'), socket.IPPROTO_TCP, 40000, 80, 23, 255))
+
+    def test_without_inner(self):
+        offsets = parse(vxlan_frame(inner_packet()), inner=False)
+        self.assertOffsets(offsets, nsh=64, nsh_length=24, inner_eth=None, inner_ip=None, l4=None)
+
+    def test_plain_vxlan(self):
+        frame = vxlan_frame(inner_packet(), udp_dport=4789)
+        self.assertOffsets(parse(frame), vxlan=42, inner_eth=50, nsh=None, path=None)
+
+    def test_not_vxlan(self):
+        self.assertIsNone(parse(vxlan_frame(inner_packet(), udp_dport=53)))
+        self.assertIsNone(parse(OUTER_DMAC + OUTER_SMAC + b'\x08\x06' + b'\x00' * 28))
+        self.assertIsNone(parse(OUTER_DMAC + OUTER_SMAC + b'\x08\x06'))
+
+    def test_truncated(self):
+        frame = vxlan_frame(inner_packet())
+        for length in [0, 13, 50, 60, 63, 71, 87]:
+            self.assertIs(vt.parse_frame(frame, length, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS),
+                          vt.FRAME_TRUNCATED, length)
+        self.assertIs(parse(eth_nsh_frame(b'')[:20]), vt.FRAME_TRUNCATED)
+        self.assertIs(parse(OUTER_DMAC + OUTER_SMAC + b'\x89\x4f'), vt.FRAME_TRUNCATED)
+
+    def test_truncated_inner_packet(self):
+        """ Headers past NSH that are cut short read as None, the frame is still NSH """
+        frame = vxlan_frame(inner_packet())
+        self.assertOffsets(vt.parse_frame(frame, 100, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS),
+                           nsh=64, inner_eth=88, inner_ip=None, l4=None)
+        offsets = vt.parse_frame(frame, 130, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS)
+        self.assertEqual(offsets.l4, 122)
+        self.assertIsNone(vt.frame_tcp_offset(offsets))
+
+    def test_nsh_length_past_frame(self):
+        frame = bytearray(vxlan_frame(inner_packet(payload=b'')))
+        frame[65] = (frame[65] & 0xC0) | 0x3F
+        self.assertIs(parse(bytes(frame)), vt.FRAME_TRUNCATED)
+        frame[65] = (frame[65] & 0xC0) | 1
+        self.assertIs(parse(bytes(frame)), vt.FRAME_TRUNCATED)
+
+
+class HeaderTest(unittest.TestCase):
+
+    def test_ip_header_round_trip(self):
+        header = ipv4('192.168.0.1', '192.168.0.2', socket.IPPROTO_UDP, b'', b'\x01\x01\x01\x00')[:20]
+        ip = vt.IP4HEADER()
+        vt.decode_ip_at(header, 0, ip)
+        self.assertEqual((ip.ip_ver, ip.ip_ihl, ip.ip_proto), (4, 6, socket.IPPROTO_UDP))
+        self.assertEqual(ip.build(), header)
+
+    def test_ip_header_defaults(self):
+        self.assertEqual(vt.IP4HEADER(ip_tot_len=20).build()[:4], b'\x45\x00\x00\x14')
+
+
+class ChecksumTest(unittest.TestCase):
+
+    def test_rfc1071_example(self):
+        self.assertEqual(vt.compute_internet_checksum(b'\x00\x01\xf2\x03\xf4\xf5\xf6\xf7'), 0x220d)
+        self.assertEqual(vt.compute_internet_checksum(b'\x00\x01\xf2\x03\xf4\xf5\xf6'), 0x2304)
+
+    def test_ip_header(self):
+        header = bytearray(ipv4('192.168.0.1', '192.168.0.2', socket.IPPROTO_UDP, b'')[:20])
+        expected = struct.unpack_from('!H', header, 10)[0]
+        header[10:12] = b'\x00\x00'
+        self.assertEqual(vt.compute_internet_checksum(header), expected)
+
+    def test_update_matches_compute(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            words = [rng.randrange(0x10000) for _ in range(16)]
+            data = struct.pack('!16H', *words)
+            index = rng.randrange(16)
+            new = rng.choice([0, 0xFFFF, rng.randrange(0x10000)])
+            updated = struct.pack('!16H', *(words[:index] + [new] + words[index + 1:]))
+            self.assertEqual(vt.update_internet_checksum(vt.compute_internet_checksum(data), words[index], new),
+                             vt.compute_internet_checksum(updated))
+
+    def test_update32_matches_compute(self):
+        rng = random.Random(2)
+        for _ in range(1000):
+            words = [rng.randrange(0x100000000) for _ in range(4)]
+            new = rng.randrange(0x100000000)
+            self.assertEqual(vt.update_internet_checksum32(vt.compute_internet_checksum(struct.pack('!4I', *words)),
+                                                           words[2], new),
+                             vt.compute_internet_checksum(struct.pack('!4I', words[0], words[1], new, words[3])))
+
+
+class RuleTableTest(unittest.TestCase):
+
+    def flow(self, src='11.0.0.5', dst='11.0.0.6', proto=socket.IPPROTO_TCP, sport=40000, dport=80, nsp=23, nsi=255):
+        return (ip_address(src), ip_address(dst), proto, sport, dport, nsp, nsi)
+
+    def test_table_of_one_shape(self):
+        rules = [vt.FirewallRule('drop src 10.1.0.0/16 proto tcp dport 80', 0),
+                 vt.FirewallRule('rst src 10.2.0.0/16 proto tcp dport 80', 1),
+                 vt.FirewallRule('forward src 10.1.2.0/16 proto tcp dport 80', 2)]
+        table = vt.RuleTable(rules[0].shape(), rules)
+        self.assertIs(table.lookup(*self.flow(src='10.1.200.7')), rules[0])
+        self.assertIs(table.lookup(*self.flow(src='10.2.0.1')), rules[1])
+        self.assertIsNone(table.lookup(*self.flow(src='10.3.0.1')))
+        self.assertIsNone(table.lookup(*self.flow(src='10.1.0.1', dport=81)))
+        self.assertIsNone(table.lookup(*self.flow(src='10.1.0.1', proto=socket.IPPROTO_UDP)))
+
+    def test_port_ranges_of_a_long_bucket(self):
+        """ More rules than FIREWALL_BUCKET_SCAN in one bucket are split on their port boundaries """
+        rules = [vt.FirewallRule('drop proto tcp dport %d-%d' % (1000 * i, 1000 * i + 499), i) for i in range(20)]
+        rules.append(vt.FirewallRule('rst proto tcp dport 0-65535', 20))
+        table = vt.RuleTable(rules[0].shape(), rules)
+        self.assertIsNotNone(table.buckets[rules[0].key()].bounds)
+        for dport, rule in [(0, rules[0]), (499, rules[0]), (500, rules[20]), (7250, rules[7]),
+                            (19499, rules[19]), (19500, rules[20]), (65535, rules[20])]:
+            self.assertIs(table.lookup(*self.flow(dport=dport)), rule, dport)
+
+    def test_first_rule_wins_across_shapes(self):
+        firewall = vt.Firewall(['forward src 11.0.0.5 dport 80',
+                                'drop proto tcp dport 80',
+                                'rst proto tcp sport 40000-40100 nsp 23',
+                                'drop nsp 23 nsi 255',
+                                'drop dst 11.0.0.0/8 proto udp'])
+        self.assertEqual(firewall.lookup(*self.flow()).priority, 0)
+        self.assertEqual(firewall.lookup(*self.flow(src='11.0.0.9')).priority, 1)
+        self.assertEqual(firewall.lookup(*self.flow(src='11.0.0.9', dport=81)).priority, 2)
+        self.assertEqual(firewall.lookup(*self.flow(src='11.0.0.9', dport=81, sport=1)).priority, 3)
+        self.assertEqual(firewall.lookup(*self.flow(src='11.0.0.9', dst='11.9.9.9', proto=socket.IPPROTO_UDP, nsi=254)).priority, 4)
+        self.assertIsNone(firewall.lookup(*self.flow(src='11.0.0.9', dport=81, sport=1, nsi=254)))
+
+    def test_match_frame(self):
+        firewall = vt.Firewall(['drop proto tcp dport 22', 'rst proto tcp dport 80'])
+        frame = vxlan_frame(inner_packet(dport=80))
+        action = firewall.match_frame(frame, parse(frame))
+        self.assertEqual((str(action.rule), action.forward, action.reset), ('rst proto tcp dport 80', False, True))
+        frame = vxlan_frame(inner_packet(dport=443))
+        self.assertIs(firewall.match_frame(frame, parse(frame)), vt.FLOW_FORWARD)
+
+    def test_bad_rules(self):
+        for text in ['block proto tcp', 'drop proto', 'drop src 11.0.0.256', 'drop dport 90-80',
+                     'rst proto udp', 'drop nsi 256', 'drop color red']:
+            self.assertRaises(ValueError, vt.FirewallRule, text)
+
+
+class FlowCacheTest(unittest.TestCase):
+
+    def test_clock_spares_referenced_entries(self):
+        cache = vt.FlowCache(3, 30.0)
+        for key in 'abc':
+            cache.put(key, key.upper(), 0.0)
+        self.assertEqual(cache.get('a', 1.0), 'A')
+        cache.put('d', 'D', 2.0)
+        self.assertIs(cache.get('b', 2.0), vt.FLOW_MISS)
+        self.assertEqual([cache.get(key, 2.0) for key in 'acd'], ['A', 'C', 'D'])
+        self.assertEqual(cache.counters(), {'entries': 3, 'hits': 4, 'misses': 1, 'evictions': 1, 'expired': 0})
+
+    def test_update_marks_entry_referenced(self):
+        cache = vt.FlowCache(3, 30.0)
+        for key in 'abc':
+            cache.put(key, key.upper(), 0.0)
+        cache.put('b', 'B2', 1.0)
+        cache.put('d', 'D', 2.0)
+        self.assertIs(cache.get('a', 2.0), vt.FLOW_MISS)
+        self.assertEqual(cache.get('b', 2.0), 'B2')
+
+    def test_hand_clears_referenced_bits(self):
+        """ With every entry referenced the hand goes round once and evicts where it started """
+        cache = vt.FlowCache(3, 30.0)
+        for key in 'abc':
+            cache.put(key, key.upper(), 0.0)
+            cache.get(key, 0.0)
+        cache.put('d', 'D', 1.0)
+        cache.put('e', 'E', 1.0)
+        self.assertEqual(sorted(cache.entries), ['c', 'd', 'e'])
+        self.assertEqual(cache.evictions, 2)
+
+    def test_idle_timeout(self):
+        cache = vt.FlowCache(3, 10.0)
+        cache.put('a', 'A', 0.0)
+        cache.put('b', 'B', 5.0)
+        self.assertIs(cache.get('a', 10.5), vt.FLOW_MISS)
+        self.assertEqual(cache.get('b', 10.5), 'B')
+        self.assertEqual(cache.expired, 1)
+        cache.put('c', 'C', 11.0)
+        cache.put('d', 'D', 11.0)
+        cache.get('c', 11.0)
+        cache.get('d', 11.0)
+        cache.put('e', 'E', 21.0)
+        # The hand takes the idle entry before the referenced ones
+        self.assertEqual(sorted(cache.entries), ['c', 'd', 'e'])
+        self.assertEqual((cache.evictions, cache.expired), (0, 2))
+
+    def test_firewall_caches_actions(self):
+        cache = vt.FlowCache(16, 30.0)
+        firewall = vt.Firewall(['drop proto tcp dport 80'], cache)
+        frame = vxlan_frame(inner_packet())
+        offsets = parse(frame)
+        first = firewall.match_frame(frame, offsets)
+        self.assertIs(firewall.match_frame(frame, offsets), first)
+        self.assertFalse(first.forward)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertIs(cache.entries[vt.decode_flow(frame, offsets)][0], first)
+
+    def test_dispatch_actions_carry_context(self):
+        table = vt.DispatchTable(['23 255 set c2 0x55, block 22', '23 254 drop'], flows=vt.FlowCache(16, 30.0))
+        frame = vxlan_frame(inner_packet())
+        action = table.match_frame(frame, parse(frame))
+        self.assertTrue(action.forward)
+        self.assertEqual(action.context, [(1, 0x55)])
+        frame = vxlan_frame(inner_packet(dport=22))
+        self.assertFalse(table.match_frame(frame, parse(frame)).forward)
+        frame = vxlan_frame(inner_packet(), nsi=254)
+        self.assertFalse(table.match_frame(frame, parse(frame)).forward)
+        frame = vxlan_frame(inner_packet(), nsi=253)
+        self.assertIs(table.match_frame(frame, parse(frame)), vt.FLOW_FORWARD)
+
+
+class Timer(object):
+    __slots__ = ('expires', 'slot')
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.slot = None
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def expiry_ticks(self, wheel, timers, until):
+        """ The tick each timer expired at, advancing the wheel one tick at a time """
+        ticks = {}
+        while wheel.now < until:
+            for timer in wheel.advance(wheel.now + 1):
+                ticks[timers.index(timer)] = wheel.now
+        return [ticks.get(index) for index in range(len(timers))]
+
+    def test_timers_expire_at_their_tick(self):
+        """ Timers of the first three levels, those already due expire on the next tick """
+        start = 1000
+        wheel = vt.TimerWheel(start)
+        delays = [-5, 0, 1, 255, 256, 300, 1 << 14, (1 << 14) + 77]
+        timers = [Timer(start + delay) for delay in delays]
+        for timer in timers:
+            wheel.schedule(timer)
+        ticks = self.expiry_ticks(wheel, timers, start + (1 << 14) + 100)
+        self.assertEqual(ticks, [start + max(delay, 1) for delay in delays])
+
+    def test_update_and_cancel(self):
+        start = 5
+        wheel = vt.TimerWheel(start)
+        timers = [Timer(start + 100) for _ in range(3)]
+        for timer in timers:
+            wheel.schedule(timer)
+        wheel.update(timers[0], start + 10)
+        wheel.update(timers[1], start + 400)
+        wheel.cancel(timers[2])
+        self.assertEqual(self.expiry_ticks(wheel, timers, start + 500), [start + 10, start + 400, None])
+
+    def test_advance_jumps(self):
+        wheel = vt.TimerWheel(0)
+        timers = [Timer(tick) for tick in (3, 700, 70000)]
+        for timer in timers:
+            wheel.schedule(timer)
+        self.assertEqual(wheel.advance(2), [])
+        self.assertEqual(wheel.advance(1000), timers[:2])
+        self.assertEqual(wheel.advance(69999), [])
+        self.assertEqual(wheel.advance(70000), timers[2:])
+
+
+class ConntrackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = float(int(time.time()))
+
+    def track(self, conntrack, delay, sport=40000, dport=80, flags=vt.TCP_SYN, reply=False):
+        src, dst = '11.0.0.5', '11.0.0.6'
+        if reply:
+            src, dst, sport, dport = dst, src, dport, sport
+        frame = vxlan_frame(inner_packet(sport, dport, flags=flags, src=src, dst=dst))
+        offsets, flow = frame_flow(frame)
+        return conntrack.track(frame, offsets, flow, self.now + delay)
+
+    def handshake(self, conntrack, delay, sport=40000):
+        self.assertEqual(self.track(conntrack, delay, sport)[1], vt.CONNTRACK_NEW)
+        self.assertEqual(self.track(conntrack, delay, sport, flags=vt.TCP_SYN | vt.TCP_ACK, reply=True)[1],
+                         vt.CONNTRACK_ESTABLISHED)
+        return self.track(conntrack, delay, sport, flags=vt.TCP_ACK)
+
+    def test_states(self):
+        conntrack = vt.Conntrack(16, 100)
+        self.assertEqual(self.track(conntrack, 0, flags=vt.TCP_ACK), (None, vt.CONNTRACK_INVALID))
+        entry, state = self.handshake(conntrack, 0)
+        self.assertEqual((entry.state, state), (vt.CT_ESTABLISHED, vt.CONNTRACK_ESTABLISHED))
+        self.assertIs(self.track(conntrack, 1, flags=vt.TCP_ACK, reply=True)[0], entry)
+        self.assertEqual(self.track(conntrack, 0, dport=81, flags=vt.TCP_ACK), (None, vt.CONNTRACK_INVALID))
+        self.assertEqual(conntrack.invalid, 2)
+
+    def test_expiry(self):
+        conntrack = vt.Conntrack(16, 100)
+        self.track(conntrack, 0, sport=1)
+        self.handshake(conntrack, 0, sport=2)
+        syn_timeout = vt.CONNTRACK_TIMEOUTS[vt.CT_SYN_SENT]
+        # A packet a tick before the timeout of its connection keeps it, one at the timeout finds it gone
+        self.assertEqual(self.track(conntrack, syn_timeout - 1, sport=1)[1], vt.CONNTRACK_NEW)
+        self.assertEqual(self.track(conntrack, 2 * syn_timeout - 2, sport=2, flags=vt.TCP_ACK)[1],
+                         vt.CONNTRACK_ESTABLISHED)
+        self.assertEqual(conntrack.expired, 0)
+        self.assertEqual(self.track(conntrack, 2 * syn_timeout - 1, sport=1, flags=vt.TCP_ACK)[1],
+                         vt.CONNTRACK_INVALID)
+        self.assertEqual(conntrack.expired, 1)
+        self.assertEqual(self.track(conntrack, 2 * syn_timeout + 97, sport=2, flags=vt.TCP_ACK)[1],
+                         vt.CONNTRACK_ESTABLISHED)
+        self.assertEqual(self.track(conntrack, 2 * syn_timeout + 197, sport=2, flags=vt.TCP_ACK)[1],
+                         vt.CONNTRACK_INVALID)
+        self.assertEqual((conntrack.expired, conntrack.counters()['entries']), (2, 0))
+
+    def test_closed_connections_expire_early(self):
+        conntrack = vt.Conntrack(16, 100)
+        self.handshake(conntrack, 0)
+        self.track(conntrack, 1, flags=vt.TCP_RST)
+        closed_timeout = vt.CONNTRACK_TIMEOUTS[vt.CT_CLOSED]
+        self.track(conntrack, 1 + closed_timeout + 1, dport=81)
+        self.assertEqual(conntrack.expired, 1)
+
+    def test_syn_flood_keeps_established(self):
+        conntrack = vt.Conntrack(2, 100)
+        self.handshake(conntrack, 0, sport=1)
+        self.assertEqual(self.track(conntrack, 0, sport=2)[1], vt.CONNTRACK_NEW)
+        self.assertEqual(self.track(conntrack, 0, sport=3)[1], vt.CONNTRACK_NEW)
+        self.assertEqual(conntrack.early_drops, 1)
+        self.assertEqual(self.track(conntrack, 0, sport=1, flags=vt.TCP_ACK)[1], vt.CONNTRACK_ESTABLISHED)
+        self.handshake(conntrack, 0, sport=3)
+        self.assertEqual(self.track(conntrack, 0, sport=4), (None, vt.CONNTRACK_INVALID))
+        self.assertEqual(conntrack.full, 1)
+
+    def test_reset_once(self):
+        conntrack = vt.Conntrack(16, 100)
+        entry = self.handshake(conntrack, 0)[0]
+        self.assertTrue(conntrack.reset(entry))
+        self.assertFalse(conntrack.reset(entry))
+        # The reset connection absorbs a new SYN between the same ends
+        self.assertIs(self.track(conntrack, 1)[0], entry)
+        self.assertEqual(entry.state, vt.CT_CLOSED)
+
+
+class TcpResetTemplatesTest(unittest.TestCase):
+
+    def reply(self, resets, frame, reverse_nsp=24, swap_ip=False):
+        return bytes(resets.reply(frame, parse(frame), reverse_nsp, swap_ip))
+
+    def check_reply(self, reply, frame, sport, dport, seq, swap_ip=False):
+        """ Every field of the reset answering the TCP packet from sport to dport with seq """
+        self.assertEqual(len(reply), 142)
+        self.assertEqual(reply[0:14], OUTER_SMAC + OUTER_DMAC + b'\x08\x00')
+        outer_src, outer_dst = socket.inet_aton('192.168.0.1'), socket.inet_aton('192.168.0.2')
+        if swap_ip:
+            outer_src, outer_dst = outer_dst, outer_src
+        self.assertEqual(struct.unpack_from('!BBHxxxxBB', reply, 14), (0x45, 0, 128, vt.IPV4_TTL, socket.IPPROTO_UDP))
+        self.assertEqual(reply[26:34], outer_src + outer_dst)
+        self.assertEqual(checksum(reply[14:34]), 0)
+        self.assertEqual(struct.unpack_from('!HHH', reply, 34), (5000, 4790, 108))
+        pseudo = outer_src + outer_dst + struct.pack('!BBH', 0, socket.IPPROTO_UDP, 108)
+        self.assertEqual(checksum(pseudo + reply[34:]), 0)
+        # VxLAN-gpe and the inserted Eth as received, the reverse path and nsi minus one in NSH
+        self.assertEqual(reply[42:64], frame[42:64])
+        self.assertEqual(struct.unpack_from('!I', reply, 68)[0], (24 << 8) | 254)
+        self.assertEqual(reply[72:88], struct.pack('!4I', *CONTEXT))
+        self.assertEqual(reply[88:102], INNER_SMAC + INNER_DMAC + b'\x08\x00')
+        self.assertEqual(struct.unpack_from('!BBHxxxxBB', reply, 102), (0x45, 0, 40, vt.IPV4_TTL, socket.IPPROTO_TCP))
+        self.assertEqual(reply[114:122], socket.inet_aton('11.0.0.6') + socket.inet_aton('11.0.0.5'))
+        self.assertEqual(checksum(reply[102:122]), 0)
+        self.assertEqual(struct.unpack_from('!HHIIBB', reply, 122),
+                         (dport, sport, 0, (seq + 1) & 0xFFFFFFFF, 0x50, vt.TCP_RST | vt.TCP_ACK))
+        pseudo = reply[114:122] + struct.pack('!BBH', 0, socket.IPPROTO_TCP, 20)
+        self.assertEqual(checksum(pseudo + reply[122:142]), 0)
+
+    def test_reply(self):
+        resets = vt.TcpResetTemplates(vt.FlowCache(vt.RESET_TEMPLATES, 30.0))
+        frame = vxlan_frame(inner_packet(seq=1000))
+        self.check_reply(self.reply(resets, frame), frame, 40000, 80, 1000)
+
+    def test_reply_patches_template(self):
+        """ Later connections of the host pair get the template with their ports and ack patched in """
+        resets = vt.TcpResetTemplates(vt.FlowCache(vt.RESET_TEMPLATES, 30.0))
+        for sport, dport, seq in [(40000, 80, 1000), (1, 65535, 0xFFFFFFFF), (65535, 1, 0), (12345, 443, 0x7FFFFFFF)]:
+            frame = vxlan_frame(inner_packet(sport, dport, seq))
+            self.check_reply(self.reply(resets, frame), frame, sport, dport, seq)
+        self.assertEqual(resets.templates.counters()['entries'], 1)
+
+    def test_reply_swap_ip(self):
+        resets = vt.TcpResetTemplates(vt.FlowCache(vt.RESET_TEMPLATES, 30.0))
+        frame = vxlan_frame(inner_packet())
+        self.check_reply(self.reply(resets, frame, swap_ip=True), frame, 40000, 80, 1000, swap_ip=True)
+
+    def test_reply_drops_outer_ip_options(self):
+        resets = vt.TcpResetTemplates(vt.FlowCache(vt.RESET_TEMPLATES, 30.0))
+        frame = vxlan_frame(inner_packet(), ip_options=b'\x01\x01\x01\x00')
+        self.check_reply(self.reply(resets, frame), frame[:14] + frame[18:], 40000, 80, 1000)
+
+    def test_no_reply_without_tcp(self):
+        resets = vt.TcpResetTemplates(vt.FlowCache(vt.RESET_TEMPLATES, 30.0))
+        packet = inner_packet()
+        packet = packet[:23] + struct.pack('!B', socket.IPPROTO_UDP) + packet[24:]
+        self.assertIsNone(resets.reply(vxlan_frame(packet), parse(vxlan_frame(packet)), 24, False))
+        frame = eth_nsh_frame(inner_packet())
+        self.assertIsNone(resets.reply(frame, parse(frame), 24, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
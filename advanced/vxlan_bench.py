@@ -0,0 +1,421 @@
+#
+# Copyright (c) 2015 All rights reserved
+# This program and the accompanying materials
+# are made available under the terms of the Apache License, Version 2.0
+# which accompanies this distribution, and is available at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+
+"""
+Micro-benchmarks for the vxlan_tool.py packet codecs.
+
+Run it next to vxlan_tool.py:
+
+    python vxlan_bench.py
+
+or with python -m vxlan_bench from this directory. To check a change,
+save the results before it and compare against them after:
+
+    python vxlan_bench.py --json before.json
+    python vxlan_bench.py --baseline before.json
+
+To compare against another revision of the tool, point --tool at it:
+
+    git show HEAD~1:advanced/vxlan_tool.py > /tmp/vxlan_tool_old.py
+    python vxlan_bench.py --tool /tmp/vxlan_tool_old.py
+
+To time the whole dump and forward paths on captured traffic, without
+root or an interface, replay a pcap file through each mode, --json and
+--baseline compare the modes the same way:
+
+    python vxlan_bench.py --replay nsh.pcap
+"""
+
+import argparse
+import collections
+import imp
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import timeit
+
+CHECKSUM_SIZES = [64, 128, 256, 512, 1024, 1500, 4096, 9000]
+FIREWALL_SIZES = [1, 10, 100, 1000, 10000]
+# Inner TCP payload lengths of the synthetic frames, up to a full 1500 byte MTU
+FRAME_PAYLOADS = [0, 512, 1354]
+REPLAY_MODES = [('dump', ['-d', 'dump']),
+                ('forward', ['-d', 'forward']),
+                ('forward inner', ['-d', 'forward', '--forward-inner']),
+                ('block', ['-d', 'forward', '--block', '80']),
+                ('block and rst', ['-d', 'forward', '--block', '80', '--metadata'])]
+# The firewall rules and --forward-inner of each mode, timed through the
+# pipeline the receive loop compiles for them on the frame of the decode
+# benchmark, what the loop decoded eagerly for every frame before
+PIPELINE_MODES = [('forward', [], False),
+                  ('forward inner', [], True),
+                  ('block', ['drop proto tcp dport 80'], False),
+                  ('block and rst', ['rst proto tcp dport 80'], False),
+                  ('block and rst, forward inner', ['rst proto tcp dport 80'], True)]
+VXLAN_GPE_UDP_PORTS = [4790, 6633]
+VXLAN_UDP_PORTS = [4789] + VXLAN_GPE_UDP_PORTS
+DEFAULT_TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'vxlan_tool.py')
+
+
+def load_tool(path):
+    return imp.load_source('vxlan_tool', path)
+
+
+def build_frame(vt, payload_len=64):
+    """
+    Build an Eth + IP + UDP + VxLAN-gpe + Eth + NSH MD1 + Eth + IP + TCP frame
+    the same way OVS sends it to the SF, with the reverse path 24 in c3
+    """
+    ip_to_int = lambda ip: vt.int_from_bytes(socket.inet_aton(ip))
+
+    eth = vt.ETHHEADER(0xfa, 0x16, 0x3e, 0x00, 0x00, 0x02,
+                       0xfa, 0x16, 0x3e, 0x00, 0x00, 0x01, 0x08, 0x00)
+    inserted_eth = vt.ETHHEADER(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0x89, 0x4f)
+    inner_eth = vt.ETHHEADER(0xfa, 0x16, 0x3e, 0x00, 0x00, 0x06,
+                             0xfa, 0x16, 0x3e, 0x00, 0x00, 0x05, 0x08, 0x00)
+    vxlan = vt.VXLAN(flags=0x0c, next_protocol=0x04, vni=0x1234)
+    base = vt.BASEHEADER(service_path=23, service_index=255)
+    context = vt.CONTEXTHEADER(ip_to_int('192.168.0.2'), 0x1234, 24, 0)
+
+    tcp = vt.TCPHEADER()
+    tcp.tcp_sport = 40000
+    tcp.tcp_dport = 80
+    tcp.tcp_seq = 1000
+    tcp.tcp_offset = 0x50
+    tcp.tcp_flags = 0x02
+    tcp.tcp_window = 1024
+    segment = tcp.build() + b'\x00' * payload_len
+    inner_ip, inner_ip_pack = vt.build_ipv4_header_reset(
+        20 + len(segment), socket.IPPROTO_TCP, ip_to_int('11.0.0.6'),
+        ip_to_int('11.0.0.5'), True)
+
+    nsh = (vxlan.build() + inserted_eth.build() + base.build() +
+           context.build() + inner_eth.build() + inner_ip_pack + segment)
+    outer = vt.build_udp_packet('192.168.0.1', '192.168.0.2', 5000, 4790,
+                                nsh, False)
+    return eth.build() + outer
+
+
+def bench_decode(vt, frame):
+    """ The header decoding done by the receive loop for every frame """
+    def decode():
+        eth = vt.ETHHEADER()
+        vt.decode_eth(frame, 0, eth)
+        ip = vt.IP4HEADER()
+        vt.decode_ip(frame, ip)
+        udp = vt.UDPHEADER()
+        vt.decode_udp(frame, udp)
+        vxlan = vt.VXLAN()
+        vt.decode_vxlan(frame, vxlan)
+        inserted_eth = vt.ETHHEADER()
+        vt.decode_eth(frame, 50, inserted_eth)
+        base = vt.BASEHEADER()
+        vt.decode_nsh_baseheader(frame, 64, base)
+        context = vt.CONTEXTHEADER()
+        vt.decode_nsh_contextheader(frame, 72, context)
+    return decode
+
+
+def bench_dump(vt, frame):
+    """ The headers the dump thread decodes to print a frame """
+    return lambda: vt.decode_dump_headers(frame, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS)
+
+
+def bench_codecs(vt, frame):
+    """ (name, function) decoding each header of frame into a reused header object """
+    eth = vt.ETHHEADER()
+    ip = vt.IP4HEADER()
+    udp = vt.UDPHEADER()
+    vxlan = vt.VXLAN()
+    base = vt.BASEHEADER()
+    context = vt.CONTEXTHEADER()
+    tcp = vt.TCPHEADER()
+    return [('decode_eth', lambda: vt.decode_eth(frame, 0, eth)),
+            ('decode_ip', lambda: vt.decode_ip(frame, ip)),
+            ('decode_udp', lambda: vt.decode_udp(frame, udp)),
+            ('decode_vxlan', lambda: vt.decode_vxlan(frame, vxlan)),
+            ('decode_nsh_baseheader', lambda: vt.decode_nsh_baseheader(frame, 64, base)),
+            ('decode_nsh_contextheader', lambda: vt.decode_nsh_contextheader(frame, 72, context)),
+            ('decode_tcp', lambda: vt.decode_tcp(frame, 14, tcp))]
+
+
+def bench_builders(vt, frame):
+    """
+    (name, function) building the headers and packets the forward and
+    reset paths send for frame
+    """
+    data = frame[42:]
+    ip = vt.IP4HEADER()
+    vt.decode_internal_ip(frame, 14, ip)
+    tcp = vt.TCPHEADER()
+    vt.decode_tcp(frame, 14, tcp)
+    total_len = len(data) + vt.IPV4_HEADER_LEN_BYTES + vt.UDP_HEADER_LEN_BYTES
+    builders = [('build_udp_packet', lambda: vt.build_udp_packet('192.168.0.1', '192.168.0.2', 5000, 4790, data, True)),
+                ('build_ipv4_header', lambda: vt.build_ipv4_header(total_len, socket.IPPROTO_UDP, '192.168.0.1', '192.168.0.2', True)),
+                ('build_tcp_reset', lambda: vt.build_tcp_reset(tcp, ip)),
+                ('compute_internet_checksum', lambda: vt.compute_internet_checksum(frame[14:]))]
+    if hasattr(vt, 'EncapTemplates'):
+        encaps = vt.EncapTemplates(vt.FlowCache(vt.ENCAP_TEMPLATES, 30.0))
+        addresses = frame[26:34]
+        ports = frame[34:38]
+        builders.append(('encapsulate, cached template', lambda: encaps.encapsulate(addresses, ports, data, True)))
+    return builders
+
+
+def bench_checksum(vt, size):
+    """ Full Internet checksum over size bytes of payload """
+    data = bytes(bytearray(i & 0xFF for i in range(size)))
+    return lambda: vt.compute_internet_checksum(data)
+
+
+def bench_checksum_update(vt):
+    """ Incremental checksum update for one rewritten 16-bit word """
+    return lambda: vt.update_internet_checksum(0x1c46, 0x00ff, 0x00fe)
+
+
+def firewall_rules(size, seed=0):
+    """
+    size random rules of the kinds a chain is likely to carry: exact ports,
+    port ranges, prefixes of a few lengths and per-path rules
+    """
+    rng = random.Random(seed)
+    rules = []
+    for i in range(size):
+        words = [rng.choice(['drop', 'drop', 'forward'])]
+        kind = rng.randrange(4)
+        if (kind == 0):
+            words += ['proto', 'tcp', 'dport', str(rng.randrange(1, 65536))]
+        elif (kind == 1):
+            lo = rng.randrange(1024, 60000)
+            words += ['proto', rng.choice(['tcp', 'udp']), 'dport', '%d-%d' % (lo, lo + rng.randrange(1000))]
+        elif (kind == 2):
+            words += ['src', '10.%d.%d.0/%d' % (rng.randrange(256), rng.randrange(256), rng.choice([24, 28, 32]))]
+        else:
+            words += ['nsp', str(rng.randrange(1, 1 << 24)), 'nsi', str(rng.randrange(256))]
+        rules.append(' '.join(words))
+    return rules
+
+
+def dispatch_entries(size, seed=0):
+    """
+    size dispatch table entries with the pipelines of a few kinds of chains,
+    the last one for the path of the bench frame (23, 255)
+    """
+    rng = random.Random(seed)
+    pipelines = ['count, forward', 'block 80', 'rst 22, forward', 'set c1 7', 'count, block 1000-2000, drop']
+    entries = ["%d %d %s" % (100 + i // 256, i % 256, rng.choice(pipelines)) for i in range(size - 1)]
+    return entries + ["23 255 count, set c1 1"]
+
+
+def bench_parse(vt, frame):
+    """ The one pass over the frame that finds all its headers """
+    length = len(frame)
+    return lambda: vt.parse_frame(frame, length, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS)
+
+
+def bench_firewall(vt, frame, size, cached=False, tracked=False):
+    """ Frame parse, flow decode and rule lookup for a frame no rule matches """
+    flows = None
+    if cached:
+        flows = vt.FlowCache(65536, 30.0)
+    if tracked:
+        firewall = vt.Firewall(firewall_rules(size), flows, vt.Conntrack(65536, 3600.0))
+    else:
+        firewall = vt.Firewall(firewall_rules(size), flows)
+    length = len(frame)
+    return lambda: vt.firewall_match(firewall, frame, vt.parse_frame(frame, length, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS))
+
+
+def bench_reset(vt, frame):
+    """ TCP RST for a blocked packet of a host pair whose template is built """
+    resets = vt.TcpResetTemplates(vt.FlowCache(vt.RESET_TEMPLATES, 30.0))
+    offsets = vt.parse_frame(frame, len(frame), VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS)
+    return lambda: resets.reply(frame, offsets, 42, True)
+
+
+def bench_forward(vt, frame, detailed=False, sample=0, probes=False):
+    """ In place forwarding of one frame, with the given PacketStats instrumentation """
+    stats = vt.PacketStats("bench", detailed, sample, probes)
+    firewall = vt.Firewall([])
+    buf = bytearray(frame)
+    length = len(frame)
+    dmac = b'\x00\x02'
+    def forward():
+        buf[:] = frame
+        vt.forward_packet_inplace(buf, length, dmac, True, firewall, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS,
+                                  stats, stats.start_timer())
+    return forward
+
+
+def bench_dispatch(vt, frame, size):
+    """ In place forwarding of one frame through a dispatch table of size paths """
+    stats = vt.PacketStats("bench")
+    table = vt.DispatchTable(dispatch_entries(size))
+    buf = bytearray(frame)
+    length = len(frame)
+    dmac = b'\x00\x02'
+    def forward():
+        buf[:] = frame
+        vt.forward_packet_inplace(buf, length, dmac, True, table, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS, stats)
+    return forward
+
+
+def bench_pipeline(vt, frame, rules=(), inner=False):
+    """
+    A frame through the stage pipeline the receive loop compiles for a
+    firewall of rules, forwarded encapsulated or inner
+    """
+    stats = vt.PacketStats("bench")
+    args = argparse.Namespace(do="forward", metadata=False, forward_inner=inner, swap_ip=True)
+    firewall = vt.Firewall(rules) if rules else None
+    resets = vt.TcpResetTemplates(vt.FlowCache(vt.RESET_TEMPLATES, 30.0))
+    encaps = vt.EncapTemplates(vt.FlowCache(vt.ENCAP_TEMPLATES, 30.0))
+    process = vt.compile_stages(vt.sf_stages(args, firewall, stats, None, None, vt.NullSender(), b'\x00\x02',
+                                             resets, encaps, VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS))
+    return lambda: process(frame, None, None)
+
+
+def replay(tool, pcap, loops):
+    """ Replay pcap through every mode of the tool, (name, ns/packet, pps) per mode """
+    for name, mode in REPLAY_MODES:
+        output = subprocess.check_output([sys.executable, tool, '--replay', pcap,
+                                          '--replay-loops', str(loops)] + mode)
+        lines = output.decode('utf-8', 'replace').splitlines()
+        summary = [line for line in lines if line.startswith('replay: ')][-1]
+        pps = summary.split(', ')[2]
+        yield "replay %s" % name, float(lines[-1].split()[0]), pps
+
+
+def run(func, number, repeat):
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best * 1e9 / number
+
+
+def benchmarks(vt, number):
+    """ (name, function, iterations) of every benchmark the tool supports """
+    frame = build_frame(vt)
+    yield "decode", bench_decode(vt, frame), number
+    if hasattr(vt, 'decode_dump_headers'):
+        yield "dump, headers decoded", bench_dump(vt, frame), number
+    if hasattr(vt, 'sf_stages'):
+        for mode, rules, inner in PIPELINE_MODES:
+            yield "pipeline, %s" % mode, bench_pipeline(vt, frame, rules, inner), number
+    if hasattr(vt, 'parse_frame'):
+        yield "parse_frame", bench_parse(vt, frame), number
+    for payload_len in FRAME_PAYLOADS:
+        sized = build_frame(vt, payload_len)
+        size = len(sized)
+        for name, func in bench_codecs(vt, sized):
+            yield "%s %dB" % (name, size), func, number
+        for name, func in bench_builders(vt, sized):
+            yield "%s %dB" % (name, size), func, max(number // 10, 1)
+    for size in CHECKSUM_SIZES:
+        yield "checksum %dB" % size, bench_checksum(vt, size), max(number * 64 // size // 10, 1)
+    if hasattr(vt, 'update_internet_checksum'):
+        yield "checksum update", bench_checksum_update(vt), number
+    if hasattr(vt, 'TcpResetTemplates'):
+        yield "tcp reset", bench_reset(vt, frame), number
+    if hasattr(vt, 'Firewall'):
+        for size in FIREWALL_SIZES:
+            yield "firewall %d rules" % size, bench_firewall(vt, frame, size), number
+    if hasattr(vt, 'StageTimer'):
+        for label, detailed, sample in [('counters only', False, 0), ('per path counters', True, 0),
+                                        ('stages timed every 64th packet', True, 64),
+                                        ('stages timed every packet', True, 1)]:
+            yield "forward, %s" % label, bench_forward(vt, frame, detailed, sample), number
+    if hasattr(vt, 'ProbeStats'):
+        # The last bytes of the inner payload become the trailer of a probe sent just now
+        probe = frame[:-vt.PROBE_TRAILER_CODEC.size] + vt.PROBE_TRAILER_CODEC.pack(0, 0, vt.monotonic_clock()(), vt.PROBE_MAGIC)
+        yield "forward, latency probe measured", bench_forward(vt, probe, probes=True), number
+    if hasattr(vt, 'DispatchTable'):
+        for size in FIREWALL_SIZES:
+            yield "forward, dispatch table of %d paths" % size, bench_dispatch(vt, frame, size), number
+    if hasattr(vt, 'FlowCache'):
+        size = FIREWALL_SIZES[-1]
+        yield "firewall %d rules, cached flow" % size, bench_firewall(vt, frame, size, True), number
+    if hasattr(vt, 'Conntrack'):
+        # The frame is a SYN, after the first one it is the retransmission of a tracked one
+        size = FIREWALL_SIZES[-1]
+        yield "firewall %d rules, cached flow, connection tracked" % size, bench_firewall(vt, frame, size, True, True), number
+
+
+def compare(ns, baseline_ns, threshold):
+    """ The change against the baseline as text, and whether it is a regression """
+    if baseline_ns is None:
+        return "new", False
+    change = (ns - baseline_ns) * 100.0 / baseline_ns
+    return "%+.1f%% against %.0f ns" % (change, baseline_ns), change > threshold
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for vxlan_tool.py',
+                                     prog='vxlan_bench.py')
+    parser.add_argument('--tool', default=DEFAULT_TOOL,
+                        help='Path of the vxlan_tool.py to benchmark')
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Iterations per measurement')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Measurements to take, the best one is reported')
+    parser.add_argument('-k', '--filter',
+                        help='Only run the benchmarks whose name contains this')
+    parser.add_argument('--json',
+                        help='Write the results to this file as JSON, to be used as --baseline later')
+    parser.add_argument('--baseline',
+                        help='Compare against the results of an earlier --json run')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Percent slowdown against --baseline counted as a regression, which makes the exit status 1')
+    parser.add_argument('--replay',
+                        help='Replay this pcap file through each mode of the tool instead')
+    parser.add_argument('--replay-loops', type=int, default=1,
+                        help='Replay the pcap file this many times per mode')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    if args.replay is not None:
+        print("%s (%s)" % (args.tool, args.replay))
+        measurements = ((name, lambda ns=ns: ns, ", " + pps)
+                        for name, ns, pps in replay(args.tool, args.replay, args.replay_loops))
+    else:
+        vt = load_tool(args.tool)
+        print("%s (%d byte frame)" % (args.tool, len(build_frame(vt))))
+        measurements = ((name, lambda func=func, number=number: run(func, number, args.repeat), "")
+                        for name, func, number in benchmarks(vt, args.number))
+    results = collections.OrderedDict()
+    regressions = []
+    for name, measure, extra in measurements:
+        if (args.filter is not None) and (args.filter not in name):
+            continue
+        ns = results[name] = measure()
+        if args.baseline is None:
+            print("%s: %.0f ns%s" % (name, ns, extra))
+            continue
+        change, regressed = compare(ns, baseline.get(name), args.threshold)
+        print("%s: %.0f ns%s (%s)%s" % (name, ns, extra, change, " REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'tool': args.tool, 'number': args.number, 'repeat': args.repeat,
+                       'results': results}, f, indent=2)
+            f.write("\n")
+    if regressions:
+        print("%d regressions over %.0f%%: %s" % (len(regressions), args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,501 @@
+#
+# Copyright (c) 2015 All rights reserved
+# This program and the accompanying materials
+# are made available under the terms of the Apache License, Version 2.0
+# which accompanies this distribution, and is available at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+
+"""
+End-to-end throughput harness for vxlan_tool.py on one machine.
+
+It builds a chain out of network namespaces and veth pairs, without an
+OpenStack deployment:
+
+    gen --> sff --> sf1 --> sff --> sf2 ... sfN --> sff --> sink
+
+gen runs the send mode load generator, every sfK runs
+vxlan_tool.py -d forward on its eth0 and sink only counts. sff stands in
+for the OVS SFF: a tc mirred rule hands every frame coming from one hop to
+the next one. The SFs swap the Ethernet addresses of the frames they
+forward, so their MACs alternate between the generator's and another one.
+
+Run it as root next to vxlan_tool.py:
+
+    python vxlan_harness.py
+
+Every configuration is run for every chain length, and gets its
+delivered pps and Gbps, its loss and the percentiles of the one way
+latency of probe frames sent next to the load. Loss and rates come from
+the veth counters of gen and sink, the per hop counts and the latency of
+the probes up to each hop from the SFs' reports, with --probe-stats.
+
+Run only some of the configurations, or pass other tool options:
+
+    python vxlan_harness.py --hops 1 3 -k ring
+    python vxlan_harness.py --config 'block=--block 80' --pps 50000
+
+and --json writes the results to a file. Without root, --self-check only
+checks the probe frames and filter the harness builds against the tool:
+
+    python vxlan_harness.py --self-check
+"""
+
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import imp
+import json
+import os
+import re
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CONFIGS = [('socket', []),
+           ('ring', ['--io', 'ring']),
+           ('batch 16', ['--batch', '16']),
+           ('xdp', ['--io', 'xdp'])]
+# Each SF swaps the Ethernet addresses, odd hops have SF_MAC and even ones GEN_MAC
+GEN_MAC = '02:00:00:00:00:01'
+SF_MAC = '02:00:00:00:00:02'
+SINK_MAC = '02:00:00:00:00:03'
+INNER_SOURCE_MAC = '02:00:00:00:01:01'
+INNER_DESTINATION_MAC = '02:00:00:00:01:02'
+OUTER_SOURCE_IP = '192.168.0.1'
+OUTER_DESTINATION_IP = '192.168.0.2'
+INNER_SOURCE_IP = '11.0.0.5'
+INNER_DESTINATION_IP = '11.0.0.6'
+# Probes end with the probe trailer of the tool, which the sink filter finds from the end
+PROBE_PORT = 7
+VXLAN_GPE_UDP_PORTS = [4790]
+VXLAN_UDP_PORTS = [4789] + VXLAN_GPE_UDP_PORTS
+PERCENTILES = [50, 90, 99]
+REPORT = re.compile(r'^[\w ]+: rx (\d+) pkts, tx (\d+) pkts')
+PROBE_REPORT = re.compile(r'^  probes nsp \d+: (\d+) received, .* latency mean (\d+) ns, p50 <= (\d+) ns, p99 <= (\d+) ns')
+
+CLONE_NEWNET = 0x40000000
+ETH_P_ALL = 0x0003
+BPF_LD_W_LEN = 0x80
+BPF_LD_W_IND = 0x40
+BPF_ALU_SUB_K = 0x14
+BPF_TAX = 0x07
+DEFAULT_TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'vxlan_tool.py')
+
+
+def load_tool(path):
+    return imp.load_source('vxlan_tool', path)
+
+
+class Topology(object):
+    """ The namespaces and veth pairs of a chain of hops SFs, named after prefix """
+    def __init__(self, prefix, hops):
+        self.prefix = prefix
+        self.gen = prefix + '-gen'
+        self.sff = prefix + '-sff'
+        self.sink = prefix + '-sink'
+        self.sfs = ['%s-sf%d' % (prefix, hop) for hop in range(1, hops + 1)]
+        # The sff end of each hop, in chain order
+        self.ports = ['gen'] + ['sf%d' % hop for hop in range(1, hops + 1)] + ['sink']
+
+    def namespaces(self):
+        return [self.sff, self.gen] + self.sfs + [self.sink]
+
+    def setup(self):
+        """ Create the chain, after removing what an earlier run may have left over """
+        self.teardown()
+        macs = [GEN_MAC] + [(SF_MAC, GEN_MAC)[hop % 2] for hop in range(len(self.sfs))] + [SINK_MAC]
+        for namespace in self.namespaces():
+            ip('netns', 'add', namespace)
+            ip('netns', 'exec', namespace, 'sysctl', '-qw', 'net.ipv6.conf.all.disable_ipv6=1',
+               'net.ipv6.conf.default.disable_ipv6=1')
+        for namespace, port, mac in zip([self.gen] + self.sfs + [self.sink], self.ports, macs):
+            ip('link', 'add', 'name', 'eth0', 'netns', namespace, 'address', mac,
+               'type', 'veth', 'peer', 'name', port, 'netns', self.sff)
+            ip('-n', namespace, 'link', 'set', 'eth0', 'up')
+            ip('-n', self.sff, 'link', 'set', port, 'up')
+        for port, next_port in zip(self.ports[:-1], self.ports[1:]):
+            tc('-n', self.sff, 'qdisc', 'add', 'dev', port, 'clsact')
+            tc('-n', self.sff, 'filter', 'add', 'dev', port, 'ingress', 'protocol', 'all',
+               'u32', 'match', 'u32', '0', '0', 'action', 'mirred', 'egress', 'redirect', 'dev', next_port)
+
+    def teardown(self):
+        """ Deleting the namespaces deletes their veths too """
+        existing = subprocess.check_output(['ip', 'netns', 'list']).decode('utf-8', 'replace').split()
+        for namespace in self.namespaces():
+            if namespace in existing:
+                ip('netns', 'del', namespace)
+
+    def counters(self, namespace):
+        """ The stats64 counters of eth0 in namespace """
+        output = subprocess.check_output(['ip', '-n', namespace, '-s', '-j', 'link', 'show', 'dev', 'eth0'])
+        return json.loads(output.decode('utf-8'))[0]['stats64']
+
+
+def ip(*args):
+    subprocess.check_call(('ip',) + args)
+
+
+def tc(*args):
+    subprocess.check_call(('tc',) + args)
+
+
+def netns_socket(namespace, protocol):
+    """ An AF_PACKET socket bound to eth0 in namespace """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    own = open('/proc/self/ns/net')
+    target = open('/var/run/netns/' + namespace)
+    try:
+        if libc.setns(target.fileno(), CLONE_NEWNET) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "can't enter namespace %s: %s" % (namespace, os.strerror(err)))
+        try:
+            s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(protocol))
+            s.bind(('eth0', 0))
+        finally:
+            libc.setns(own.fileno(), CLONE_NEWNET)
+    finally:
+        own.close()
+        target.close()
+    return s
+
+
+def build_probe(vt, seq, timestamp, args):
+    """ A frame laid out like the generator's, to PROBE_PORT, ending with the probe trailer """
+    trailer = vt.PROBE_TRAILER_CODEC.pack(0, seq, timestamp, vt.PROBE_MAGIC)
+    inner_eth = vt.ETHHEADER(*(vt.mac_to_ints(INNER_DESTINATION_MAC) + vt.mac_to_ints(INNER_SOURCE_MAC) + [0x08, 0x00]))
+    inner = vt.build_udp_packet(INNER_SOURCE_IP, INNER_DESTINATION_IP, PROBE_PORT, PROBE_PORT, trailer, False)
+    nsh = vt.BASEHEADER(service_path=args.nsp, service_index=args.nsi)
+    context = vt.CONTEXTHEADER(vt.int_from_bytes(socket.inet_aton(OUTER_DESTINATION_IP)), 0x1234, 0x12345678, 0x87654321)
+    vxlan = vt.VXLAN(0, 0, 0x04, 0x1234, 0)
+    outer_eth = vt.ETHHEADER(*(vt.mac_to_ints(SF_MAC) + vt.mac_to_ints(GEN_MAC) + [0x08, 0x00]))
+    return outer_eth.build() + vt.build_udp_packet(OUTER_SOURCE_IP, OUTER_DESTINATION_IP, 55651, 4790,
+                                                   vxlan.build() + nsh.build() + context.build() +
+                                                   inner_eth.build() + inner, False)
+
+
+def probe_filter(vt):
+    """ Classic BPF program accepting the frames whose last 4 bytes are the probe magic """
+    magic = vt.int_from_bytes(vt.PROBE_MAGIC)
+    return vt.assemble_bpf([(BPF_LD_W_LEN, 0, 0, 0),
+                            (BPF_ALU_SUB_K, 0, 0, 4),
+                            (BPF_TAX, 0, 0, 0),
+                            (BPF_LD_W_IND, 0, 0, 0),
+                            (vt.BPF_JEQ_K, 0, 'reject', magic),
+                            (vt.BPF_RET_K, 0, 0, vt.BPF_ACCEPT),
+                            'reject',
+                            (vt.BPF_RET_K, 0, 0, 0)])
+
+
+def self_check(vt, args):
+    """
+    Check the frames and filter the harness builds, without root or a
+    chain: the probe must be a VxLAN-gpe + NSH frame on the nsp and nsi of
+    the load ending with a trailer the tool reads back, and the probe
+    filter, attached to a UDP socket on the loopback, must take the probe
+    and not a frame that only differs in the magic. Returns the problems.
+    """
+    problems = []
+    probe = build_probe(vt, 1, 2, args)
+    offsets = vt.parse_frame(probe, len(probe), VXLAN_UDP_PORTS, VXLAN_GPE_UDP_PORTS)
+    if (offsets is None) or (offsets is vt.FRAME_TRUNCATED) or (offsets.nsh is None):
+        problems.append("the probe isn't a VxLAN-gpe + NSH frame")
+    elif (offsets.path != ((args.nsp << 8) | args.nsi)) or (offsets.inner_proto != socket.IPPROTO_UDP):
+        problems.append("the probe isn't UDP on nsp %d nsi %d" % (args.nsp, args.nsi))
+    trailer = vt.PROBE_TRAILER_CODEC.unpack_from(probe, len(probe) - vt.PROBE_TRAILER_CODEC.size)
+    if trailer != (0, 1, 2, vt.PROBE_MAGIC):
+        problems.append("the probe trailer reads back as %r" % (trailer,))
+
+    recv_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    send_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        recv_s.bind(('127.0.0.1', 0))
+        vt.attach_prefilter(recv_s, probe_filter(vt))
+        recv_s.settimeout(1.0)
+        # Were the other frame let through it would be received first
+        send_s.sendto(probe[:-4] + b'\x00' * 4, recv_s.getsockname())
+        send_s.sendto(probe, recv_s.getsockname())
+        try:
+            if recv_s.recv(65535) != probe:
+                problems.append("the probe filter takes frames without the probe magic")
+        except socket.timeout:
+            problems.append("the probe filter drops the probe")
+    finally:
+        send_s.close()
+        recv_s.close()
+    return problems
+
+
+class Probes(object):
+    """ Sends probes from gen at rate per second and records their latency at sink until stopped """
+    def __init__(self, vt, topology, rate, args):
+        self.vt = vt
+        self.args = args
+        self.interval = 1.0 / rate
+        self.clock = vt.monotonic_clock()
+        self.send_s = netns_socket(topology.gen, 0)
+        self.recv_s = netns_socket(topology.sink, ETH_P_ALL)
+        self.recv_s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        vt.attach_prefilter(self.recv_s, probe_filter(vt))
+        self.recv_s.settimeout(0.2)
+        self.sent = 0
+        self.latencies = []
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.send), threading.Thread(target=self.receive)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, drain):
+        """ Stop sending, keep receiving for drain seconds """
+        self.stopped.set()
+        self.threads[0].join()
+        time.sleep(drain)
+        self.threads[1].join()
+        self.send_s.close()
+        self.recv_s.close()
+
+    def send(self):
+        due = time.time()
+        while not self.stopped.is_set():
+            self.send_s.send(build_probe(self.vt, self.sent, self.clock(), self.args))
+            self.sent += 1
+            due += self.interval
+            self.stopped.wait(max(due - time.time(), 0))
+
+    def receive(self):
+        seen = set()
+        while (not self.stopped.is_set()) or (len(seen) < self.sent):
+            try:
+                frame = self.recv_s.recv(65535)
+            except socket.timeout:
+                if self.stopped.is_set():
+                    break
+                continue
+            received = self.clock()
+            stream, seq, sent, magic = self.vt.PROBE_TRAILER_CODEC.unpack_from(frame, len(frame) - self.vt.PROBE_TRAILER_CODEC.size)
+            if (magic == self.vt.PROBE_MAGIC) and (seq not in seen):
+                seen.add(seq)
+                self.latencies.append(received - sent)
+
+
+def read_output(output):
+    output.seek(0)
+    return output.read().decode('utf-8', 'replace')
+
+
+def percentile(values, percent):
+    """ Nearest rank percentile of the sorted values """
+    if not values:
+        return None
+    rank = max(int(round(percent / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def measure(vt, topology, tool_args, args):
+    """ Run the load through the chain with every SF started with tool_args, return the results """
+    # The SFs write to files, a verbose one would block on a full pipe
+    outputs = [tempfile.TemporaryFile() for namespace in topology.sfs]
+    sfs = []
+    probes = None
+    for namespace, output in zip(topology.sfs, outputs):
+        sfs.append(subprocess.Popen(['ip', 'netns', 'exec', namespace, sys.executable, args.tool,
+                                     '-i', 'eth0', '-d', 'forward', '-v', 'off', '--probe-stats'] + tool_args,
+                                    stdout=output, stderr=subprocess.STDOUT))
+    try:
+        time.sleep(args.settle)
+        for namespace, sf, output in zip(topology.sfs, sfs, outputs):
+            if sf.poll() is not None:
+                lines = read_output(output).strip().splitlines()
+                raise RuntimeError("the SF in %s exited: %s" % (namespace, lines[-1] if lines else sf.returncode))
+
+        probes = Probes(vt, topology, args.probe_rate, args)
+        gen_before = topology.counters(topology.gen)['tx']
+        sink_before = topology.counters(topology.sink)['rx']
+        probes.start()
+        generator = ['ip', 'netns', 'exec', topology.gen, sys.executable, args.tool, '-i', 'eth0', '-d', 'send',
+                     '-t', 'vxlan_gpe_nsh', '--outer-source-mac', GEN_MAC, '--outer-destination-mac', SF_MAC,
+                     '--outer-source-ip', OUTER_SOURCE_IP, '--outer-destination-ip', OUTER_DESTINATION_IP,
+                     '--inner-source-mac', INNER_SOURCE_MAC, '--inner-destination-mac', INNER_DESTINATION_MAC,
+                     '--inner-source-ip', INNER_SOURCE_IP, '--inner-destination-ip', INNER_DESTINATION_IP,
+                     '--inner-source-udp-port-count', str(args.flows), '--nsp', str(args.nsp), '--nsi', str(args.nsi),
+                     '--frame-size', args.frame_size, '--duration', str(args.duration), '--batch', str(args.batch)]
+        if args.gbps:
+            generator += ['--gbps', str(args.gbps)]
+        else:
+            generator += ['--pps', str(args.pps)]
+        subprocess.check_output(generator, stderr=subprocess.STDOUT)
+        probes.stop(args.drain)
+        gen = topology.counters(topology.gen)['tx']
+        sink = topology.counters(topology.sink)['rx']
+    finally:
+        if (probes is not None) and (not probes.stopped.is_set()):
+            probes.stop(0)
+        for sf in sfs:
+            if sf.poll() is None:
+                sf.terminate()
+            sf.wait()
+        reports = [read_output(output) for output in outputs]
+
+    hops = []
+    for report in reports:
+        lines = report.splitlines()
+        counts = [match for match in map(REPORT.match, lines) if match is not None]
+        if not counts:
+            hops.append(None)
+            continue
+        hop = collections.OrderedDict([('rx', int(counts[0].group(1))), ('tx', int(counts[0].group(2)))])
+        probe_counts = [match for match in map(PROBE_REPORT.match, lines) if match is not None]
+        if probe_counts:
+            # From gen up to the SF, the histogram only gives upper bounds of p50 and p99
+            hop['probes'] = int(probe_counts[0].group(1))
+            hop['latency_mean_us'] = int(probe_counts[0].group(2)) / 1e3
+            hop['latency_p50_us'] = int(probe_counts[0].group(3)) / 1e3
+            hop['latency_p99_us'] = int(probe_counts[0].group(4)) / 1e3
+        hops.append(hop)
+
+    sent = gen['packets'] - gen_before['packets']
+    received = sink['packets'] - sink_before['packets']
+    latencies = sorted(latency / 1e3 for latency in probes.latencies)
+    result = collections.OrderedDict()
+    result['offered_pps'] = sent / args.duration
+    result['pps'] = received / args.duration
+    result['gbps'] = (sink['bytes'] - sink_before['bytes']) * 8 / args.duration / 1e9
+    result['loss'] = (sent - received) / float(sent) if sent else 0.0
+    result['probes'] = probes.sent
+    result['probes_lost'] = probes.sent - len(latencies)
+    for percent in PERCENTILES:
+        result['latency_p%d_us' % percent] = percentile(latencies, percent)
+    result['latency_max_us'] = latencies[-1] if latencies else None
+    result['hops'] = hops
+    return result
+
+
+def format_result(name, result):
+    latency = ' '.join('p%d %s' % (percent, format_us(result['latency_p%d_us' % percent]))
+                       for percent in PERCENTILES)
+    lines = ["%s: %.0f pps offered, %.0f pps, %.3f Gbps, loss %.2f%%, latency %s max %s us (%d/%d probes lost)" %
+             (name, result['offered_pps'], result['pps'], result['gbps'], result['loss'] * 100, latency,
+              format_us(result['latency_max_us']), result['probes_lost'], result['probes'])]
+    previous = 0.0
+    for hop, counts in enumerate(result['hops'], 1):
+        if counts is None:
+            lines.append("  sf%d: no report" % hop)
+        elif 'latency_mean_us' not in counts:
+            lines.append("  sf%d: rx %d, tx %d" % (hop, counts['rx'], counts['tx']))
+        else:
+            # Each hop's own latency is what its mean adds to the one before
+            lines.append("  sf%d: rx %d, tx %d, latency mean %.0f us (+%.0f), p50 <= %.0f p99 <= %.0f us" %
+                         (hop, counts['rx'], counts['tx'], counts['latency_mean_us'],
+                          counts['latency_mean_us'] - previous, counts['latency_p50_us'], counts['latency_p99_us']))
+            previous = counts['latency_mean_us']
+    return '\n'.join(lines)
+
+
+def format_us(value):
+    if value is None:
+        return '-'
+    return '%.0f' % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput harness for vxlan_tool.py',
+                                     prog='vxlan_harness.py')
+    parser.add_argument('--tool', default=DEFAULT_TOOL,
+                        help='Path of the vxlan_tool.py to run')
+    parser.add_argument('--hops', type=int, nargs='+', default=[1],
+                        help='Chain lengths to run every configuration with')
+    parser.add_argument('--config', action='append', metavar='NAME=ARGS',
+                        help='Run the SFs with these vxlan_tool.py options instead of the default configurations, can be repeated')
+    parser.add_argument('-k', '--filter',
+                        help='Only run the configurations whose name contains this')
+    parser.add_argument('--pps', type=float, default=10000,
+                        help='Offered load in packets per second')
+    parser.add_argument('--gbps', type=float,
+                        help='Offered load in Gbit/s of Ethernet frames, instead of --pps')
+    parser.add_argument('--frame-size', default='64',
+                        help="Size of the generated frames in bytes including FCS, or 'imix'")
+    parser.add_argument('--flows', type=int, default=1,
+                        help='Spread the load over this many inner UDP source ports')
+    parser.add_argument('--nsp', type=int, default=23,
+                        help='nsp of the generated frames')
+    parser.add_argument('--nsi', type=int, default=255,
+                        help='nsi of the generated frames')
+    parser.add_argument('--batch', type=int, default=16,
+                        help='Frames the generator sends per system call')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='Seconds to send for in each run')
+    parser.add_argument('--probe-rate', type=float, default=100.0,
+                        help='Latency probes sent per second')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='Seconds the SFs are given to start before the load')
+    parser.add_argument('--drain', type=float, default=1.0,
+                        help='Seconds to wait for frames still in the chain after the load')
+    parser.add_argument('--prefix', default='vxh',
+                        help='Prefix of the network namespace names')
+    parser.add_argument('--keep', default=False, action='store_true',
+                        help="Don't delete the namespaces after the last run")
+    parser.add_argument('--json',
+                        help='Write the results to this file as JSON')
+    parser.add_argument('--self-check', default=False, action='store_true',
+                        help='Only check the probe frames and filter the harness builds, needs no root')
+    args = parser.parse_args()
+
+    if args.self_check:
+        problems = self_check(load_tool(args.tool), args)
+        for problem in problems:
+            print("Error: %s" % problem)
+        if problems:
+            sys.exit(1)
+        print("%s: probe frames and filter check out" % args.tool)
+        return
+    if os.geteuid() != 0:
+        print("Error: the harness must run as root to create network namespaces")
+        sys.exit(-1)
+    configs = CONFIGS
+    if args.config:
+        configs = []
+        for config in args.config:
+            name, _, options = config.partition('=')
+            configs.append((name, shlex.split(options)))
+
+    vt = load_tool(args.tool)
+    print("%s (%s byte frames, %s)" % (args.tool, args.frame_size,
+                                       "%g Gbps" % args.gbps if args.gbps else "%g pps" % args.pps))
+    results = collections.OrderedDict()
+    for hops in args.hops:
+        topology = Topology(args.prefix, hops)
+        topology.setup()
+        try:
+            for name, options in configs:
+                if (args.filter is not None) and (args.filter not in name):
+                    continue
+                label = "%s, %d hop%s" % (name, hops, "s" if hops > 1 else "")
+                try:
+                    results[label] = measure(vt, topology, options, args)
+                except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+                    print("%s: %s" % (label, e))
+                    continue
+                print(format_result(label, results[label]))
+        finally:
+            if not args.keep:
+                topology.teardown()
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'tool': args.tool, 'pps': args.pps, 'gbps': args.gbps, 'frame_size': args.frame_size,
+                       'duration': args.duration, 'results': results}, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -15,11 +15,31 @@ __status__ = "beta"
 import socket, sys
 import pdb
 import argparse
+import binascii
+import ctypes
+import ctypes.util
+import errno
+import json
+import mmap
+import multiprocessing
+import os
+import select
+import signal
+import threading
+import time
+import traceback
 from struct import *
-from ctypes import Structure, c_ubyte, c_ushort, c_uint
+from array import array
+from bisect import bisect_right
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 NSH_TYPE1_LEN = 0x6
 NSH_MD_TYPE1 = 0x1
+NSH_MD_TYPE2 = 0x2
 NSH_VERSION1 = int('00', 2)
 NSH_NEXT_PROTO_IPV4 = int('00000001', 2)
 NSH_NEXT_PROTO_OAM = int('00000100', 2)
@@ -36,6 +56,36 @@ IPV4_IHL_VER = (IPV4_VERSION << 4) + IP_HEADER_LEN
 
 UDP_HEADER_LEN_BYTES = 8
 
+RECV_BUF_SIZE = 65565
+MSG_WAITFORONE = 0x10000
+""" How long an idle receive loop waits for a frame before looking for new settings again """
+IDLE_POLL_MS = 100
+
+""" Precompiled header codecs, used with unpack_from/pack_into at an offset """
+ETH_CODEC = Struct('!B B B B B B B B B B B B B B')
+IP4_CODEC = Struct('!B B H H H B B H I I')
+UDP_CODEC = Struct('!H H H H')
+TCP_CODEC = Struct('!H H I I B B H H H')
+ICMP_CODEC = Struct('!B B H H H I')
+VXLAN_CODEC = Struct('!B H B I')
+NSH_BASE_CODEC = Struct('!H B B I')
+NSH_CONTEXT_CODEC = Struct('!I I I I')
+PSEUDO_HEADER_CODEC = Struct('!I I B B H')
+U8_CODEC = Struct('!B')
+U16_CODEC = Struct('!H')
+MAC_PAIR_CODEC = Struct('!6s6s')
+IP4_ADDR_PAIR_CODEC = Struct('!4s4s')
+U32_PAIR_CODEC = Struct('!II')
+FLOW_IP_CODEC = Struct('!9xB2xII')
+PORT_PAIR_CODEC = Struct('!HH')
+IP_VER_PROTO_CODEC = Struct('!B8xB')
+ETH_IP_PROTO_CODEC = Struct('!12xHB8xB')
+ETH_IP_UDP_PORT_CODEC = Struct('!12xHB8xB12xH')
+ETH_NSH_BASE_CODEC = Struct('!12xHHBBI')
+NSH_TLV_CODEC = Struct('!HBB')
+TCP_PORTS_SEQ_CODEC = Struct('!HHI')
+U32_CODEC = Struct('!I')
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -46,16 +96,29 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-class VXLAN(Structure):
-    _fields_ = [('flags', c_ubyte),
-                ('reserved', c_uint, 16),
-                ('next_protocol', c_uint, 8),
-                ('vni', c_uint, 24),
-                ('reserved2', c_uint, 8)]
+class HeaderRecord(object):
+    """
+    Lightweight packet header, the fields are listed in __slots__ and packed
+    by codec in that order unless packed_values() says otherwise
+    """
+    __slots__ = ()
+    codec = None
+
+    def packed_values(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def build(self):
+        return self.codec.pack(*self.packed_values())
+
+    def build_into(self, buf, offset):
+        self.codec.pack_into(buf, offset, *self.packed_values())
+
+class VXLAN(HeaderRecord):
+    __slots__ = ('flags', 'reserved', 'next_protocol', 'vni', 'reserved2')
+    codec = VXLAN_CODEC
 
     def __init__(self, flags=int('00001000', 2), reserved=0, next_protocol=0,
-                 vni=int('111111111111111111111111', 2), reserved2=0, *args, **kwargs):
-        super(self.__class__, self).__init__(*args, **kwargs)
+                 vni=int('111111111111111111111111', 2), reserved2=0):
         self.flags = flags
         self.reserved = reserved
         self.next_protocol = next_protocol
@@ -64,63 +127,47 @@ class VXLAN(Structure):
 
     header_size = 8
 
-    def build(self):
-        return pack('!B H B I',
-                    self.flags,
-                    self.reserved,
-                    self.next_protocol,
-                    (self.vni << 8) + self.reserved2)
-
-class ETHHEADER(Structure):
-    _fields_ = [('dmac0', c_ubyte),
-                ('dmac1', c_ubyte),
-                ('dmac2', c_ubyte),
-                ('dmac3', c_ubyte),
-                ('dmac4', c_ubyte),
-                ('dmac5', c_ubyte),
-                ('smac0', c_ubyte),
-                ('smac1', c_ubyte),
-                ('smac2', c_ubyte),
-                ('smac3', c_ubyte),
-                ('smac4', c_ubyte),
-                ('smac5', c_ubyte),
-                ('ethertype0', c_ubyte),
-                ('ethertype1', c_ubyte)]
+    def packed_values(self):
+        return (self.flags,
+                self.reserved,
+                self.next_protocol,
+                ((self.vni & 0xFFFFFF) << 8) + (self.reserved2 & 0xFF))
+
+class ETHHEADER(HeaderRecord):
+    __slots__ = ('dmac0', 'dmac1', 'dmac2', 'dmac3', 'dmac4', 'dmac5',
+                 'smac0', 'smac1', 'smac2', 'smac3', 'smac4', 'smac5',
+                 'ethertype0', 'ethertype1')
+    codec = ETH_CODEC
+
+    def __init__(self, dmac0=0, dmac1=0, dmac2=0, dmac3=0, dmac4=0, dmac5=0, smac0=0, smac1=0,
+                 smac2=0, smac3=0, smac4=0, smac5=0, ethertype0=0, ethertype1=0):
+        self.dmac0 = dmac0
+        self.dmac1 = dmac1
+        self.dmac2 = dmac2
+        self.dmac3 = dmac3
+        self.dmac4 = dmac4
+        self.dmac5 = dmac5
+        self.smac0 = smac0
+        self.smac1 = smac1
+        self.smac2 = smac2
+        self.smac3 = smac3
+        self.smac4 = smac4
+        self.smac5 = smac5
+        self.ethertype0 = ethertype0
+        self.ethertype1 = ethertype1
 
     header_size = 14
 
-    def build(self):
-        return pack('!B B B B B B B B B B B B B B',
-                    self.dmac0,
-                    self.dmac1,
-                    self.dmac2,
-                    self.dmac3,
-                    self.dmac4,
-                    self.dmac5,
-                    self.smac0,
-                    self.smac1,
-                    self.smac2,
-                    self.smac3,
-                    self.smac4,
-                    self.smac5,
-                    self.ethertype0,
-                    self.ethertype1)
-
-class BASEHEADER(Structure):
+class BASEHEADER(HeaderRecord):
     """
     Represent a NSH base header
     """
-    _fields_ = [('version', c_ushort, 2),
-                ('flags', c_ushort, 8),
-                ('length', c_ushort, 6),
-                ('md_type', c_ubyte),
-                ('next_protocol', c_ubyte),
-                ('service_path', c_uint, 24),
-                ('service_index', c_uint, 8)]
+    __slots__ = ('version', 'flags', 'length', 'md_type', 'next_protocol',
+                 'service_path', 'service_index')
+    codec = NSH_BASE_CODEC
 
     def __init__(self, service_path=1, service_index=255, version=NSH_VERSION1, flags=NSH_FLAG_ZERO,
-                 length=NSH_TYPE1_LEN, md_type=NSH_MD_TYPE1, proto=NSH_NEXT_PROTO_ETH, *args, **kwargs):
-        super(self.__class__, self).__init__(*args, **kwargs)
+                 length=NSH_TYPE1_LEN, md_type=NSH_MD_TYPE1, proto=NSH_NEXT_PROTO_ETH):
         self.version = version
         self.flags = flags
         self.length = length
@@ -131,97 +178,85 @@ class BASEHEADER(Structure):
 
     header_size = 8
 
-    def build(self):
-        return pack('!H B B I',
-                    (self.version << 14) + (self.flags << 6) + self.length,
-                    self.md_type,
-                    self.next_protocol,
-                    (self.service_path << 8) + self.service_index)
-
+    def packed_values(self):
+        return (((self.version & 0x3) << 14) + ((self.flags & 0xFF) << 6) + (self.length & 0x3F),
+                self.md_type,
+                self.next_protocol,
+                ((self.service_path & 0xFFFFFF) << 8) + (self.service_index & 0xFF))
 
-class CONTEXTHEADER(Structure):
-    _fields_ = [('network_platform', c_uint),
-                ('network_shared', c_uint),
-                ('service_platform', c_uint),
-                ('service_shared', c_uint)]
 
-    header_size = 16
+class CONTEXTHEADER(HeaderRecord):
+    __slots__ = ('network_platform', 'network_shared', 'service_platform', 'service_shared')
+    codec = NSH_CONTEXT_CODEC
 
-    def __init__(self, network_platform=0x00, network_shared=0x00, service_platform=0x00, service_shared=0x00, *args,
-                 **kwargs):
-        super(self.__class__, self).__init__(*args, **kwargs)
+    def __init__(self, network_platform=0, network_shared=0, service_platform=0, service_shared=0):
         self.network_platform = network_platform
         self.network_shared = network_shared
         self.service_platform = service_platform
         self.service_shared = service_shared
 
-    def build(self):
-        return pack('!I I I I',
-                    self.network_platform,
-                    self.network_shared,
-                    self.service_platform,
-                    self.service_shared)
-
-class IP4HEADER(Structure):
-    _fields_ = [
-        ('ip_ihl', c_ubyte),
-        ('ip_ver', c_ubyte),
-        ('ip_tos', c_ubyte),
-        ('ip_tot_len', c_ushort),
-        ('ip_id', c_ushort),
-        ('ip_frag_offset', c_ushort),
-        ('ip_ttl', c_ubyte),
-        ('ip_proto', c_ubyte),
-        ('ip_chksum', c_ushort),
-        ('ip_saddr', c_uint),
-        ('ip_daddr', c_uint)]
+    header_size = 16
+
+class IP4HEADER(HeaderRecord):
+    __slots__ = ('ip_ihl', 'ip_ver', 'ip_tos', 'ip_tot_len', 'ip_id', 'ip_frag_offset',
+                 'ip_ttl', 'ip_proto', 'ip_chksum', 'ip_saddr', 'ip_daddr')
+    codec = IP4_CODEC
+
+    def __init__(self, ip_ihl=IP_HEADER_LEN, ip_ver=IPV4_VERSION, ip_tos=0, ip_tot_len=0, ip_id=0, ip_frag_offset=0,
+                 ip_ttl=0, ip_proto=0, ip_chksum=0, ip_saddr=0, ip_daddr=0):
+        self.ip_ihl = ip_ihl
+        self.ip_ver = ip_ver
+        self.ip_tos = ip_tos
+        self.ip_tot_len = ip_tot_len
+        self.ip_id = ip_id
+        self.ip_frag_offset = ip_frag_offset
+        self.ip_ttl = ip_ttl
+        self.ip_proto = ip_proto
+        self.ip_chksum = ip_chksum
+        self.ip_saddr = ip_saddr
+        self.ip_daddr = ip_daddr
 
     header_size = 20
 
-    def build(self):
-        ip_header_pack = pack('!B B H H H B B H I I', IPV4_IHL_VER, self.ip_tos, self.ip_tot_len, self.ip_id,
-                              self.ip_frag_offset, self.ip_ttl, self.ip_proto, self.ip_chksum, self.ip_saddr,
-                              self.ip_daddr)
-        return ip_header_pack
+    def packed_values(self):
+        return ((self.ip_ver << 4) | self.ip_ihl, self.ip_tos, self.ip_tot_len, self.ip_id,
+                self.ip_frag_offset, self.ip_ttl, self.ip_proto, self.ip_chksum, self.ip_saddr,
+                self.ip_daddr)
 
     def set_ip_checksum(self, checksum):
         self.ip_chksum = checksum
 
-class UDPHEADER(Structure):
+class UDPHEADER(HeaderRecord):
     """
     Represents a UDP header
     """
-    _fields_ = [
-        ('udp_sport', c_ushort),
-        ('udp_dport', c_ushort),
-        ('udp_len', c_ushort),
-        ('udp_sum', c_ushort)]
+    __slots__ = ('udp_sport', 'udp_dport', 'udp_len', 'udp_sum')
+    codec = UDP_CODEC
 
-    header_size = 8
+    def __init__(self, udp_sport=0, udp_dport=0, udp_len=0, udp_sum=0):
+        self.udp_sport = udp_sport
+        self.udp_dport = udp_dport
+        self.udp_len = udp_len
+        self.udp_sum = udp_sum
 
-    def build(self):
-        udp_header_pack = pack('!H H H H', self.udp_sport, self.udp_dport, self.udp_len,
-                               self.udp_sum)
-        return udp_header_pack
+    header_size = 8
 
-class PSEUDO_TCPHEADER(Structure):
+class PSEUDO_TCPHEADER(HeaderRecord):
     """ Pseudoheader used in the TCP checksum."""
+    __slots__ = ('src_ip', 'dest_ip', 'zeroes', 'protocol', 'length')
+    codec = PSEUDO_HEADER_CODEC
 
     def __init__(self):
         self.src_ip = 0
         self.dest_ip = 0
         self.zeroes = 0
-        self.protocol = 6 
+        self.protocol = 6
         self.length = 0
 
-    def build(self):
-        """ Create a string from a pseudoheader """
-        p_tcp_header_pack = pack('!I I B B H', self.src_ip, self.dest_ip,
-                                 self.zeroes, self.protocol, self.length)
-        return p_tcp_header_pack
-
-class PSEUDO_UDPHEADER(Structure):
+class PSEUDO_UDPHEADER(HeaderRecord):
     """ Pseudoheader used in the UDP checksum."""
+    __slots__ = ('src_ip', 'dest_ip', 'zeroes', 'protocol', 'length')
+    codec = PSEUDO_HEADER_CODEC
 
     def __init__(self):
         self.src_ip = 0
@@ -230,195 +265,339 @@ class PSEUDO_UDPHEADER(Structure):
         self.protocol = 17
         self.length = 0
 
-    def build(self):
-        """ Create a string from a pseudoheader """
-        p_udp_header_pack = pack('!I I B B H', self.src_ip, self.dest_ip,
-                                 self.zeroes, self.protocol, self.length)
-        return p_udp_header_pack
-
-class TCPHEADER(Structure):
+class TCPHEADER(HeaderRecord):
     """
     Represents a TCP header
     """
-    _fields_ = [
-        ('tcp_sport', c_ushort),
-        ('tcp_dport', c_ushort),
-        ('tcp_seq', c_uint),
-        ('tcp_ack', c_uint),
-        ('tcp_offset', c_ubyte),
-        ('tcp_flags', c_ubyte),
-        ('tcp_window', c_ushort),
-        ('tcp_checksum', c_ushort),
-        ('tcp_urgent', c_ushort),]
+    __slots__ = ('tcp_sport', 'tcp_dport', 'tcp_seq', 'tcp_ack', 'tcp_offset',
+                 'tcp_flags', 'tcp_window', 'tcp_checksum', 'tcp_urgent')
+    codec = TCP_CODEC
+
+    def __init__(self, tcp_sport=0, tcp_dport=0, tcp_seq=0, tcp_ack=0, tcp_offset=0, tcp_flags=0,
+                 tcp_window=0, tcp_checksum=0, tcp_urgent=0):
+        self.tcp_sport = tcp_sport
+        self.tcp_dport = tcp_dport
+        self.tcp_seq = tcp_seq
+        self.tcp_ack = tcp_ack
+        self.tcp_offset = tcp_offset
+        self.tcp_flags = tcp_flags
+        self.tcp_window = tcp_window
+        self.tcp_checksum = tcp_checksum
+        self.tcp_urgent = tcp_urgent
 
     header_size = 20
 
-    def build(self):
-        tcp_header_pack = pack('!H H I I B B H H H', self.tcp_sport, self.tcp_dport,
-                               self.tcp_seq, self.tcp_ack, self.tcp_offset,
-                               self.tcp_flags, self.tcp_window, self.tcp_checksum,
-                               self.tcp_urgent)
-        return tcp_header_pack
-
-class ICMPHEADER(Structure):
+class ICMPHEADER(HeaderRecord):
     """
     Represents a ICMP header
     """
-    _fields_ = [
-        ('icmp_type', c_ubyte),
-        ('icmp_code', c_ubyte),
-        ('icmp_checksum', c_ushort),
-        ('icmp_unused', c_ushort),
-        ('icmp_MTU', c_ushort),
-        ('icmp_iphead', c_uint)]
+    __slots__ = ('icmp_type', 'icmp_code', 'icmp_checksum', 'icmp_unused', 'icmp_MTU',
+                 'icmp_iphead')
+    codec = ICMP_CODEC
+
+    def __init__(self, icmp_type=0, icmp_code=0, icmp_checksum=0, icmp_unused=0, icmp_MTU=0,
+                 icmp_iphead=0):
+        self.icmp_type = icmp_type
+        self.icmp_code = icmp_code
+        self.icmp_checksum = icmp_checksum
+        self.icmp_unused = icmp_unused
+        self.icmp_MTU = icmp_MTU
+        self.icmp_iphead = icmp_iphead
 
     header_size = 12
 
-    def build(self):
-        icmp_header_pack = pack('!B B H H H I', self.icmp_type, self.icmp_code,
-                                self.icmp_checksum, self.icmp_unused, self.icmp_MTU,
-                                self.icmp_iphead)
-        return icmp_header_pack
-
 
 def decode_eth(payload, offset, eth_header_values):
-    eth_header = payload[offset:(offset+14)]
-
-    _header_values = unpack('!B B B B B B B B B B B B B B', eth_header)
-    eth_header_values.dmac0 = _header_values[0]
-    eth_header_values.dmac1 = _header_values[1]
-    eth_header_values.dmac2 = _header_values[2]
-    eth_header_values.dmac3 = _header_values[3]
-    eth_header_values.dmac4 = _header_values[4]
-    eth_header_values.dmac5 = _header_values[5]
-    eth_header_values.smac0 = _header_values[6]
-    eth_header_values.smac1 = _header_values[7]
-    eth_header_values.smac2 = _header_values[8]
-    eth_header_values.smac3 = _header_values[9]
-    eth_header_values.smac4 = _header_values[10]
-    eth_header_values.smac5 = _header_values[11]
-    eth_header_values.ethertype0 = _header_values[12]
-    eth_header_values.ethertype1 = _header_values[13]
+    (eth_header_values.dmac0, eth_header_values.dmac1, eth_header_values.dmac2,
+     eth_header_values.dmac3, eth_header_values.dmac4, eth_header_values.dmac5,
+     eth_header_values.smac0, eth_header_values.smac1, eth_header_values.smac2,
+     eth_header_values.smac3, eth_header_values.smac4, eth_header_values.smac5,
+     eth_header_values.ethertype0, eth_header_values.ethertype1) = ETH_CODEC.unpack_from(payload, offset)
 
 def decode_ip(payload, ip_header_values):
-    ip_header = payload[14:34]
+    decode_ip_at(payload, 14, ip_header_values)
 
-    _header_values = unpack('!B B H H H B B H I I', ip_header)
+def decode_ip_at(payload, offset, ip_header_values):
+    _header_values = IP4_CODEC.unpack_from(payload, offset)
     ip_header_values.ip_ihl = _header_values[0] & 0x0F
     ip_header_values.ip_ver = _header_values[0] >> 4
-    ip_header_values.ip_tos = _header_values[1]
-    ip_header_values.ip_tot_len = _header_values[2]
-    ip_header_values.ip_id = _header_values[3]
-    ip_header_values.ip_frag_offset = _header_values[4]
-    ip_header_values.ip_ttl = _header_values[5]
-    ip_header_values.ip_proto = _header_values[6]
-    ip_header_values.ip_chksum = _header_values[7]
-    ip_header_values.ip_saddr = _header_values[8]
-    ip_header_values.ip_daddr = _header_values[9]
+    (ip_header_values.ip_tos, ip_header_values.ip_tot_len, ip_header_values.ip_id,
+     ip_header_values.ip_frag_offset, ip_header_values.ip_ttl, ip_header_values.ip_proto,
+     ip_header_values.ip_chksum, ip_header_values.ip_saddr, ip_header_values.ip_daddr) = _header_values[1:]
 
 def decode_udp(payload, udp_header_values):
-    udp_header = payload[34:42]
+    decode_udp_at(payload, 34, udp_header_values)
 
-    _header_values = unpack('!H H H H', udp_header)
-    udp_header_values.udp_sport = _header_values[0]
-    udp_header_values.udp_dport = _header_values[1]
-    udp_header_values.udp_len = _header_values[2]
-    udp_header_values.udp_sum = _header_values[3]
+def decode_udp_at(payload, offset, udp_header_values):
+    (udp_header_values.udp_sport, udp_header_values.udp_dport,
+     udp_header_values.udp_len, udp_header_values.udp_sum) = UDP_CODEC.unpack_from(payload, offset)
 
 def decode_tcp(payload, offset, tcp_header_values):
-    tcp_header = payload[(108+offset):(128+offset)]
-
-    _header_values = unpack('!H H I I B B H H H', tcp_header)
-    tcp_header_values.tcp_sport = _header_values[0]
-    tcp_header_values.tcp_dport = _header_values[1]
-    tcp_header_values.tcp_seq = _header_values[2]
-    tcp_header_values.tcp_ack = _header_values[3]
-    tcp_header_values.tcp_offset = _header_values[4]
-    tcp_header_values.tcp_flags = _header_values[5]
-    tcp_header_values.tcp_window = _header_values[6]
-    tcp_header_values.tcp_checksum = _header_values[7]
-    tcp_header_values.tcp_urgent = _header_values[8]
+    decode_tcp_at(payload, 108+offset, tcp_header_values)
 
-def decode_internal_ip(payload, offset, ip_header_values):
-    ip_header = payload[(88+offset):(108+offset)]
+def decode_tcp_at(payload, offset, tcp_header_values):
+    (tcp_header_values.tcp_sport, tcp_header_values.tcp_dport, tcp_header_values.tcp_seq,
+     tcp_header_values.tcp_ack, tcp_header_values.tcp_offset, tcp_header_values.tcp_flags,
+     tcp_header_values.tcp_window, tcp_header_values.tcp_checksum,
+     tcp_header_values.tcp_urgent) = TCP_CODEC.unpack_from(payload, offset)
 
-    _header_values = unpack('!B B H H H B B H I I', ip_header)
-    ip_header_values.ip_ihl = _header_values[0] & 0x0F
-    ip_header_values.ip_ver = _header_values[0] >> 4
-    ip_header_values.ip_tos = _header_values[1]
-    ip_header_values.ip_tot_len = _header_values[2]
-    ip_header_values.ip_id = _header_values[3]
-    ip_header_values.ip_frag_offset = _header_values[4]
-    ip_header_values.ip_ttl = _header_values[5]
-    ip_header_values.ip_proto = _header_values[6]
-    ip_header_values.ip_chksum = _header_values[7]
-    ip_header_values.ip_saddr = _header_values[8]
-    ip_header_values.ip_daddr = _header_values[9]
+def decode_internal_ip(payload, offset, ip_header_values):
+    decode_ip_at(payload, 88+offset, ip_header_values)
 
 def decode_vxlan(payload, vxlan_header_values):
     """Decode the VXLAN header for a received packets"""
-    vxlan_header = payload[42:50]
+    decode_vxlan_at(payload, 42, vxlan_header_values)
 
-    _header_values = unpack('!B H B I', vxlan_header)
-    vxlan_header_values.flags = _header_values[0]
-    vxlan_header_values.reserved = _header_values[1]
-    vxlan_header_values.next_protocol = _header_values[2]
+def decode_vxlan_at(payload, offset, vxlan_header_values):
+    (vxlan_header_values.flags, vxlan_header_values.reserved,
+     vxlan_header_values.next_protocol, vni_rsvd2) = VXLAN_CODEC.unpack_from(payload, offset)
 
-    vni_rsvd2 = _header_values[3]
     vxlan_header_values.vni = vni_rsvd2 >> 8
     vxlan_header_values.reserved2 = vni_rsvd2 & 0x000000FF
 
 def decode_nsh_baseheader(payload, offset, nsh_base_header_values):
     """Decode the NSH base headers for a received packets"""
-    base_header = payload[offset:(offset+8)]
-
-    _header_values = unpack('!H B B I', base_header)
-    start_idx = _header_values[0]
-    nsh_base_header_values.md_type = _header_values[1]
-    nsh_base_header_values.next_protocol = _header_values[2]
-    path_idx = _header_values[3]
+    (start_idx, nsh_base_header_values.md_type, nsh_base_header_values.next_protocol,
+     path_idx) = NSH_BASE_CODEC.unpack_from(payload, offset)
 
     nsh_base_header_values.version = start_idx >> 14
-    nsh_base_header_values.flags = start_idx >> 6
-    nsh_base_header_values.length = start_idx >> 0
+    nsh_base_header_values.flags = (start_idx >> 6) & 0xFF
+    nsh_base_header_values.length = start_idx & 0x3F
     nsh_base_header_values.service_path = path_idx >> 8
     nsh_base_header_values.service_index = path_idx & 0x000000FF
 
 def decode_nsh_contextheader(payload, offset, nsh_context_header_values):
     """Decode the NSH context headers for a received packet"""
-    context_header = payload[offset:(offset+16)]
+    (nsh_context_header_values.network_platform, nsh_context_header_values.network_shared,
+     nsh_context_header_values.service_platform,
+     nsh_context_header_values.service_shared) = NSH_CONTEXT_CODEC.unpack_from(payload, offset)
 
-    _header_values = unpack('!I I I I', context_header)
-    nsh_context_header_values.network_platform = _header_values[0]
-    nsh_context_header_values.network_shared = _header_values[1]
-    nsh_context_header_values.service_platform = _header_values[2]
-    nsh_context_header_values.service_shared = _header_values[3]
+class FrameOffsets(object):
+    """
+    Where the headers of a received frame start, as found by parse_frame()
+    in one walk over it. Headers the frame doesn't have read as None. path
+    is the NSH service path word (nsp << 8 | nsi), nsh_length the length of
+    the whole NSH header including its metadata, l4 the TCP/UDP header of
+    the inner packet. action is the FlowAction FirewallStage resolved for
+    the frame.
+    """
+    __slots__ = ('length', 'ip', 'udp', 'vxlan', 'inserted_eth', 'nsh', 'nsh_length',
+                 'md_type', 'next_protocol', 'path', 'inner_eth', 'inner_ip', 'inner_proto', 'l4', 'action')
+
+    def __getattr__(self, name):
+        if name in self.__slots__:
+            return None
+        raise AttributeError(name)
+
+FRAME_TRUNCATED = object()
+
+def parse_frame(buf, length, vxlan_udp_ports, vxlan_gpe_udp_ports, inner=True):
+    """
+    Walk the first length bytes of an Eth + NSH or Eth + IP + UDP + VxLAN
+    or VxLAN-gpe (+ inserted Eth) + NSH frame once, honoring the outer and
+    inner IP header lengths and the NSH length field, so MD type 2 headers
+    with their TLVs are skipped as a whole. Without inner the walk stops
+    after NSH. Returns the FrameOffsets, None if the frame is none of
+    these, FRAME_TRUNCATED if it is cut short or its lengths don't add up.
+    """
+    if (length < 38):
+        if (length < 14) or (U16_CODEC.unpack_from(buf, 12)[0] == 0x894f):
+            return FRAME_TRUNCATED
+        return None
+    """ The UDP port is read assuming an outer IP header without options """
+    ethertype, ver_ihl, proto, udp_dport = ETH_IP_UDP_PORT_CODEC.unpack_from(buf, 0)
+    if (ethertype == 0x894f):
+        offsets = FrameOffsets()
+        offsets.length = length
+        nsh = 14
+        ver_len = None
+    elif (ethertype == 0x0800):
+        if (proto != 17):
+            return None
+        udp = 14 + (ver_ihl & 0x0F) * 4
+        if (udp != 34):
+            if (udp < 34) or (length < udp + 4):
+                return FRAME_TRUNCATED
+            udp_dport = U16_CODEC.unpack_from(buf, udp + 2)[0]
+        if (udp_dport not in vxlan_udp_ports):
+            return None
+        if (length < udp + 16):
+            return FRAME_TRUNCATED
+        offsets = FrameOffsets()
+        offsets.length = length
+        offsets.ip = 14
+        offsets.udp = udp
+        offsets.vxlan = udp + 8
+        nsh = udp + 16
+        if (udp_dport not in vxlan_gpe_udp_ports):
+            """ VxLAN carries Ethernet """
+            offsets.inner_eth = nsh
+            return offsets
+        """ Skip inserted ethernet header before NSH, reading the NSH base header along with it """
+        ver_len = None
+        if (length >= nsh + 22):
+            ethertype, ver_len, md_type, next_protocol, path = ETH_NSH_BASE_CODEC.unpack_from(buf, nsh)
+            if (ethertype == 0x894f):
+                offsets.inserted_eth = nsh
+                nsh += 14
+            else:
+                ver_len = None
+        elif (length >= nsh + 14) and (U16_CODEC.unpack_from(buf, nsh + 12)[0] == 0x894f):
+            return FRAME_TRUNCATED
+    else:
+        return None
+
+    if (ver_len is None):
+        if (length < nsh + 8):
+            return FRAME_TRUNCATED
+        ver_len, md_type, next_protocol, path = NSH_BASE_CODEC.unpack_from(buf, nsh)
+    nsh_length = (ver_len & 0x3F) * 4
+    if (nsh_length < 8) or (length < nsh + nsh_length):
+        return FRAME_TRUNCATED
+    offsets.nsh = nsh
+    offsets.nsh_length = nsh_length
+    offsets.md_type = md_type & 0x0F
+    offsets.next_protocol = next_protocol
+    offsets.path = path
+    if not inner:
+        return offsets
+
+    inner_offset = nsh + nsh_length
+    if (next_protocol == NSH_NEXT_PROTO_ETH):
+        offsets.inner_eth = inner_offset
+        if (length < inner_offset + 34):
+            return offsets
+        ethertype, ver_ihl, proto = ETH_IP_PROTO_CODEC.unpack_from(buf, inner_offset)
+        if (ethertype != 0x0800):
+            return offsets
+        inner_offset += 14
+    elif (next_protocol == NSH_NEXT_PROTO_IPV4):
+        if (length < inner_offset + 20):
+            return offsets
+        ver_ihl, proto = IP_VER_PROTO_CODEC.unpack_from(buf, inner_offset)
+    else:
+        return offsets
+    offsets.inner_ip = inner_offset
+    offsets.inner_proto = proto
+    l4 = inner_offset + (ver_ihl & 0x0F) * 4
+    if (l4 <= length):
+        offsets.l4 = l4
+    return offsets
+
+def decode_nsh_tlvs(payload, offsets):
+    """
+    The (class, type, value) of the MD type 2 metadata TLVs of the NSH
+    header, values are padded to 4 bytes (RFC 8300)
+    """
+    tlvs = []
+    offset = offsets.nsh + 8
+    end = offsets.nsh + offsets.nsh_length
+    while (offset + 4 <= end):
+        md_class, md_type, md_length = NSH_TLV_CODEC.unpack_from(payload, offset)
+        md_length &= 0x7F
+        offset += 4
+        tlvs.append((md_class, md_type, bytes(payload[offset:min(offset + md_length, end)])))
+        offset += (md_length + 3) & ~3
+    return tlvs
+
+def frame_nsh_context_offset(offsets):
+    """ Only MD type 1 NSH headers carry the fixed context header """
+    if (offsets.md_type != NSH_MD_TYPE1) or (offsets.nsh_length < NSH_TYPE1_LEN * 4):
+        return None
+    return offsets.nsh + 8
+
+def frame_tcp_offset(offsets):
+    if (offsets.inner_proto != socket.IPPROTO_TCP) or (offsets.l4 is None) or (offsets.length < offsets.l4 + 20):
+        return None
+    return offsets.l4
+
+""" The header class, decoder and the offset in FrameOffsets of each PacketView header """
+PACKET_VIEW_HEADERS = {'eth': (ETHHEADER, decode_eth, lambda offsets: 0),
+                       'inserted_eth': (ETHHEADER, decode_eth, lambda offsets: offsets.inserted_eth),
+                       'ip': (IP4HEADER, decode_ip_at, lambda offsets: offsets.ip),
+                       'udp': (UDPHEADER, decode_udp_at, lambda offsets: offsets.udp),
+                       'vxlan': (VXLAN, decode_vxlan_at, lambda offsets: offsets.vxlan),
+                       'nsh_base': (BASEHEADER, decode_nsh_baseheader, lambda offsets: offsets.nsh),
+                       'nsh_context': (CONTEXTHEADER, decode_nsh_contextheader, frame_nsh_context_offset),
+                       'inner_eth': (ETHHEADER, decode_eth, lambda offsets: offsets.inner_eth),
+                       'inner_ip': (IP4HEADER, decode_ip_at, lambda offsets: offsets.inner_ip),
+                       'tcp': (TCPHEADER, decode_tcp_at, frame_tcp_offset)}
+
+class PacketView(object):
+    """
+    The headers of a frame parse_frame() returned offsets for, each one
+    decoded the first time it is read and kept for the rest of the frame's
+    processing, so a mode only pays for the headers it looks at. Headers
+    the frame doesn't have read as header objects with their defaults.
+    """
+    __slots__ = ('packet', 'offsets') + tuple(PACKET_VIEW_HEADERS)
+
+    def __init__(self, packet, offsets):
+        self.packet = packet
+        self.offsets = offsets
+
+    def __getattr__(self, name):
+        if name not in PACKET_VIEW_HEADERS:
+            raise AttributeError(name)
+        header_class, decode, header_offset = PACKET_VIEW_HEADERS[name]
+        header = header_class()
+        offset = header_offset(self.offsets)
+        if offset is not None:
+            decode(self.packet, offset, header)
+        setattr(self, name, header)
+        return header
 
 def compute_internet_checksum(data):
     """
     Function for Internet checksum calculation. Works
     for both IP and UDP.
 
+    The data is summed as an array of 16-bit words in host order, the one's
+    complement sum doesn't depend on byte order (RFC 1071) so the folded
+    sum only needs swapping back on little endian hosts.
     """
-    checksum = 0
-    n = len(data) % 2
-    # data padding
-    pad = bytearray('', encoding='UTF-8')
-    if n == 1:
-        pad = bytearray(b'\x00')
-    # for i in range(0, len(data + pad) - n, 2):
-    for i in range(0, len(data)-1, 2):
-        checksum += (ord(data[i]) << 8) + (ord(data[i + 1]))
-    if n == 1:
-        checksum += (ord(data[len(data)-1]) << 8) + (pad[0])
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    else:
+        data = bytes(data)
+    if len(data) % 2:
+        data += b'\x00'
+    checksum = sum(array('H', data))
     while checksum >> 16:
         checksum = (checksum & 0xFFFF) + (checksum >> 16)
+    if sys.byteorder == 'little':
+        checksum = ((checksum & 0xFF) << 8) | (checksum >> 8)
     checksum = ~checksum & 0xffff
     return checksum
 
+def update_internet_checksum(checksum, old, new):
+    """
+    Incremental Internet checksum update (RFC 1624, eqn. 3) after the
+    16-bit word old was replaced by new
+    """
+    checksum = (~checksum & 0xFFFF) + (~old & 0xFFFF) + new
+    checksum = (checksum & 0xFFFF) + (checksum >> 16)
+    checksum = (checksum & 0xFFFF) + (checksum >> 16)
+    return ~checksum & 0xFFFF
+
+def update_internet_checksum32(checksum, old, new):
+    """ Same as update_internet_checksum for a 32-bit field """
+    checksum = update_internet_checksum(checksum, old >> 16, new >> 16)
+    return update_internet_checksum(checksum, old & 0xFFFF, new & 0xFFFF)
+
+def add_internet_checksum(checksum, added):
+    """
+    Incremental Internet checksum update after zero words were replaced by
+    words summing up to added (RFC 1624, eqn. 3 with m = 0)
+    """
+    checksum = (~checksum & 0xFFFF) + added
+    while checksum >> 16:
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)
+    return ~checksum & 0xFFFF
+
 # Implements int.from_bytes(s, byteorder='big')
 def int_from_bytes(s):
-    return sum(ord(c) << (i * 8) for i, c in enumerate(s[::-1]))
+    return sum(c << (i * 8) for i, c in enumerate(bytearray(s)[::-1]))
 
 def build_ethernet_header_swap(myethheader):
     """ Build Ethernet header """
@@ -467,9 +646,12 @@ def build_ipv4_header(ip_tot_len, proto, src_ip, dest_ip, swap_ip):
 
     return ip_header, ip_header_pack
 
-def build_ipv4_header_reset(ip_tot_len, proto, src_ip, dest_ip, swap_ip):
+def build_ipv4_header_reset(ip_tot_len, proto, src_ip, dest_ip, swap_ip, orig_ip_header=None):
     """
-    Builds a complete IP header including checksum
+    Builds a complete IP header including checksum. When the header it
+    answers is given as orig_ip_header the checksum is derived from its
+    checksum by updating only the words that differ, the swapped addresses
+    don't change the sum.
     """
 
     if (swap_ip == True):
@@ -478,7 +660,15 @@ def build_ipv4_header_reset(ip_tot_len, proto, src_ip, dest_ip, swap_ip):
 
     ip_header = IP4HEADER(IP_HEADER_LEN, IPV4_VERSION, IPV4_TOS, ip_tot_len, IPV4_PACKET_ID, 0, IPV4_TTL, proto, 0, new_ip_saddr, new_ip_daddr)
 
-    checksum = compute_internet_checksum(ip_header.build())
+    if (orig_ip_header is not None) and (orig_ip_header.ip_ihl == IP_HEADER_LEN) and (orig_ip_header.ip_chksum != 0):
+        checksum = orig_ip_header.ip_chksum
+        checksum = update_internet_checksum(checksum, (((orig_ip_header.ip_ver << 4) | orig_ip_header.ip_ihl) << 8) | orig_ip_header.ip_tos, (IPV4_IHL_VER << 8) | IPV4_TOS)
+        checksum = update_internet_checksum(checksum, orig_ip_header.ip_tot_len, ip_tot_len)
+        checksum = update_internet_checksum(checksum, orig_ip_header.ip_id, IPV4_PACKET_ID)
+        checksum = update_internet_checksum(checksum, orig_ip_header.ip_frag_offset, 0)
+        checksum = update_internet_checksum(checksum, (orig_ip_header.ip_ttl << 8) | orig_ip_header.ip_proto, (IPV4_TTL << 8) | proto)
+    else:
+        checksum = compute_internet_checksum(ip_header.build())
     ip_header.set_ip_checksum(checksum)
     ip_header_pack = ip_header.build()
 
@@ -501,7 +691,7 @@ def build_tcp_reset(mytcpheader, ip_header):
     tcp_header.tcp_dport = source_port
     tcp_header.tcp_window = 0
     tcp_header.tcp_urgent = 0
-    ack = mytcpheader.tcp_seq + 1
+    ack = (mytcpheader.tcp_seq + 1) & 0xFFFFFFFF
     tcp_header.tcp_seq = 0
     tcp_header.tcp_ack = ack
     tcp_header.tcp_checksum = 0
@@ -564,6 +754,3333 @@ def build_udp_packet(src_ip, dest_ip, src_port, dest_port, data, swap_ip):
 
     return udp_packet
 
+FIREWALL_FORWARD = 'forward'
+FIREWALL_DROP = 'drop'
+FIREWALL_RST = 'rst'
+FIREWALL_ACTIONS = [FIREWALL_FORWARD, FIREWALL_DROP, FIREWALL_RST]
+IP_PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17}
+""" Rule buckets longer than this get a destination port interval index """
+FIREWALL_BUCKET_SCAN = 8
+
+class FirewallRule(object):
+    """
+    One firewall rule, written as
+
+        <forward|drop|rst> [proto tcp|udp|icmp|N] [src IP[/LEN]] [dst IP[/LEN]]
+                           [sport PORT[-PORT]] [dport PORT[-PORT]] [nsp N] [nsi N]
+                           [state new|established|invalid]
+
+    Fields that are left out match anything. Addresses and ports are those
+    of the inner packet, nsp/nsi those of the NSH header in front of it.
+    rst rules must match TCP, they answer with a TCP reset on the symmetric
+    path carried in the NSH context header (c3) and drop if there is none.
+    state rules must match TCP too, the state is the one Conntrack gives the
+    packet, e.g. 'forward proto tcp state established' followed by rules for
+    the new connections that are let through and 'drop proto tcp' only
+    lets the packets of connections those opened pass.
+    """
+    __slots__ = ('priority', 'action', 'src', 'src_mask', 'dst', 'dst_mask', 'proto',
+                 'sport_lo', 'sport_hi', 'dport_lo', 'dport_hi', 'nsp', 'nsi', 'state', 'text')
+
+    def __init__(self, text, priority=0):
+        words = text.split()
+        if (not words) or (words[0] not in FIREWALL_ACTIONS):
+            raise ValueError("rule must start with one of %s: '%s'" % (', '.join(FIREWALL_ACTIONS), text))
+        if (len(words) % 2) != 1:
+            raise ValueError("missing value in rule '%s'" % text)
+        self.priority = priority
+        self.action = words[0]
+        self.text = ' '.join(words)
+        self.src = self.src_mask = self.dst = self.dst_mask = 0
+        self.proto = self.nsp = self.nsi = self.state = None
+        self.sport_lo = self.dport_lo = 0
+        self.sport_hi = self.dport_hi = 0xFFFF
+        for field, value in zip(words[1::2], words[2::2]):
+            if (field == 'proto'):
+                self.proto = IP_PROTOCOLS.get(value)
+                if self.proto is None:
+                    self.proto = parse_number(value, 0xFF, text)
+            elif (field == 'src'):
+                self.src, self.src_mask = parse_prefix(value, text)
+            elif (field == 'dst'):
+                self.dst, self.dst_mask = parse_prefix(value, text)
+            elif (field == 'sport'):
+                self.sport_lo, self.sport_hi = parse_port_range(value, text)
+            elif (field == 'dport'):
+                self.dport_lo, self.dport_hi = parse_port_range(value, text)
+            elif (field == 'nsp'):
+                self.nsp = parse_number(value, 0xFFFFFF, text)
+            elif (field == 'nsi'):
+                self.nsi = parse_number(value, 0xFF, text)
+            elif (field == 'state'):
+                if value not in CONNTRACK_STATES:
+                    raise ValueError("state must be one of %s: '%s'" % (', '.join(CONNTRACK_STATES), text))
+                self.state = value
+            else:
+                raise ValueError("unknown field '%s' in rule '%s'" % (field, text))
+        if (self.action == FIREWALL_RST) and (self.proto != socket.IPPROTO_TCP):
+            raise ValueError("rst rules must match proto tcp: '%s'" % text)
+        if (self.state is not None) and (self.proto != socket.IPPROTO_TCP):
+            raise ValueError("state rules must match proto tcp: '%s'" % text)
+
+    def __str__(self):
+        return self.text
+
+    def shape(self):
+        """ The fields this rule hashes on, rules of the same shape share a table """
+        return (self.src_mask, self.dst_mask, self.proto is not None,
+                self.sport_lo == self.sport_hi, self.dport_lo == self.dport_hi,
+                self.nsp is not None, self.nsi is not None, self.state is not None)
+
+    def key(self):
+        return (self.src, self.dst, self.proto,
+                self.sport_lo if self.sport_lo == self.sport_hi else None,
+                self.dport_lo if self.dport_lo == self.dport_hi else None,
+                self.nsp, self.nsi, self.state)
+
+def parse_number(value, maximum, text):
+    try:
+        number = int(value, 0)
+    except ValueError:
+        number = -1
+    if not (0 <= number <= maximum):
+        raise ValueError("bad value '%s' in rule '%s'" % (value, text))
+    return number
+
+def parse_prefix(value, text):
+    """ Return the (network, mask) integers of an IP or IP/LEN """
+    address, _, length = value.partition('/')
+    try:
+        network = int_from_bytes(socket.inet_aton(address))
+    except socket.error:
+        raise ValueError("bad address '%s' in rule '%s'" % (value, text))
+    mask = 0xFFFFFFFF
+    if length:
+        mask = (0xFFFFFFFF << (32 - parse_number(length, 32, text))) & 0xFFFFFFFF
+    return network & mask, mask
+
+def parse_port_range(value, text):
+    lo, _, hi = value.partition('-')
+    lo = parse_number(lo, 0xFFFF, text)
+    hi = parse_number(hi, 0xFFFF, text) if hi else lo
+    if (hi < lo):
+        raise ValueError("empty port range '%s' in rule '%s'" % (value, text))
+    return lo, hi
+
+def load_firewall_rules(path):
+    """ Read the rules of a rules file, one per line, # starts a comment """
+    with open(path) as f:
+        lines = [line.split('#', 1)[0].strip() for line in f]
+    return [line for line in lines if line]
+
+class RuleBucket(object):
+    """
+    The rules of one hash table entry, in priority order. Short buckets are
+    scanned, long ones are split on the destination port boundaries of their
+    rules so that only the rules covering the port are looked at.
+    """
+    __slots__ = ('rules', 'bounds', 'segments')
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.bounds = None
+        self.segments = None
+        if (len(rules) > FIREWALL_BUCKET_SCAN):
+            self.build_index()
+
+    def build_index(self):
+        starts = {}
+        ends = {}
+        for rule in self.rules:
+            starts.setdefault(rule.dport_lo, []).append(rule)
+            ends.setdefault(rule.dport_hi + 1, []).append(rule)
+        self.bounds = sorted(set([0]) | set(starts) | (set(ends) - set([0x10000])))
+        self.segments = []
+        active = set()
+        for bound in self.bounds:
+            active.difference_update(ends.get(bound, ()))
+            active.update(starts.get(bound, ()))
+            self.segments.append(sorted(active, key=lambda rule: rule.priority))
+
+    def match(self, sport, dport):
+        rules = self.rules
+        if self.bounds is not None:
+            rules = self.segments[bisect_right(self.bounds, dport) - 1]
+        for rule in rules:
+            if ((rule.sport_lo <= sport <= rule.sport_hi) and (rule.dport_lo <= dport <= rule.dport_hi)):
+                return rule
+        return None
+
+class RuleTable(object):
+    """ The rules of one shape, hashed on the masked fields of that shape """
+    __slots__ = ('priority', 'src_mask', 'dst_mask', 'proto', 'sport', 'dport', 'nsp', 'nsi', 'state', 'buckets')
+
+    def __init__(self, shape, rules):
+        self.src_mask, self.dst_mask, self.proto, self.sport, self.dport, self.nsp, self.nsi, self.state = shape
+        self.priority = min(rule.priority for rule in rules)
+        buckets = {}
+        for rule in rules:
+            buckets.setdefault(rule.key(), []).append(rule)
+        self.buckets = dict((key, RuleBucket(sorted(bucket, key=lambda rule: rule.priority)))
+                            for key, bucket in buckets.items())
+
+    def lookup(self, saddr, daddr, proto, sport, dport, nsp, nsi, state=None):
+        bucket = self.buckets.get((saddr & self.src_mask, daddr & self.dst_mask,
+                                   proto if self.proto else None,
+                                   sport if self.sport else None,
+                                   dport if self.dport else None,
+                                   nsp if self.nsp else None,
+                                   nsi if self.nsi else None,
+                                   state if self.state else None))
+        if bucket is None:
+            return None
+        return bucket.match(sport, dport)
+
+FLOW_MISS = object()
+
+class FlowCache(object):
+    """
+    Bounded flow -> value map with CLOCK eviction, an approximation of LRU
+    that doesn't reorder anything on a hit: a hit only sets the referenced
+    bit of the entry. When the cache is full the clock hand sweeps over the
+    slots clearing referenced bits and evicts the first entry that wasn't
+    used since the hand last passed it. Entries idle for more than timeout
+    seconds are dropped when looked up or reached by the hand.
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.clear()
+
+    def clear(self):
+        """ Forget all entries, e.g. when the rules they were derived from change """
+        self.entries = {}
+        self.slots = []
+        self.free = []
+        self.hand = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key, now):
+        """ The value stored for key, FLOW_MISS if there is none """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return FLOW_MISS
+        if (now - entry[1] > self.timeout):
+            del self.entries[key]
+            self.slots[entry[3]] = None
+            self.free.append(entry[3])
+            self.expired += 1
+            self.misses += 1
+            return FLOW_MISS
+        entry[1] = now
+        entry[2] = True
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, now):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[0] = value
+            entry[1] = now
+            entry[2] = True
+            return
+        if self.free:
+            slot = self.free.pop()
+        elif (len(self.slots) < self.size):
+            slot = len(self.slots)
+            self.slots.append(None)
+        else:
+            slot = self.evict(now)
+        self.slots[slot] = key
+        self.entries[key] = [value, now, False, slot]
+
+    def evict(self, now):
+        """ Free the slot of an expired or unreferenced entry, all slots are in use """
+        slots = self.slots
+        entries = self.entries
+        while True:
+            slot = self.hand
+            self.hand = (slot + 1) % self.size
+            entry = entries[slots[slot]]
+            if (now - entry[1] > self.timeout):
+                self.expired += 1
+            elif entry[2]:
+                entry[2] = False
+                continue
+            else:
+                self.evictions += 1
+            del entries[slots[slot]]
+            return slot
+
+    def counters(self):
+        return {'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expired': self.expired}
+
+""" TCP connection states of the conntrack table """
+CT_SYN_SENT = 0
+CT_SYN_RECV = 1
+CT_ESTABLISHED = 2
+CT_FIN_WAIT = 3
+CT_CLOSED = 4
+""" Seconds a connection without packets is kept in each state, the established one is --conntrack-timeout """
+CONNTRACK_TIMEOUTS = [30, 30, 3600, 60, 10]
+""" The states firewall rules match on, those of netfilter's ctstate """
+CONNTRACK_NEW = 'new'
+CONNTRACK_ESTABLISHED = 'established'
+CONNTRACK_INVALID = 'invalid'
+CONNTRACK_STATES = [CONNTRACK_NEW, CONNTRACK_ESTABLISHED, CONNTRACK_INVALID]
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+""" Slots per level of the timer wheel as powers of 2, it turns once a second and reaches 2^26 s ahead """
+TIMER_WHEEL_BITS = [8, 6, 6, 6]
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel. Level 0 has a slot for each of the next 256
+    ticks, a slot of each level above spans all the slots of the level below
+    it. Timers go into the lowest level that reaches their expiry tick, and
+    whenever the slots of a level wrap around the next slot of the level
+    above is emptied into the levels below. A tick thus only looks at the
+    timers of the slots it reaches, the timers that are due or moved down,
+    never at all of them. Timers are objects with an expires tick and a slot
+    attribute, cancelling one is a set removal. Pushing the expiry of a timer
+    back doesn't move it, it is put back in when its old slot comes up.
+    """
+    def __init__(self, now):
+        self.now = now
+        self.levels = [[set() for index in range(1 << bits)] for bits in TIMER_WHEEL_BITS]
+        """ (shift, mask, reach) of each level, timers less than reach ticks ahead go into it """
+        self.spans = []
+        shift = 0
+        for bits in TIMER_WHEEL_BITS:
+            self.spans.append((shift, (1 << bits) - 1, 1 << (shift + bits)))
+            shift += bits
+
+    def schedule(self, timer):
+        """ Put timer into the slot of its expires tick, those already due go into the next one """
+        expires = max(timer.expires, self.now + 1)
+        delta = expires - self.now
+        for slots, (shift, mask, reach) in zip(self.levels, self.spans):
+            if (delta < reach):
+                break
+        else:
+            """ Further out than the wheel reaches, the timer is put back in when its slot comes up """
+            expires = self.now + reach - 1
+        timer.slot = slots[(expires >> shift) & mask]
+        timer.slot.add(timer)
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+
+    def update(self, timer, expires):
+        """ Set the expires tick of the scheduled timer, only an earlier one moves it """
+        if (expires < timer.expires):
+            self.cancel(timer)
+            timer.expires = expires
+            self.schedule(timer)
+        else:
+            timer.expires = expires
+
+    def take(self, slots, index):
+        """ Empty the slot index of the level slots, returning its timers """
+        timers = slots[index]
+        if timers:
+            slots[index] = set()
+            for timer in timers:
+                timer.slot = None
+        return timers
+
+    def advance(self, now):
+        """ Turn the wheel up to the tick now, returning the timers that expired """
+        expired = []
+        levels = self.levels
+        spans = self.spans
+        while (self.now < now):
+            self.now += 1
+            tick = self.now
+            for level in range(1, len(levels)):
+                shift, mask, reach = spans[level]
+                if (tick & ((1 << shift) - 1)):
+                    break
+                for timer in self.take(levels[level], (tick >> shift) & mask):
+                    self.schedule(timer)
+            for timer in self.take(levels[0], tick & spans[0][1]):
+                if (timer.expires > tick):
+                    self.schedule(timer)
+                else:
+                    expired.append(timer)
+        return expired
+
+class Connection(object):
+    """ An entry of the Conntrack table, low tells which end opened the connection """
+    __slots__ = ('key', 'low', 'state', 'replied', 'fins', 'reset', 'expires', 'slot')
+
+class Conntrack(object):
+    """
+    The TCP connections of the inner packets, at most size of them. A
+    connection is keyed by its two (address, port) ends, the lower one
+    first, so both directions of it find the same entry. Only a SYN opens
+    one, other packets of connections the table doesn't hold are invalid.
+    A connection is new until the other end answered and established from
+    then on, as netfilter's ctstate, and is dropped from the table after
+    being idle for the timeout of its TCP state. Idle connections are found
+    with a TimerWheel: the clock is read anyway for every packet, each
+    second that passed turns the wheel, which hands over the connections
+    that expired. A SYN flood can't push out established connections: once
+    the table is full the oldest connection that wasn't answered or whose
+    handshake didn't finish gives way to the new one, when there is none
+    the SYN is not tracked and invalid. With several workers each keeps its
+    own table, both directions of a connection must reach the same worker.
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeouts = list(CONNTRACK_TIMEOUTS)
+        self.timeouts[CT_ESTABLISHED] = int(timeout)
+        self.entries = {}
+        self.wheel = TimerWheel(int(time.time()))
+        """ Connections in the order they were opened, those established by now are skipped lazily """
+        self.embryonic = deque()
+        self.created = 0
+        self.expired = 0
+        self.early_drops = 0
+        self.full = 0
+        self.invalid = 0
+
+    def track(self, buf, offsets, flow, now):
+        """
+        Update the connection of the TCP packet parse_frame() returned offsets
+        for, flow its decode_flow() tuple. Returns the Connection and state of
+        the packet, (None, None) for packets that aren't TCP and None for the
+        Connection of invalid ones that have none.
+        """
+        saddr, daddr, proto, sport, dport = flow[:5]
+        if (proto != socket.IPPROTO_TCP) or (offsets.l4 is None) or (offsets.length < offsets.l4 + 14):
+            return None, None
+        flags = U8_CODEC.unpack_from(buf, offsets.l4 + 13)[0]
+        tick = int(now)
+        if (tick > self.wheel.now):
+            if not self.entries:
+                """ Nothing to expire, the wheel is empty """
+                self.wheel.now = tick
+            for entry in self.wheel.advance(tick):
+                del self.entries[entry.key]
+                self.expired += 1
+
+        source = (saddr << 16) | sport
+        destination = (daddr << 16) | dport
+        low = (source < destination)
+        if low:
+            key = (source << 48) | destination
+        else:
+            key = (destination << 48) | source
+        entry = self.entries.get(key)
+        if entry is None:
+            if ((flags & (TCP_SYN | TCP_ACK | TCP_RST | TCP_FIN)) != TCP_SYN):
+                self.invalid += 1
+                return None, CONNTRACK_INVALID
+            entry = self.open(key, low, tick)
+            if entry is None:
+                self.invalid += 1
+                return None, CONNTRACK_INVALID
+            return entry, CONNTRACK_NEW
+
+        origin = (low == entry.low)
+        state = entry.state
+        if (flags & TCP_RST):
+            state = CT_CLOSED
+        elif (state == CT_SYN_SENT):
+            if not origin:
+                if ((flags & (TCP_SYN | TCP_ACK)) != (TCP_SYN | TCP_ACK)):
+                    self.invalid += 1
+                    return entry, CONNTRACK_INVALID
+                state = CT_SYN_RECV
+                entry.replied = True
+        elif (state == CT_SYN_RECV):
+            if origin and (flags & TCP_ACK):
+                state = CT_ESTABLISHED
+        elif (state == CT_CLOSED):
+            """ A new connection between the same ends, unless we reset the old one """
+            if origin and (not entry.reset) and ((flags & (TCP_SYN | TCP_ACK)) == TCP_SYN):
+                state = CT_SYN_SENT
+                entry.replied = False
+                entry.fins = 0
+                self.embryonic.append(entry)
+        elif (flags & TCP_FIN):
+            entry.fins |= 1 if origin else 2
+            state = CT_CLOSED if (entry.fins == 3) else CT_FIN_WAIT
+        entry.state = state
+        self.wheel.update(entry, tick + self.timeouts[state])
+        if entry.replied:
+            return entry, CONNTRACK_ESTABLISHED
+        return entry, CONNTRACK_NEW
+
+    def open(self, key, low, tick):
+        """ The Connection for a SYN, None if the table is full of established ones """
+        if (len(self.entries) >= self.size) and (not self.early_drop()):
+            self.full += 1
+            return None
+        entry = Connection()
+        entry.key = key
+        entry.low = low
+        entry.state = CT_SYN_SENT
+        entry.replied = False
+        entry.fins = 0
+        entry.reset = False
+        entry.expires = tick + self.timeouts[CT_SYN_SENT]
+        entry.slot = None
+        self.entries[key] = entry
+        self.wheel.schedule(entry)
+        self.embryonic.append(entry)
+        if (len(self.embryonic) > 2 * self.size):
+            """ Bounded by the table, copying the live ones costs O(1) per connection opened since the last time """
+            self.embryonic = deque(entry for entry in self.embryonic if (entry.slot is not None) and (entry.state < CT_ESTABLISHED))
+        self.created += 1
+        return entry
+
+    def early_drop(self):
+        """ Drop the oldest connection that isn't established, False if there is none """
+        embryonic = self.embryonic
+        while embryonic:
+            entry = embryonic.popleft()
+            if (entry.slot is not None) and (entry.state < CT_ESTABLISHED):
+                self.wheel.cancel(entry)
+                del self.entries[entry.key]
+                self.early_drops += 1
+                return True
+        return False
+
+    def reset(self, entry):
+        """
+        Close the connection of entry for a reset being sent, True the first
+        time only: the connection keeps absorbing its packets, SYNs included,
+        until it expires, so that a flow gets one reset and not one per packet
+        """
+        if entry.reset:
+            return False
+        entry.reset = True
+        entry.state = CT_CLOSED
+        self.wheel.update(entry, self.wheel.now + self.timeouts[CT_CLOSED])
+        return True
+
+    def counters(self):
+        return {'entries': len(self.entries),
+                'created': self.created,
+                'expired': self.expired,
+                'early_drops': self.early_drops,
+                'full': self.full,
+                'invalid': self.invalid}
+
+class FlowAction(object):
+    """
+    What becomes of the frames of a flow, resolved once from the rule taking
+    them, None if none does, and the (word, value) context header rewrites
+    of their path, None if there are none. This is what the FlowCache of a
+    Firewall holds, a hit needs nothing but its attributes.
+    """
+    __slots__ = ('rule', 'forward', 'reset', 'context')
+
+    def __init__(self, rule=None, context=None):
+        self.rule = rule
+        self.forward = (rule is None) or (rule.action == FIREWALL_FORWARD)
+        self.reset = (rule is not None) and (rule.action == FIREWALL_RST)
+        self.context = context if self.forward else None
+
+""" The action of the frames no rule takes """
+FLOW_FORWARD = FlowAction()
+""" What rst rules give for the packets of a connection they already reset """
+CONNTRACK_RESET_SENT = FlowAction(FirewallRule("%s proto tcp" % FIREWALL_DROP))
+
+class Firewall(object):
+    """
+    An ordered rule set, the first matching rule wins and packets no rule
+    matches are forwarded. Rules are grouped by the fields they match on
+    and each group is a hash table on those fields (tuple space search),
+    so a lookup costs one hash probe per group no matter how many rules
+    there are. The groups are probed in the order of their best rule and
+    the probing stops once no later group can hold a better match. The
+    FlowAction of each rule is built up front, default is that of the
+    packets no rule matches. With a FlowCache the action of a flow is only
+    looked up for its first packet. With a Conntrack TCP packets are
+    tracked before the lookup, which then also matches their state, and an
+    rst rule resets a connection once.
+    """
+    def __init__(self, rules, flows=None, conntrack=None, default=FLOW_FORWARD):
+        self.flows = flows
+        self.conntrack = conntrack
+        self.default = default
+        self.rules = [FirewallRule(text, priority) for priority, text in enumerate(rules)]
+        self.actions = [FlowAction(rule, default.context) for rule in self.rules]
+        for rule in self.rules:
+            if (rule.state is not None) and (conntrack is None):
+                raise ValueError("state rules need --conntrack: '%s'" % rule)
+        shapes = {}
+        for rule in self.rules:
+            shapes.setdefault(rule.shape(), []).append(rule)
+        self.tables = sorted((RuleTable(shape, rules) for shape, rules in shapes.items()),
+                             key=lambda table: table.priority)
+
+    """ Only a DispatchTable rewrites context headers or can do without the inner headers """
+    rewrites = False
+    inner = True
+
+    def has_action(self, action):
+        return any(rule.action == action for rule in self.rules)
+
+    def match_frame(self, buf, offsets):
+        """ The FlowAction of the first rule matching the NSH frame with offsets """
+        flow = decode_flow(buf, offsets)
+        if flow is None:
+            return self.default
+        conntrack = self.conntrack
+        if conntrack is None:
+            return self.match(flow)
+        entry, state = conntrack.track(buf, offsets, flow, time.time())
+        action = self.match(flow + (state,))
+        if action.reset and (entry is not None) and (not conntrack.reset(entry)):
+            return CONNTRACK_RESET_SENT
+        return action
+
+    def match(self, flow):
+        """
+        The FlowAction of the lookup() of flow through the flow cache, flow
+        is a decode_flow() tuple, with the Conntrack state if tracked
+        """
+        flows = self.flows
+        if flows is None:
+            return self.resolve(self.lookup(*flow))
+        now = time.time()
+        action = flows.get(flow, now)
+        if action is FLOW_MISS:
+            action = self.resolve(self.lookup(*flow))
+            flows.put(flow, action, now)
+        return action
+
+    def resolve(self, rule):
+        if rule is None:
+            return self.default
+        return self.actions[rule.priority]
+
+    def lookup(self, saddr, daddr, proto, sport, dport, nsp, nsi, state=None):
+        """ Return the first rule matching the flow, None if none does """
+        best = None
+        for table in self.tables:
+            if (best is not None) and (best.priority < table.priority):
+                break
+            rule = table.lookup(saddr, daddr, proto, sport, dport, nsp, nsi, state)
+            if (rule is not None) and ((best is None) or (rule.priority < best.priority)):
+                best = rule
+        return best
+
+def decode_flow(buf, offsets):
+    """
+    Return the (saddr, daddr, proto, sport, dport, nsp, nsi) the firewall
+    matches on for the NSH frame parse_frame() returned offsets for, None
+    if no IPv4 packet follows the NSH header. The ports are 0 for protocols
+    other than TCP and UDP.
+    """
+    if (offsets.inner_ip is None):
+        return None
+    proto, saddr, daddr = FLOW_IP_CODEC.unpack_from(buf, offsets.inner_ip)
+    sport = dport = 0
+    if ((proto == 6) or (proto == 17)) and (offsets.l4 is not None) and (offsets.length >= offsets.l4 + 4):
+        sport, dport = PORT_PAIR_CODEC.unpack_from(buf, offsets.l4)
+    return saddr, daddr, proto, sport, dport, offsets.path >> 8, offsets.path & 0xFF
+
+def firewall_match(firewall, buf, offsets):
+    """
+    The FlowAction of the NSH frame with offsets, FLOW_FORWARD without a
+    firewall. firewall is a Firewall or a DispatchTable.
+    """
+    if firewall is None:
+        return FLOW_FORWARD
+    return firewall.match_frame(buf, offsets)
+
+DISPATCH_FORWARD = 'forward'
+DISPATCH_DROP = 'drop'
+DISPATCH_COUNT = 'count'
+DISPATCH_BLOCK = 'block'
+DISPATCH_RST = 'rst'
+DISPATCH_SET = 'set'
+""" The number of values each dispatch action takes """
+DISPATCH_ACTIONS = {DISPATCH_FORWARD: 0, DISPATCH_DROP: 0, DISPATCH_COUNT: 0,
+                    DISPATCH_BLOCK: 1, DISPATCH_RST: 1, DISPATCH_SET: 2}
+NSH_CONTEXT_WORDS = {'c1': 0, 'c2': 1, 'c3': 2, 'c4': 3}
+
+class ServicePath(object):
+    """
+    The action pipeline of one (nsp, nsi) of a DispatchTable, written as
+
+        <nsp> <nsi> <action>[, <action> ...]
+
+    with the actions
+
+        count                   count the packets and bytes of the path
+        block PORT[-PORT]       drop TCP to these destination ports
+        rst PORT[-PORT]         answer TCP to these ports with a reset, as an rst rule does
+        set c1|c2|c3|c4 VALUE   rewrite an MD type 1 context header of the forwarded packets
+        forward|drop            what happens to the packets no block or rst took, the last action
+
+    The block and rst actions are firewall rules checked in their order,
+    without forward or drop the packets they don't take are forwarded.
+    """
+    __slots__ = ('nsp', 'nsi', 'firewall', 'action', 'context', 'count', 'packets', 'bytes', 'text')
+
+    def __init__(self, text, flows=None, conntrack=None):
+        words = text.split(None, 2)
+        if (len(words) < 3):
+            raise ValueError("dispatch entry must be '<nsp> <nsi> <action>[, <action> ...]': '%s'" % text)
+        self.nsp = parse_number(words[0], 0xFFFFFF, text)
+        self.nsi = parse_number(words[1], 0xFF, text)
+        self.text = text
+        verdict = None
+        self.context = None
+        self.count = False
+        self.packets = self.bytes = 0
+        rules = []
+        actions = [action.split() for action in words[2].split(',')]
+        for position, action in enumerate(actions):
+            if (not action) or (action[0] not in DISPATCH_ACTIONS):
+                raise ValueError("actions must be one of %s: '%s'" % (', '.join(sorted(DISPATCH_ACTIONS)), text))
+            if (len(action) != DISPATCH_ACTIONS[action[0]] + 1):
+                raise ValueError("wrong number of values for %s in '%s'" % (action[0], text))
+            if (action[0] in (DISPATCH_FORWARD, DISPATCH_DROP)):
+                if (position != len(actions) - 1):
+                    raise ValueError("%s must be the last action: '%s'" % (action[0], text))
+                if (action[0] == DISPATCH_DROP):
+                    verdict = FirewallRule("%s nsp %d nsi %d" % (FIREWALL_DROP, self.nsp, self.nsi))
+            elif (action[0] == DISPATCH_COUNT):
+                self.count = True
+            elif (action[0] == DISPATCH_BLOCK):
+                rules.append("%s proto tcp dport %s nsp %d nsi %d" % (FIREWALL_DROP, action[1], self.nsp, self.nsi))
+            elif (action[0] == DISPATCH_RST):
+                rules.append("%s proto tcp dport %s nsp %d nsi %d" % (FIREWALL_RST, action[1], self.nsp, self.nsi))
+            else:
+                if action[1] not in NSH_CONTEXT_WORDS:
+                    raise ValueError("set takes one of %s: '%s'" % (', '.join(sorted(NSH_CONTEXT_WORDS)), text))
+                if self.context is None:
+                    self.context = []
+                self.context.append((NSH_CONTEXT_WORDS[action[1]], parse_number(action[2], 0xFFFFFFFF, text)))
+        """ What the frames no block or rst takes get """
+        self.action = FlowAction(verdict, self.context)
+        self.firewall = None
+        if rules:
+            self.firewall = Firewall(rules, flows, conntrack, self.action)
+
+    def __str__(self):
+        return self.text
+
+    def match_frame(self, buf, offsets):
+        """ Count the NSH frame with offsets, returning its FlowAction """
+        if self.count:
+            self.packets += 1
+            self.bytes += offsets.length
+        if self.firewall is not None:
+            return self.firewall.match_frame(buf, offsets)
+        return self.action
+
+class DispatchTable(object):
+    """
+    Lets one process serve many service chains: every (nsp, nsi) the SF is
+    on gets its own ServicePath, found with a single dict lookup on the NSH
+    path word (nsp << 8 | nsi) of the frame. Frames of paths the table
+    doesn't list are handed to the fallback Firewall, and forwarded without
+    one. It stands in for the Firewall of the forward loops.
+    """
+    def __init__(self, entries, fallback=None, flows=None, conntrack=None):
+        self.fallback = fallback
+        self.flows = flows
+        self.conntrack = conntrack
+        self.paths = {}
+        for text in entries:
+            path = ServicePath(text, flows, conntrack)
+            key = (path.nsp << 8) | path.nsi
+            if key in self.paths:
+                raise ValueError("nsp %d nsi %d is dispatched twice: '%s'" % (path.nsp, path.nsi, text))
+            self.paths[key] = path
+        self.rewrites = any(path.context is not None for path in self.paths.values())
+        """ Only the block and rst actions look past NSH """
+        self.inner = ((fallback is not None) or any(path.firewall is not None for path in self.paths.values()))
+
+    def has_action(self, action):
+        firewalls = [path.firewall for path in self.paths.values()] + [self.fallback]
+        return any(firewall.has_action(action) for firewall in firewalls if firewall is not None)
+
+    def match_frame(self, buf, offsets):
+        """ The FlowAction of the NSH frame with offsets """
+        path = self.paths.get(offsets.path)
+        if path is None:
+            return firewall_match(self.fallback, buf, offsets)
+        return path.match_frame(buf, offsets)
+
+    def counters(self):
+        """ The packets and bytes of the paths with a count action, keyed by 'nsp/nsi' """
+        return dict(("%d/%d" % (path.nsp, path.nsi), [path.packets, path.bytes])
+                    for path in self.paths.values() if path.count)
+
+def rewrite_context(buf, offset, context, udp_sum_offset=None):
+    """
+    Write the (word, value) pairs of context into the MD type 1 context
+    header at offset of the writable buf, updating the UDP checksum at
+    udp_sum_offset, if there is one, for the words that changed
+    """
+    udp_sum = 0
+    if udp_sum_offset is not None:
+        udp_sum = U16_CODEC.unpack_from(buf, udp_sum_offset)[0]
+    """ A zero UDP checksum means there is none """
+    checksummed = (udp_sum != 0)
+    for word, value in context:
+        old = U32_CODEC.unpack_from(buf, offset + 4 * word)[0]
+        U32_CODEC.pack_into(buf, offset + 4 * word, value)
+        if checksummed:
+            udp_sum = update_internet_checksum32(udp_sum, old, value)
+    if checksummed:
+        U16_CODEC.pack_into(buf, udp_sum_offset, udp_sum or 0xFFFF)
+
+RESET_TEMPLATES = 4096
+
+class TcpResetTemplate(object):
+    __slots__ = ('buf', 'tcp_offset', 'tcp_sum', 'udp_sum')
+
+class TcpResetTemplates(object):
+    """
+    Builds the TCP resets rst rules send back on the symmetric path. The
+    reply to a host pair on a path is the same for every connection but for
+    the ports and the ack, so the whole reply frame is built once into a
+    template, with zero ports and ack and the checksums of that. A reset is
+    then the template with those three fields patched in and the TCP and
+    outer UDP checksums updated for them, no headers are rebuilt.
+    """
+    def __init__(self, templates):
+        self.templates = templates
+
+    def reply(self, packet, offsets, reverse_nsp, swap_ip):
+        """
+        The reset answering the VxLAN-gpe + NSH + TCP packet parse_frame()
+        returned offsets for, None if it doesn't carry TCP. The returned
+        buffer is reused by the next reply for the same template.
+        """
+        ip_offset = offsets.inner_ip
+        tcp_offset = offsets.l4
+        if (offsets.vxlan is None) or (offsets.inner_proto != socket.IPPROTO_TCP) or (tcp_offset is None) or (offsets.length < tcp_offset + 8):
+            return None
+        saddr, daddr = U32_PAIR_CODEC.unpack_from(packet, ip_offset + 12)
+
+        udp_offset = offsets.udp
+        key = (packet[0:12], packet[offsets.ip + 12:offsets.ip + 20], packet[udp_offset:udp_offset + 4],
+               packet[offsets.vxlan:ip_offset], saddr, daddr)
+        now = time.time()
+        template = self.templates.get(key, now)
+        if template is FLOW_MISS:
+            template = self.build(packet, offsets, saddr, daddr, reverse_nsp, swap_ip)
+            self.templates.put(key, template, now)
+
+        sport, dport, seq = TCP_PORTS_SEQ_CODEC.unpack_from(packet, tcp_offset)
+        ack = (seq + 1) & 0xFFFFFFFF
+        added = sport + dport + (ack >> 16) + (ack & 0xFFFF)
+        tcp_sum = add_internet_checksum(template.tcp_sum, added)
+        udp_sum = add_internet_checksum(template.udp_sum, added + tcp_sum + (~template.tcp_sum & 0xFFFF))
+        TCP_CODEC.pack_into(template.buf, template.tcp_offset, dport, sport, 0, ack, 80, 20, 0, tcp_sum, 0)
+        U16_CODEC.pack_into(template.buf, 40, udp_sum or 0xFFFF)
+        return template.buf
+
+    def build(self, packet, offsets, saddr, daddr, reverse_nsp, swap_ip):
+        """
+        Reply frame with swapped MACs and outer IPs, the reverse nsp and nsi
+        minus one in NSH, and an inner IP + TCP RST with zero ports and ack.
+        The reply's outer IP header has no options, the headers from VxLAN
+        on are moved up by the length of the options of the packet's.
+        """
+        shift = offsets.vxlan - 42
+        ip_offset = offsets.inner_ip - shift
+        nsh_offset = offsets.nsh - shift
+        template = TcpResetTemplate()
+        template.tcp_offset = ip_offset + 20
+        buf = bytearray(template.tcp_offset + 20)
+        buf[0:14] = packet[6:12] + packet[0:6] + packet[12:14]
+        buf[42:ip_offset] = packet[offsets.vxlan:offsets.inner_ip]
+        U32_CODEC.pack_into(buf, nsh_offset + 4, ((reverse_nsp & 0xFFFFFF) << 8) | ((offsets.path - 1) & 0xFF))
+        if (offsets.inner_eth is not None):
+            inner_eth = offsets.inner_eth
+            buf[inner_eth - shift:inner_eth - shift + 12] = packet[inner_eth + 6:inner_eth + 12] + packet[inner_eth:inner_eth + 6]
+
+        ip_header, ip_header_pack = build_ipv4_header_reset(40, socket.IPPROTO_TCP, saddr, daddr, True)
+        buf[ip_offset:template.tcp_offset] = ip_header_pack
+        """ A seq of 0xFFFFFFFF gives a zero ack """
+        tcp_header, tcp_header_pack = build_tcp_reset(TCPHEADER(0, 0, 0xFFFFFFFF), ip_header)
+        buf[template.tcp_offset:] = tcp_header_pack
+        template.tcp_sum = tcp_header.tcp_checksum
+
+        outer_ip_saddr, outer_ip_daddr = IP4_ADDR_PAIR_CODEC.unpack_from(packet, offsets.ip + 12)
+        outer_ip_header, outer_ip_header_pack = build_ipv4_header(len(buf) - 14, socket.IPPROTO_UDP, socket.inet_ntoa(outer_ip_saddr), socket.inet_ntoa(outer_ip_daddr), swap_ip)
+        buf[14:34] = outer_ip_header_pack
+        udp_sport, udp_dport = PORT_PAIR_CODEC.unpack_from(packet, offsets.udp)
+        udp_header, udp_header_pack = build_udp_header(udp_sport, udp_dport, outer_ip_header, bytes(buf[42:]))
+        buf[34:42] = udp_header_pack
+        template.udp_sum = udp_header.udp_sum
+        template.buf = buf
+        return template
+
+ENCAP_TEMPLATES = 4096
+""" IP version/IHL and TOS, total length, ID/fragment/TTL/protocol, IP checksum, addresses, ports, UDP length and checksum """
+ENCAP_CODEC = Struct('!2sH6sH8s4sHH')
+
+class EncapTemplate(object):
+    __slots__ = ('ver_tos', 'id_proto', 'ip_sum', 'addresses', 'ports', 'udp_sum')
+
+class EncapTemplates(object):
+    """
+    Builds the outer IP + UDP headers forward mode puts back around the
+    VxLAN payload. The headers of an (outer addresses, UDP ports, swap_ip)
+    are built once into a template for an empty payload, with the IP and
+    UDP checksums of that. Encapsulating a payload is then one pack of the
+    template with the lengths added and the checksums updated for them and
+    the sum of the payload, no addresses are converted and no headers are
+    rebuilt per packet.
+    """
+    def __init__(self, templates):
+        self.templates = templates
+
+    def encapsulate(self, addresses, ports, payload, swap_ip):
+        """
+        The IP + UDP packet carrying payload for the frame whose outer IP
+        addresses and UDP ports are the bytes addresses and ports
+        """
+        key = (addresses, ports, swap_ip)
+        now = time.time()
+        template = self.templates.get(key, now)
+        if template is FLOW_MISS:
+            template = self.build(addresses, ports, swap_ip)
+            self.templates.put(key, template, now)
+        length = len(payload)
+        ip_sum = add_internet_checksum(template.ip_sum, length)
+        udp_sum = add_internet_checksum(template.udp_sum, 2 * length + (~compute_internet_checksum(payload) & 0xFFFF))
+        return ENCAP_CODEC.pack(template.ver_tos, IPV4_HEADER_LEN_BYTES + UDP_HEADER_LEN_BYTES + length, template.id_proto, ip_sum,
+                                template.addresses, template.ports, UDP_HEADER_LEN_BYTES + length, udp_sum or 0xFFFF) + payload
+
+    def build(self, addresses, ports, swap_ip):
+        """ build_udp_packet() for an empty payload, cut into the parts that don't change """
+        ip_saddr, ip_daddr = IP4_ADDR_PAIR_CODEC.unpack(addresses)
+        udp_sport, udp_dport = PORT_PAIR_CODEC.unpack(ports)
+        ip_header, ip_header_pack = build_ipv4_header(IPV4_HEADER_LEN_BYTES + UDP_HEADER_LEN_BYTES, socket.IPPROTO_UDP,
+                                                      socket.inet_ntoa(ip_saddr), socket.inet_ntoa(ip_daddr), swap_ip)
+        udp_header, udp_header_pack = build_udp_header(udp_sport, udp_dport, ip_header, b'')
+        template = EncapTemplate()
+        template.ver_tos = ip_header_pack[0:2]
+        template.id_proto = ip_header_pack[4:10]
+        template.ip_sum = ip_header.ip_chksum
+        template.addresses = ip_header_pack[12:20]
+        template.ports = udp_header_pack[0:4]
+        template.udp_sum = udp_header.udp_sum
+        return template
+
+def forward_packet_inplace(buf, length, dmac, swap_ip, firewall, vxlan_udp_ports, vxlan_gpe_udp_ports, stats, timer=None):
+    """
+    Rewrite a received VxLAN/VxLAN-gpe + NSH or Eth + NSH frame in place so
+    that it can be sent back out of the same buffer: swap the outer MACs,
+    decrement the nsi and swap the outer IPs. Swapping the IPs leaves the IP
+    and UDP checksums valid, the UDP checksum is updated incrementally for
+    the new nsi. buf is any writable buffer holding the frame at offset 0, dmac the
+    last two bytes of our MAC. Plain VxLAN frames and the frames the firewall
+    doesn't forward are dropped.
+    Drops are counted in stats, timer is the StageTimer of a sampled frame.
+    Returns the number of bytes to send, 0 if the frame is dropped.
+    """
+    if length < 14:
+        stats.drop(DROP_PARSE_ERROR)
+        return 0
+    dst_mac, src_mac = MAC_PAIR_CODEC.unpack_from(buf, 0)
+    if (dmac is not None) and (dst_mac[4:6] != dmac):
+        stats.drop()
+        return 0
+    """ Only the firewall looks past NSH """
+    offsets = parse_frame(buf, length, vxlan_udp_ports, vxlan_gpe_udp_ports, (firewall is not None) and firewall.inner)
+    if offsets is None:
+        stats.drop()
+        return 0
+    if offsets is FRAME_TRUNCATED:
+        stats.drop(DROP_PARSE_ERROR)
+        return 0
+
+    nsh = offsets.nsh
+    if (nsh is None):
+        """ Plain VxLAN, only NSH frames are forwarded """
+        stats.drop()
+        return 0
+    if stats.paths is not None:
+        stats.count_path(offsets.path, length)
+    if stats.probes is not None:
+        stats.probes.record(buf, length, offsets.path)
+    if timer is not None:
+        timer.mark(STAGE_DECODE)
+    action = firewall_match(firewall, buf, offsets)
+    if not action.forward:
+        stats.drop(DROP_BLOCKED)
+        return 0
+    if timer is not None:
+        timer.mark(STAGE_DECISION)
+
+    if action.context is not None:
+        context_offset = frame_nsh_context_offset(offsets)
+        if context_offset is not None:
+            rewrite_context(buf, context_offset, action.context, None if offsets.udp is None else offsets.udp + 6)
+
+    if (offsets.ip is None):
+        """ Eth + NSH """
+        if ((offsets.path & 0xFF) <= 1):
+            stats.drop()
+            return 0
+        U8_CODEC.pack_into(buf, nsh + 7, (offsets.path - 1) & 0xFF)
+    else:
+        path_index = offsets.path & 0xFFFF
+        if ((path_index & 0xFF) <= 1):
+            stats.drop()
+            return 0
+        """ nsi minus one """
+        U16_CODEC.pack_into(buf, nsh + 6, path_index - 1)
+        udp_sum_offset = offsets.udp + 6
+        udp_sum = U16_CODEC.unpack_from(buf, udp_sum_offset)[0]
+        if (udp_sum != 0):
+            udp_sum = update_internet_checksum(udp_sum, path_index, path_index - 1)
+            U16_CODEC.pack_into(buf, udp_sum_offset, udp_sum or 0xFFFF)
+
+        if swap_ip:
+            ip_saddr, ip_daddr = IP4_ADDR_PAIR_CODEC.unpack_from(buf, offsets.ip + 12)
+            IP4_ADDR_PAIR_CODEC.pack_into(buf, offsets.ip + 12, ip_daddr, ip_saddr)
+
+    MAC_PAIR_CODEC.pack_into(buf, 0, src_mac, dst_mac)
+    if timer is not None:
+        timer.mark(STAGE_ENCODE)
+    return length
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+def load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.recvmmsg
+        libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1
+
+def monotonic_clock():
+    """
+    A function returning CLOCK_MONOTONIC in ns, which unlike time.time()
+    doesn't step when the wall clock is set. All processes and network
+    namespaces of a host share it, so probe latencies are one way within a
+    host and round trip when the probes come back to their sender's host.
+    """
+    if hasattr(time, 'monotonic_ns'):
+        return time.monotonic_ns
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    now = timespec()
+    pointer = ctypes.byref(now)
+    def clock():
+        libc.clock_gettime(CLOCK_MONOTONIC, pointer)
+        return now.tv_sec * 1000000000 + now.tv_nsec
+    return clock
+
+STAGE_DECODE = 'decode'
+STAGE_DECISION = 'decision'
+STAGE_ENCODE = 'encode'
+STAGE_SEND = 'send'
+STAGES = [STAGE_DECODE, STAGE_DECISION, STAGE_ENCODE, STAGE_SEND]
+
+""" Reasons for dropping a frame, the forward paths pass them to PacketStats.drop() """
+DROP_OTHER = 0
+DROP_BLOCKED = 1
+DROP_PARSE_ERROR = 2
+
+class StageTimer(object):
+    """
+    Times the stages of one packet. Each mark() books the time since the
+    previous mark (or start()) to the stage into a histogram of power of 2
+    nanosecond buckets, read off monotonic_clock().
+    """
+    def __init__(self):
+        self.clock = monotonic_clock()
+        self.histograms = dict((stage, {}) for stage in STAGES)
+        self.totals = dict((stage, 0) for stage in STAGES)
+        self.last = 0
+
+    def start(self):
+        self.last = self.clock()
+
+    def mark(self, stage):
+        now = self.clock()
+        elapsed = now - self.last
+        self.last = now
+        bucket = 1
+        while bucket < elapsed:
+            bucket <<= 1
+        histogram = self.histograms[stage]
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+        self.totals[stage] += elapsed
+
+class ProbeStream(object):
+    """ The probes received from one sender stream on one nsp """
+    __slots__ = ('first', 'highest', 'received', 'reordered')
+
+    def __init__(self, seq):
+        self.first = seq
+        self.highest = seq
+        self.received = 0
+        self.reordered = 0
+
+    def lost(self):
+        """ Probes missing from the sequence numbers seen so far, late ones are counted once they arrive """
+        return max(self.highest - self.first + 1 - self.received, 0)
+
+class ProbeStats(object):
+    """
+    Latency, loss and reordering of the latency probes seen by a receive
+    loop, per nsp. The latency is the time from the send stamp in the
+    probe trailer to the frame being seen here, in a histogram of power
+    of 2 nanosecond buckets. A probe arriving after a higher sequence
+    number of its stream is counted as reordered.
+    """
+    def __init__(self):
+        self.clock = monotonic_clock()
+        self.histograms = {}
+        self.totals = {}
+        self.streams = {}
+
+    def record(self, buf, length, path):
+        """ Record the frame of length bytes in buf on the NSH path word path if it is a probe """
+        if (length < PROBE_TRAILER_CODEC.size):
+            return
+        stream, seq, sent, magic = PROBE_TRAILER_CODEC.unpack_from(buf, length - PROBE_TRAILER_CODEC.size)
+        if (magic != PROBE_MAGIC):
+            return
+        elapsed = max(self.clock() - sent, 0)
+        nsp = path >> 8
+        bucket = 1
+        while bucket < elapsed:
+            bucket <<= 1
+        histogram = self.histograms.get(nsp)
+        if histogram is None:
+            histogram = self.histograms[nsp] = {}
+            self.totals[nsp] = 0
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+        self.totals[nsp] += elapsed
+
+        probes = self.streams.get((nsp, stream))
+        if probes is None:
+            probes = self.streams[(nsp, stream)] = ProbeStream(seq)
+        if (seq < probes.highest):
+            probes.reordered += 1
+        probes.first = min(probes.first, seq)
+        probes.highest = max(probes.highest, seq)
+        probes.received += 1
+
+    def counters(self):
+        probes = {}
+        for nsp, histogram in list(self.histograms.items()):
+            probes[str(nsp)] = {'histogram': dict(histogram), 'total_ns': self.totals[nsp], 'streams': {}}
+        for (nsp, stream), counts in list(self.streams.items()):
+            probes[str(nsp)]['streams'][str(stream)] = [counts.first, counts.highest, counts.received, counts.reordered]
+        return probes
+
+    def add(self, counters):
+        """ Sum up the probe counters of another loop, the streams split over them are joined again """
+        for nsp, timing in counters.items():
+            nsp = int(nsp)
+            histogram = self.histograms.setdefault(nsp, {})
+            for bucket, count in timing['histogram'].items():
+                bucket = int(bucket)
+                histogram[bucket] = histogram.get(bucket, 0) + count
+            self.totals[nsp] = self.totals.get(nsp, 0) + timing['total_ns']
+            for stream, (first, highest, received, reordered) in timing['streams'].items():
+                probes = self.streams.get((nsp, int(stream)))
+                if probes is None:
+                    probes = self.streams[(nsp, int(stream))] = ProbeStream(first)
+                probes.first = min(probes.first, first)
+                probes.highest = max(probes.highest, highest)
+                probes.received += received
+                probes.reordered += reordered
+
+    def report(self):
+        lines = []
+        for nsp in sorted(self.histograms):
+            histogram = self.histograms[nsp]
+            samples = sum(histogram.values())
+            streams = [probes for (stream_nsp, stream), probes in self.streams.items() if stream_nsp == nsp]
+            lines.append("  probes nsp %d: %d received, %d lost, %d reordered, latency mean %.0f ns, p50 <= %d ns, p99 <= %d ns" %
+                         (nsp, samples, sum(probes.lost() for probes in streams), sum(probes.reordered for probes in streams),
+                          float(self.totals[nsp]) / samples, histogram_quantile(histogram, 0.5),
+                          histogram_quantile(histogram, 0.99)))
+        return lines
+
+class PacketStats(object):
+    """
+    Packet counters of one receive loop. They also count how full the
+    receive batches (or ring blocks) are so that the batch size can be
+    traded off against the packet rate it gives. With detailed set packets
+    are also counted per (nsp, nsi), with sample set every sample-th packet
+    has its stages timed, with probes set latency probes are measured.
+    """
+    def __init__(self, name, detailed=False, sample=0, probes=False):
+        self.name = name
+        self.start = time.time()
+        self.stop = None
+        self.batches = 0
+        self.rx_packets = 0
+        self.rx_bytes = 0
+        self.tx_packets = 0
+        self.tx_bytes = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.parse_errors = 0
+        self.resets = 0
+        self.fill = {}
+        self.flows = {}
+        self.flow_cache = None
+        self.connections = {}
+        self.conntrack = None
+        self.dispatch = None
+        self.dispatched = {}
+        self.paths = None
+        if detailed:
+            self.paths = {}
+        self.sample = sample
+        self.countdown = sample
+        self.timer = StageTimer()
+        self.probes = None
+        if probes:
+            self.probes = ProbeStats()
+        self.exporter = None
+        self.dump = None
+        self.dumps = {}
+
+    def close(self):
+        """
+        Stop the clock, the DumpWriter and the exporter, if any, which writes
+        the final counters
+        """
+        self.stop = time.time()
+        if self.dump is not None:
+            self.dump.close()
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
+
+    def record(self, received, sent, sent_bytes=0, received_bytes=0):
+        self.batches += 1
+        self.rx_packets += received
+        self.rx_bytes += received_bytes
+        self.tx_packets += sent
+        self.tx_bytes += sent_bytes
+        bucket = 1
+        while bucket < max(received, sent):
+            bucket <<= 1
+        self.fill[bucket] = self.fill.get(bucket, 0) + 1
+
+    def drop(self, reason=DROP_OTHER):
+        self.dropped += 1
+        if (reason == DROP_BLOCKED):
+            self.blocked += 1
+        elif (reason == DROP_PARSE_ERROR):
+            self.parse_errors += 1
+
+    def count_path(self, path, length):
+        """ Count a packet of length bytes for the NSH path word (nsp << 8 | nsi) """
+        counts = self.paths.get(path)
+        if counts is None:
+            counts = self.paths[path] = [0, 0]
+        counts[0] += 1
+        counts[1] += length
+
+    def start_timer(self):
+        """ The started StageTimer if the next packet is sampled, None otherwise """
+        if not self.sample:
+            return None
+        self.countdown -= 1
+        if (self.countdown > 0):
+            return None
+        self.countdown = self.sample
+        self.timer.start()
+        return self.timer
+
+    def counters(self):
+        paths = {}
+        if self.paths is not None:
+            for path, counts in dict(self.paths).items():
+                paths["%d/%d" % (path >> 8, path & 0xFF)] = list(counts)
+        stages = {}
+        for stage in STAGES:
+            histogram = dict(self.timer.histograms[stage])
+            if histogram:
+                stages[stage] = {'histogram': histogram, 'total_ns': self.timer.totals[stage]}
+        return {'name': self.name,
+                'start': self.start,
+                'stop': self.stop or time.time(),
+                'batches': self.batches,
+                'rx_packets': self.rx_packets,
+                'rx_bytes': self.rx_bytes,
+                'tx_packets': self.tx_packets,
+                'tx_bytes': self.tx_bytes,
+                'dropped': self.dropped,
+                'blocked': self.blocked,
+                'parse_errors': self.parse_errors,
+                'resets': self.resets,
+                'fill': dict(self.fill),
+                'flows': self.flow_counters(),
+                'conntrack': self.conntrack_counters(),
+                'dumps': self.dump_counters(),
+                'dispatch': self.dispatch_counters(),
+                'paths': paths,
+                'stages': stages,
+                'probes': self.probe_counters()}
+
+    def probe_counters(self):
+        if self.probes is None:
+            return {}
+        return self.probes.counters()
+
+    def flow_counters(self):
+        if self.flow_cache is None:
+            return self.flows
+        return self.flow_cache.counters()
+
+    def conntrack_counters(self):
+        if self.conntrack is None:
+            return self.connections
+        return self.conntrack.counters()
+
+    def dump_counters(self):
+        if self.dump is None:
+            return self.dumps
+        return self.dump.counters()
+
+    def dispatch_counters(self):
+        if self.dispatch is None:
+            return self.dispatched
+        return self.dispatch.counters()
+
+    def add(self, counters):
+        """ Sum up the counters of another loop, e.g. of a worker process """
+        self.start = min(self.start, counters['start'])
+        self.stop = max(self.stop or 0, counters['stop'])
+        for name in ('batches', 'rx_packets', 'rx_bytes', 'tx_packets', 'tx_bytes',
+                     'dropped', 'blocked', 'parse_errors', 'resets'):
+            setattr(self, name, getattr(self, name) + counters.get(name, 0))
+        for bucket, count in counters['fill'].items():
+            bucket = int(bucket)
+            self.fill[bucket] = self.fill.get(bucket, 0) + count
+        for name, count in counters.get('flows', {}).items():
+            self.flows[name] = self.flows.get(name, 0) + count
+        for name, count in counters.get('conntrack', {}).items():
+            self.connections[name] = self.connections.get(name, 0) + count
+        for name, count in counters.get('dumps', {}).items():
+            self.dumps[name] = self.dumps.get(name, 0) + count
+        for path, (packets, length) in counters.get('dispatch', {}).items():
+            counts = self.dispatched.setdefault(path, [0, 0])
+            counts[0] += packets
+            counts[1] += length
+        if counters.get('paths'):
+            if self.paths is None:
+                self.paths = {}
+            for path, (packets, length) in counters['paths'].items():
+                nsp, nsi = path.split('/')
+                counts = self.paths.setdefault((int(nsp) << 8) | int(nsi), [0, 0])
+                counts[0] += packets
+                counts[1] += length
+        for stage, timing in counters.get('stages', {}).items():
+            histogram = self.timer.histograms[stage]
+            for bucket, count in timing['histogram'].items():
+                bucket = int(bucket)
+                histogram[bucket] = histogram.get(bucket, 0) + count
+            self.timer.totals[stage] += timing['total_ns']
+        if counters.get('probes'):
+            if self.probes is None:
+                self.probes = ProbeStats()
+            self.probes.add(counters['probes'])
+
+    def report(self):
+        elapsed = max((self.stop or time.time()) - self.start, 1e-9)
+        batches = max(self.batches, 1)
+        packets = self.rx_packets or self.tx_packets
+        lines = ["%s: rx %d pkts, tx %d pkts in %.1fs, %.0f pps, %.2f pkts/batch, %.3f batches/pkt" %
+                 (self.name, self.rx_packets, self.tx_packets, elapsed, packets / elapsed,
+                  float(packets) / batches, float(self.batches) / max(packets, 1))]
+        if self.tx_bytes:
+            lines.append("  tx %d bytes, %.3f Gbps" % (self.tx_bytes, self.tx_bytes * 8 / elapsed / 1e9))
+        if self.dropped or self.resets:
+            lines.append("  dropped %d pkts (%d blocked, %d parse errors), %d resets sent" %
+                         (self.dropped, self.blocked, self.parse_errors, self.resets))
+        for bucket in sorted(self.fill):
+            lines.append("  <= %4d pkts/batch: %d batches" % (bucket, self.fill[bucket]))
+        flows = self.flow_counters()
+        if flows:
+            lookups = max(flows['hits'] + flows['misses'], 1)
+            lines.append("  flow cache: %d entries, %d hits (%.1f%%), %d misses, %d evictions, %d expired" %
+                         (flows['entries'], flows['hits'], 100.0 * flows['hits'] / lookups,
+                          flows['misses'], flows['evictions'], flows['expired']))
+        connections = self.conntrack_counters()
+        if connections:
+            lines.append("  conntrack: %d connections, %d opened, %d expired, %d early drops, %d refused as full, %d invalid pkts" %
+                         (connections['entries'], connections['created'], connections['expired'],
+                          connections['early_drops'], connections['full'], connections['invalid']))
+        dumps = self.dump_counters()
+        if dumps:
+            lines.append("  dump: %d frames written, %d dropped on a full queue, %d rate limited" %
+                         (dumps['written'], dumps['dropped'], dumps['limited']))
+        dispatched = self.dispatch_counters()
+        for path in sorted(dispatched, key=lambda path: [int(part) for part in path.split('/')]):
+            lines.append("  path %s: %d pkts, %d bytes" % (path, dispatched[path][0], dispatched[path][1]))
+        for stage in STAGES:
+            histogram = self.timer.histograms[stage]
+            samples = sum(histogram.values())
+            if samples:
+                lines.append("  %s: %d samples, mean %.0f ns, p50 <= %d ns, p99 <= %d ns" %
+                             (stage, samples, float(self.timer.totals[stage]) / samples,
+                              histogram_quantile(histogram, 0.5), histogram_quantile(histogram, 0.99)))
+        if self.probes is not None:
+            lines += self.probes.report()
+        return "\n".join(lines)
+
+def histogram_quantile(histogram, q):
+    """ Upper bound of the bucket holding the q quantile """
+    total = sum(histogram.values())
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if (seen >= q * total):
+            return bucket
+    return 0
+
+PROMETHEUS_COUNTERS = [('rx_packets', 'Received packets'),
+                       ('rx_bytes', 'Received bytes'),
+                       ('tx_packets', 'Sent packets'),
+                       ('tx_bytes', 'Sent bytes'),
+                       ('dropped', 'Received packets that were not forwarded'),
+                       ('blocked', 'Packets dropped by a firewall rule'),
+                       ('parse_errors', 'Packets dropped as truncated'),
+                       ('resets', 'TCP resets sent for rst firewall rules'),
+                       ('batches', 'Receive batches')]
+PROMETHEUS_FLOW_COUNTERS = [('hits', 'Flow cache hits'),
+                            ('misses', 'Flow cache misses'),
+                            ('evictions', 'Flows evicted from the flow cache'),
+                            ('expired', 'Idle flows dropped from the flow cache')]
+PROMETHEUS_CONNTRACK_COUNTERS = [('created', 'TCP connections opened in the conntrack table'),
+                                 ('expired', 'Idle TCP connections dropped from the conntrack table'),
+                                 ('early_drops', 'Unestablished TCP connections dropped for a new one on a full conntrack table'),
+                                 ('full', 'SYNs not tracked as the conntrack table was full of established connections'),
+                                 ('invalid', 'TCP packets of no tracked connection or out of its state')]
+
+def prometheus_text(counters):
+    """ The counters of PacketStats.counters() in the Prometheus text exposition format """
+    worker = 'worker="%s"' % counters['name']
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append("# HELP vxlan_tool_%s %s" % (name, help))
+        lines.append("# TYPE vxlan_tool_%s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append("vxlan_tool_%s%s{%s} %s" % (name, suffix, ','.join([worker] + labels), value))
+
+    for name, help in PROMETHEUS_COUNTERS:
+        metric(name + '_total', 'counter', help, [('', [], counters[name])])
+    flows = counters['flows']
+    if flows:
+        metric('flow_cache_entries', 'gauge', 'Flows in the flow cache', [('', [], flows['entries'])])
+        for name, help in PROMETHEUS_FLOW_COUNTERS:
+            metric('flow_cache_%s_total' % name, 'counter', help, [('', [], flows[name])])
+    connections = counters.get('conntrack')
+    if connections:
+        metric('conntrack_entries', 'gauge', 'TCP connections in the conntrack table', [('', [], connections['entries'])])
+        for name, help in PROMETHEUS_CONNTRACK_COUNTERS:
+            metric('conntrack_%s_total' % name, 'counter', help, [('', [], connections[name])])
+    dumps = counters.get('dumps')
+    if dumps:
+        metric('dump_written_total', 'counter', 'Frames written by the dump', [('', [], dumps['written'])])
+        metric('dump_dropped_total', 'counter', 'Frames not dumped as the dump queue was full', [('', [], dumps['dropped'])])
+        metric('dump_limited_total', 'counter', 'Frames not dumped because of --dump-rate', [('', [], dumps['limited'])])
+    labels = lambda path: ['nsp="%s"' % path.split('/')[0], 'nsi="%s"' % path.split('/')[1]]
+    dispatched = counters.get('dispatch')
+    if dispatched:
+        paths = sorted(dispatched.items())
+        metric('dispatch_packets_total', 'counter', 'Packets of the service paths with a count action',
+               [('', labels(path), counts[0]) for path, counts in paths])
+        metric('dispatch_bytes_total', 'counter', 'Bytes of the service paths with a count action',
+               [('', labels(path), counts[1]) for path, counts in paths])
+    if counters['paths']:
+        paths = sorted(counters['paths'].items())
+        metric('path_packets_total', 'counter', 'Received packets per NSH service path and index',
+               [('', labels(path), counts[0]) for path, counts in paths])
+        metric('path_bytes_total', 'counter', 'Received bytes per NSH service path and index',
+               [('', labels(path), counts[1]) for path, counts in paths])
+    if counters['stages']:
+        samples = []
+        for stage, timing in sorted(counters['stages'].items()):
+            stage_label = 'stage="%s"' % stage
+            seen = 0
+            for bucket, count in sorted((int(bucket), count) for bucket, count in timing['histogram'].items()):
+                seen += count
+                samples.append(('_bucket', [stage_label, 'le="%g"' % (bucket / 1e9)], seen))
+            samples.append(('_bucket', [stage_label, 'le="+Inf"'], seen))
+            samples.append(('_sum', [stage_label], "%g" % (timing['total_ns'] / 1e9)))
+            samples.append(('_count', [stage_label], seen))
+        metric('stage_duration_seconds', 'histogram', 'Time spent per packet in each processing stage, sampled', samples)
+    probes = counters.get('probes')
+    if probes:
+        nsps = sorted(probes.items(), key=lambda item: int(item[0]))
+        samples = []
+        for nsp, timing in nsps:
+            nsp_label = 'nsp="%s"' % nsp
+            seen = 0
+            for bucket, count in sorted((int(bucket), count) for bucket, count in timing['histogram'].items()):
+                seen += count
+                samples.append(('_bucket', [nsp_label, 'le="%g"' % (bucket / 1e9)], seen))
+            samples.append(('_bucket', [nsp_label, 'le="+Inf"'], seen))
+            samples.append(('_sum', [nsp_label], "%g" % (timing['total_ns'] / 1e9)))
+            samples.append(('_count', [nsp_label], seen))
+        metric('probe_latency_seconds', 'histogram', 'Time from sending a latency probe to receiving it, per nsp', samples)
+        lost = lambda timing: sum(max(highest - first + 1 - received, 0) for first, highest, received, reordered in timing['streams'].values())
+        metric('probe_lost_total', 'counter', 'Latency probes missing from their sequence',
+               [('', ['nsp="%s"' % nsp], lost(timing)) for nsp, timing in nsps])
+        metric('probe_reordered_total', 'counter', 'Latency probes received after a later one of their sequence',
+               [('', ['nsp="%s"' % nsp], sum(counts[3] for counts in timing['streams'].values())) for nsp, timing in nsps])
+    return "\n".join(lines) + "\n"
+
+def format_counters(counters, format):
+    """ PacketStats.counters() as 'prometheus' text or 'json' """
+    if (format == 'json'):
+        return json.dumps(counters, sort_keys=True) + "\n"
+    return prometheus_text(counters)
+
+class StatsExporter(object):
+    """
+    Exports the counters of a PacketStats from a background thread, every
+    interval seconds to the file path (written to a temporary file that is
+    renamed over it) and on demand to every client that connects to the
+    UNIX socket socket_path. The format is 'prometheus' or 'json'.
+    """
+    def __init__(self, stats, path=None, socket_path=None, format='prometheus', interval=5.0):
+        self.stats = stats
+        self.path = path
+        self.socket_path = socket_path
+        self.format = format
+        self.interval = interval
+        self.listener = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+
+    def start(self):
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(self.socket_path)
+            self.listener.listen(5)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the thread and write the final counters """
+        self.stopping.set()
+        self.thread.join()
+        self.write()
+        if self.listener is not None:
+            self.listener.close()
+            os.unlink(self.socket_path)
+
+    def render(self):
+        return format_counters(self.stats.counters(), self.format)
+
+    def write(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp_path, self.path)
+
+    def serve(self):
+        due = time.time()
+        while not self.stopping.is_set():
+            now = time.time()
+            if (now >= due):
+                self.write()
+                due = now + self.interval
+            """ Wake up at least every second to notice stop() """
+            timeout = min(due - now, 1.0)
+            if self.listener is None:
+                self.stopping.wait(timeout)
+                continue
+            readable, _, _ = select.select([self.listener], [], [], timeout)
+            if readable:
+                client, _ = self.listener.accept()
+                try:
+                    client.sendall(self.render().encode('utf-8'))
+                except socket.error:
+                    pass
+                client.close()
+
+class RuntimeSettings(object):
+    """
+    The settings of the receive loops the control socket can change. A
+    RuntimeSettings is never modified, a change installs a new one in
+    ControlServer.settings with a single assignment so that a loop sees
+    all of the old settings or all of the new ones.
+    """
+    __slots__ = ('firewall', 'verbose')
+
+    def __init__(self, firewall, verbose):
+        self.firewall = firewall
+        self.verbose = verbose
+
+CONTROL_COMMANDS = [('reload', 'read --rules-file and --dispatch-file again'),
+                    ('block PORT', 'block TCP to PORT as -b does, 0 to block nothing'),
+                    ('rule RULE', 'add a firewall rule as --rule does'),
+                    ('clear', 'remove the rules of rule and block'),
+                    ('verbose on|off', 'dump the forwarded packets or not, as -v'),
+                    ('rules', 'list the firewall rules in force'),
+                    ('stats', 'the packet counters in --stats-format'),
+                    ('help', 'list the commands')]
+
+class ControlServer(object):
+    """
+    Changes the settings of a running receive loop on commands read from
+    the UNIX socket socket_path, one per line, by a background thread.
+    Each command is answered with its output, if any, and a line 'ok' or
+    'error: <reason>'. New rule tables are built by the thread, the loop
+    keeps forwarding with the old ones meanwhile and switches to the new
+    ones before its next packet (or batch or ring block), or within
+    IDLE_POLL_MS when no traffic comes, nothing is dropped. Without
+    socket_path it only holds the settings.
+    """
+    def __init__(self, args, settings, stats, socket_path=None):
+        self.args = args
+        self.settings = settings
+        self.stats = stats
+        self.socket_path = socket_path
+        self.listener = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+
+    def start(self):
+        if self.socket_path is None:
+            return
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(5)
+        self.thread.start()
+
+    def stop(self):
+        if self.listener is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.listener.close()
+        os.unlink(self.socket_path)
+
+    def serve(self):
+        while not self.stopping.is_set():
+            """ Wake up every second to notice stop() """
+            readable, _, _ = select.select([self.listener], [], [], 1.0)
+            if not readable:
+                continue
+            client, _ = self.listener.accept()
+            try:
+                for line in client.makefile('r'):
+                    if line.strip():
+                        client.sendall(self.execute(line).encode('utf-8'))
+            except socket.error:
+                pass
+            client.close()
+
+    def execute(self, line):
+        """ Run the command line, return the reply to send back """
+        command, _, value = line.strip().partition(' ')
+        value = value.strip()
+        try:
+            output = self.command(command, value)
+        except (IOError, ValueError) as e:
+            return "error: %s\n" % e
+        if output:
+            return output.rstrip("\n") + "\nok\n"
+        return "ok\n"
+
+    def command(self, command, value):
+        args = self.args
+        if (command == 'reload'):
+            self.install(args)
+        elif (command == 'block'):
+            self.install(args, block=parse_number(value, 0xFFFF, 'block ' + value))
+        elif (command == 'rule'):
+            """ Parsed here so that a bad rule is reported as such """
+            self.install(args, rules=args.rules + [str(FirewallRule(value))])
+        elif (command == 'clear'):
+            self.install(args, rules=[], block=0)
+        elif (command == 'verbose'):
+            if value not in ('on', 'off'):
+                raise ValueError("verbose takes on or off, not '%s'" % value)
+            self.settings = RuntimeSettings(self.settings.firewall, value == 'on')
+        elif (command == 'rules'):
+            return "\n".join(firewall_rule_texts(self.settings.firewall))
+        elif (command == 'stats'):
+            return format_counters(self.stats.counters(), args.stats_format)
+        elif (command == 'help'):
+            return "\n".join("%-16s %s" % (usage, help) for usage, help in CONTROL_COMMANDS)
+        else:
+            raise ValueError("unknown command '%s', try help" % command)
+        return None
+
+    def install(self, args, **changes):
+        """
+        Build the firewall for args with changes and switch the loop to it,
+        the flow cache starts out empty as the verdicts it holds may have
+        changed. args keep the changes once the firewall is built.
+        """
+        new_args = argparse.Namespace(**vars(args))
+        for name, value in changes.items():
+            setattr(new_args, name, value)
+        firewall = load_firewall(new_args)
+        self.args = new_args
+        self.settings = RuntimeSettings(firewall, self.settings.verbose)
+
+def firewall_rule_texts(firewall):
+    """
+    The rules of a Firewall or DispatchTable as they were written, those a
+    DispatchTable falls back to for the paths it doesn't list after '* '
+    """
+    if firewall is None:
+        return []
+    if isinstance(firewall, DispatchTable):
+        paths = [str(path) for key, path in sorted(firewall.paths.items())]
+        return paths + ["* " + text for text in firewall_rule_texts(firewall.fallback)]
+    return [str(rule) for rule in firewall.rules]
+
+def worker_path(path, worker, workers):
+    """ path for a single process, path.<worker> for each of several workers """
+    if (path is None) or (workers == 1):
+        return path
+    return "%s.%d" % (path, worker)
+
+def wait_readable(s):
+    """ Wait up to IDLE_POLL_MS for a frame to arrive on the socket s """
+    select.select([s], [], [], IDLE_POLL_MS / 1000.0)
+
+class PacketBatchIO(object):
+    """
+    Batched receive and send on AF_PACKET sockets. Frames are received into
+    a fixed set of buffers with one recvmmsg call that waits for the first
+    frame and then takes whatever else is ready, get rewritten in place and
+    go back out with one sendmmsg call. Without recvmmsg/sendmmsg in libc
+    the socket is drained with non-blocking recv_into calls instead.
+    """
+    def __init__(self, recv_s, send_s, batch, libc=None):
+        self.recv_s = recv_s
+        self.send_s = send_s
+        self.batch = batch
+        self.libc = libc
+        self.bufs = [bytearray(RECV_BUF_SIZE) for i in range(batch)]
+        self.views = [memoryview(buf) for buf in self.bufs]
+        self.lengths = [0] * batch
+        if libc is not None:
+            self.addrs = [ctypes.addressof((ctypes.c_char * RECV_BUF_SIZE).from_buffer(buf)) for buf in self.bufs]
+            self.rx_iov = (iovec * batch)()
+            self.rx_msgs = (mmsghdr * batch)()
+            self.tx_iov = (iovec * batch)()
+            self.tx_msgs = (mmsghdr * batch)()
+            for i in range(batch):
+                self.rx_iov[i].iov_base = self.addrs[i]
+                self.rx_iov[i].iov_len = RECV_BUF_SIZE
+                self.rx_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.rx_iov[i])
+                self.rx_msgs[i].msg_hdr.msg_iovlen = 1
+                self.tx_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.tx_iov[i])
+                self.tx_msgs[i].msg_hdr.msg_iovlen = 1
+
+    def recv(self):
+        """
+        Return how many frames were received, 0 if there were none and up
+        to IDLE_POLL_MS were spent waiting for one. Frames that arrive
+        during the wait are left for the next call, so that the caller gets
+        to look at its settings first.
+        """
+        if self.libc is not None:
+            count = self.libc.recvmmsg(self.recv_s.fileno(), self.rx_msgs, self.batch, MSG_WAITFORONE | socket.MSG_DONTWAIT, None)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err not in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise OSError(err, os.strerror(err))
+                if err != errno.EINTR:
+                    wait_readable(self.recv_s)
+                return 0
+            for i in range(count):
+                self.lengths[i] = self.rx_msgs[i].msg_len
+            return count
+
+        count = 0
+        while count < self.batch:
+            try:
+                self.lengths[count] = self.recv_s.recv_into(self.bufs[count], RECV_BUF_SIZE, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                if count == 0:
+                    wait_readable(self.recv_s)
+                break
+            count += 1
+        return count
+
+    def send(self, count):
+        """ Send the first count buffers, skipping the ones with length 0 """
+        if self.libc is None:
+            sent = 0
+            for i in range(count):
+                length = self.lengths[i]
+                if length:
+                    self.send_s.send(self.views[i][:length])
+                    sent += 1
+            return sent
+
+        pending = 0
+        for i in range(count):
+            if self.lengths[i]:
+                self.tx_iov[pending].iov_base = self.addrs[i]
+                self.tx_iov[pending].iov_len = self.lengths[i]
+                pending += 1
+        sent = 0
+        while sent < pending:
+            msgs = ctypes.byref(self.tx_msgs, sent * ctypes.sizeof(mmsghdr))
+            result = self.libc.sendmmsg(self.send_s.fileno(), msgs, pending - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err != errno.EINTR:
+                    raise OSError(err, os.strerror(err))
+                continue
+            sent += result
+        return sent
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_TX_RING = 13
+PACKET_FANOUT = 18
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+TP_STATUS_WRONG_FORMAT = 4
+TPACKET3_HDRLEN = 48
+
+RING_BLOCK_SIZE = 1 << 18
+RING_BLOCK_NR = 64
+RING_FRAME_SIZE = 1 << 11
+RING_BLOCK_TIMEOUT_MS = 4
+RING_TX_BLOCK_NR = 4
+
+TPACKET_REQ3_CODEC = Struct('=I I I I I I I')
+U32_NATIVE_CODEC = Struct('=I')
+BLOCK_DESC_PKTS_CODEC = Struct('=I I')
+TPACKET3_HDR_CODEC = Struct('=I 8x I 8x H')
+TPACKET3_TX_HDR_CODEC = Struct('=I 8x I I I')
+
+class PacketRingIO(object):
+    """
+    PACKET_MMAP capture. A TPACKET_V3 RX ring is mapped into the process and
+    frames are read straight out of the blocks the kernel hands over, a
+    block is given back once all its frames are handled. For forwarding a
+    TX ring is mapped on its own socket, frames are copied into it from the
+    RX ring and the kernel is kicked once per block. Kernels before 4.11
+    have no TPACKET_V3 TX ring, frames are then sent with send_s.
+    """
+    def __init__(self, recv_s, send_s=None, interface=None):
+        self.recv_s = recv_s
+        self.send_s = send_s
+        rx_size = RING_BLOCK_SIZE * RING_BLOCK_NR
+        recv_s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        recv_s.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                          TPACKET_REQ3_CODEC.pack(RING_BLOCK_SIZE, RING_BLOCK_NR, RING_FRAME_SIZE,
+                                                  rx_size // RING_FRAME_SIZE, RING_BLOCK_TIMEOUT_MS, 0, 0))
+        self.rx_map = mmap.mmap(recv_s.fileno(), rx_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.rx = (ctypes.c_ubyte * rx_size).from_buffer(self.rx_map)
+        self.rx_addr = ctypes.addressof(self.rx)
+        self.rx_view = memoryview(self.rx)
+        self.block = 0
+        self.poller = select.poll()
+        self.poller.register(recv_s.fileno(), select.POLLIN | select.POLLERR)
+
+        self.tx = None
+        if (send_s is not None) and (interface is not None):
+            tx_s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+            tx_s.bind((interface, 0))
+            tx_size = RING_BLOCK_SIZE * RING_TX_BLOCK_NR
+            try:
+                tx_s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+                tx_s.setsockopt(SOL_PACKET, PACKET_TX_RING,
+                                TPACKET_REQ3_CODEC.pack(RING_BLOCK_SIZE, RING_TX_BLOCK_NR, RING_FRAME_SIZE,
+                                                        tx_size // RING_FRAME_SIZE, 0, 0, 0))
+            except socket.error:
+                tx_s.close()
+            else:
+                self.tx_s = tx_s
+                self.tx_map = mmap.mmap(tx_s.fileno(), tx_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+                self.tx = (ctypes.c_ubyte * tx_size).from_buffer(self.tx_map)
+                self.tx_addr = ctypes.addressof(self.tx)
+                self.tx_frame_nr = tx_size // RING_FRAME_SIZE
+                self.tx_frame = 0
+                self.tx_pending = 0
+
+    def recv(self):
+        """
+        Return the (offset, length) of the frames of the next block, none
+        if the kernel hadn't handed it over yet and up to IDLE_POLL_MS were
+        spent waiting for it. The block is only taken on the next call then,
+        so that the caller gets to look at its settings first.
+        """
+        block_offset = self.block * RING_BLOCK_SIZE
+        if not (U32_NATIVE_CODEC.unpack_from(self.rx, block_offset + 8)[0] & TP_STATUS_USER):
+            self.poller.poll(IDLE_POLL_MS)
+            return []
+        num_pkts, frame_offset = BLOCK_DESC_PKTS_CODEC.unpack_from(self.rx, block_offset + 12)
+        frame_offset += block_offset
+        frames = []
+        for i in range(num_pkts):
+            next_offset, snaplen, mac = TPACKET3_HDR_CODEC.unpack_from(self.rx, frame_offset)
+            frames.append((frame_offset + mac, snaplen))
+            frame_offset += next_offset
+        return frames
+
+    def release(self):
+        """ Hand the current block back to the kernel """
+        U32_NATIVE_CODEC.pack_into(self.rx, self.block * RING_BLOCK_SIZE + 8, TP_STATUS_KERNEL)
+        self.block = (self.block + 1) % RING_BLOCK_NR
+
+    def send(self, offset, length):
+        """ Queue length bytes at offset in the RX ring for sending """
+        if (self.tx is None) or (length > RING_FRAME_SIZE - TPACKET3_HDRLEN):
+            self.flush()
+            self.send_s.send(self.rx_view[offset:offset + length])
+            return
+        frame = self.tx_frame * RING_FRAME_SIZE
+        status = U32_NATIVE_CODEC.unpack_from(self.tx, frame + 20)[0]
+        if (status != TP_STATUS_AVAILABLE) and (status != TP_STATUS_WRONG_FORMAT):
+            """ The ring is full, wait for the kernel to drain it """
+            self.flush(0)
+            status = U32_NATIVE_CODEC.unpack_from(self.tx, frame + 20)[0]
+            if (status != TP_STATUS_AVAILABLE) and (status != TP_STATUS_WRONG_FORMAT):
+                self.send_s.send(self.rx_view[offset:offset + length])
+                return
+        ctypes.memmove(self.tx_addr + frame + TPACKET3_HDRLEN, self.rx_addr + offset, length)
+        TPACKET3_TX_HDR_CODEC.pack_into(self.tx, frame, 0, length, length, TP_STATUS_SEND_REQUEST)
+        self.tx_frame = (self.tx_frame + 1) % self.tx_frame_nr
+        self.tx_pending += 1
+
+    def flush(self, flags=socket.MSG_DONTWAIT):
+        """ Have the kernel send all the frames queued in the TX ring """
+        if (self.tx is None) or (self.tx_pending == 0):
+            return
+        try:
+            self.tx_s.send(b'', flags)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                raise
+        self.tx_pending = 0
+
+SO_ATTACH_FILTER = 26
+SKF_AD_OFF = -0x1000
+SKF_AD_PKTTYPE = 4
+PACKET_OUTGOING = 4
+
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LDX_B_MSH = 0xb1
+BPF_JEQ_K = 0x15
+BPF_RET_K = 0x06
+BPF_ACCEPT = 0x40000
+
+BPF_INSN_CODEC = Struct('=H B B I')
+
+def assemble_bpf(program):
+    """
+    Resolve the jump labels of a classic BPF program. program is a list of
+    (code, jt, jf, k) instructions, where jt/jf may be label names, and of
+    label names, each marking the instruction after it.
+    """
+    labels = {}
+    insns = []
+    for item in program:
+        if isinstance(item, str):
+            labels[item] = len(insns)
+        else:
+            insns.append(item)
+    assembled = []
+    for pc, (code, jt, jf, k) in enumerate(insns):
+        if isinstance(jt, str):
+            jt = labels[jt] - pc - 1
+        if isinstance(jf, str):
+            jf = labels[jf] - pc - 1
+        assert 0 <= jt < 256 and 0 <= jf < 256
+        assembled.append((code, jt, jf, k & 0xFFFFFFFF))
+    return assembled
+
+def build_prefilter(dmac, vxlan_udp_ports, skip_outgoing=False):
+    """
+    Build the classic BPF program that lets only the frames the receive
+    loop would look at reach user space: Eth + NSH, or IPv4 + UDP to one of
+    the VxLAN ports, sent to our MAC (dmac is its last two bytes, as an
+    int). skip_outgoing drops the frames we send ourselves as well. The UDP
+    header is found past the IP options, X is loaded with the IP header
+    length.
+    """
+    program = []
+    if skip_outgoing:
+        program += [(BPF_LD_W_ABS, 0, 0, SKF_AD_OFF + SKF_AD_PKTTYPE),
+                    (BPF_JEQ_K, 'reject', 0, PACKET_OUTGOING)]
+    if dmac is not None:
+        program += [(BPF_LD_H_ABS, 0, 0, 4),
+                    (BPF_JEQ_K, 0, 'reject', dmac)]
+    program += [(BPF_LD_H_ABS, 0, 0, 12),
+                (BPF_JEQ_K, 'accept', 0, 0x894f),
+                (BPF_JEQ_K, 0, 'reject', 0x0800),
+                (BPF_LD_B_ABS, 0, 0, 23),
+                (BPF_JEQ_K, 0, 'reject', 17),
+                (BPF_LDX_B_MSH, 0, 0, 14),
+                (BPF_LD_H_IND, 0, 0, 14 + 2)]
+    for port in vxlan_udp_ports:
+        program.append((BPF_JEQ_K, 'accept', 0, port))
+    program += ['reject',
+                (BPF_RET_K, 0, 0, 0),
+                'accept',
+                (BPF_RET_K, 0, 0, BPF_ACCEPT)]
+    return assemble_bpf(program)
+
+def attach_prefilter(s, program):
+    """ Attach a classic BPF program with SO_ATTACH_FILTER """
+    code = ctypes.create_string_buffer(b''.join(BPF_INSN_CODEC.pack(*insn) for insn in program))
+    s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, pack('HL', len(program), ctypes.addressof(code)))
+
+AF_XDP = 44
+SOL_XDP = 283
+XDP_MMAP_OFFSETS = 1
+XDP_RX_RING = 2
+XDP_TX_RING = 3
+XDP_UMEM_REG = 4
+XDP_UMEM_FILL_RING = 5
+XDP_UMEM_COMPLETION_RING = 6
+XDP_PGOFF_RX_RING = 0
+XDP_PGOFF_TX_RING = 0x80000000
+XDP_UMEM_PGOFF_FILL_RING = 0x100000000
+XDP_UMEM_PGOFF_COMPLETION_RING = 0x180000000
+XDP_COPY = 1 << 1
+XDP_ZEROCOPY = 1 << 2
+XDP_FLAGS_SKB_MODE = 1 << 1
+XDP_FLAGS_DRV_MODE = 1 << 2
+XDP_PASS = 2
+""" Ring sizes are powers of two, all the UMEM frames fit in the fill ring so it never overflows """
+XDP_RING_SIZE = 2048
+XDP_FRAME_SIZE = 2048
+XDP_FRAME_NR = XDP_RING_SIZE
+""" Most frames taken from the RX ring at a time """
+XDP_BATCH = 64
+
+""" The bpf() system call has no libc wrapper """
+BPF_SYSCALLS = {'x86_64': 321, 'aarch64': 280, 'armv7l': 386, 'ppc64le': 361, 's390x': 351}
+BPF_MAP_CREATE = 0
+BPF_MAP_UPDATE_ELEM = 2
+BPF_PROG_LOAD = 5
+BPF_LINK_CREATE = 28
+BPF_MAP_TYPE_XSKMAP = 17
+BPF_PROG_TYPE_XDP = 6
+BPF_XDP = 37
+BPF_PSEUDO_MAP_FD = 1
+BPF_FUNC_REDIRECT_MAP = 51
+BPF_ATTR_SIZE = 128
+BPF_LOG_SIZE = 1 << 16
+
+EBPF_LDX_W = 0x61
+EBPF_LDX_H = 0x69
+EBPF_LDX_B = 0x71
+EBPF_LD_DW_IMM = 0x18
+EBPF_MOV64_X = 0xbf
+EBPF_MOV64_K = 0xb7
+EBPF_ADD64_K = 0x07
+EBPF_ADD64_X = 0x0f
+EBPF_AND64_K = 0x57
+EBPF_LSH64_K = 0x67
+EBPF_JGT_X = 0x2d
+EBPF_JEQ_K = 0x15
+EBPF_JNE_K = 0x55
+EBPF_JLT_K = 0xa5
+EBPF_CALL = 0x85
+EBPF_EXIT = 0x95
+
+EBPF_INSN_CODEC = Struct('=B B h i')
+BPF_MAP_CREATE_CODEC = Struct('=I I I I I')
+BPF_MAP_UPDATE_CODEC = Struct('=I 4x Q Q Q')
+BPF_PROG_LOAD_CODEC = Struct('=I I Q Q I I Q I I 16s I I')
+BPF_LINK_CREATE_CODEC = Struct('=I I I I')
+XDP_UMEM_REG_CODEC = Struct('=Q Q I I')
+""" producer, consumer, desc and flags offsets of the RX, TX, fill and completion rings """
+XDP_MMAP_OFFSETS_CODEC = Struct('=16Q')
+SOCKADDR_XDP_CODEC = Struct('=H H I I I')
+XDP_DESC = 'QI4x'
+XDP_ADDRESS = 'Q'
+XDP_RING_CODECS = {}
+
+def assemble_ebpf(program):
+    """
+    Resolve the jump labels of an eBPF program. program is a list of
+    (code, dst, src, off, imm) instructions, where off may be a label
+    name, and of label names, each marking the instruction after it.
+    """
+    labels = {}
+    insns = []
+    for item in program:
+        if isinstance(item, str):
+            labels[item] = len(insns)
+        else:
+            insns.append(item)
+    assembled = []
+    for pc, (code, dst, src, off, imm) in enumerate(insns):
+        if isinstance(off, str):
+            off = labels[off] - pc - 1
+        assembled.append(EBPF_INSN_CODEC.pack(code, (src << 4) | dst, off, imm))
+    return b''.join(assembled)
+
+def build_xdp_redirect(map_fd, dmac, vxlan_udp_ports):
+    """
+    Build the XDP program handing the frames build_prefilter() would
+    accept to the AF_XDP socket of their RX queue in the XSKMAP map_fd,
+    the kernel keeps all the others. Frames are read in place, so the
+    16-bit fields are compared in network order. The UDP header is found
+    past the IP options, r4 points to it less the 14 bytes of Ethernet.
+    """
+    program = [(EBPF_LDX_W, 2, 1, 0, 0),
+               (EBPF_LDX_W, 3, 1, 4, 0),
+               (EBPF_MOV64_X, 4, 2, 0, 0),
+               (EBPF_ADD64_K, 4, 0, 0, 38),
+               (EBPF_JGT_X, 4, 3, 'pass', 0)]
+    if dmac is not None:
+        program += [(EBPF_LDX_H, 5, 2, 4, 0),
+                    (EBPF_JNE_K, 5, 0, 'pass', socket.htons(dmac))]
+    program += [(EBPF_LDX_H, 5, 2, 12, 0),
+                (EBPF_JEQ_K, 5, 0, 'redirect', socket.htons(0x894f)),
+                (EBPF_JNE_K, 5, 0, 'pass', socket.htons(0x0800)),
+                (EBPF_LDX_B, 5, 2, 23, 0),
+                (EBPF_JNE_K, 5, 0, 'pass', 17),
+                (EBPF_LDX_B, 5, 2, 14, 0),
+                (EBPF_AND64_K, 5, 0, 0, 0x0F),
+                (EBPF_LSH64_K, 5, 0, 0, 2),
+                (EBPF_JLT_K, 5, 0, 'pass', 20),
+                (EBPF_MOV64_X, 4, 2, 0, 0),
+                (EBPF_ADD64_X, 4, 5, 0, 0),
+                (EBPF_MOV64_X, 6, 4, 0, 0),
+                (EBPF_ADD64_K, 6, 0, 0, 14 + 4),
+                (EBPF_JGT_X, 6, 3, 'pass', 0),
+                (EBPF_LDX_H, 5, 4, 14 + 2, 0)]
+    for port in vxlan_udp_ports:
+        program.append((EBPF_JEQ_K, 5, 0, 'redirect', socket.htons(port)))
+    program += ['pass',
+                (EBPF_MOV64_K, 0, 0, 0, XDP_PASS),
+                (EBPF_EXIT, 0, 0, 0, 0),
+                'redirect',
+                (EBPF_LDX_W, 2, 1, 16, 0),
+                (EBPF_LD_DW_IMM, 1, BPF_PSEUDO_MAP_FD, 0, map_fd),
+                (0, 0, 0, 0, 0),
+                (EBPF_MOV64_K, 3, 0, 0, XDP_PASS),
+                (EBPF_CALL, 0, 0, 0, BPF_FUNC_REDIRECT_MAP),
+                (EBPF_EXIT, 0, 0, 0, 0)]
+    return assemble_ebpf(program)
+
+def bpf(libc, command, attr):
+    """ Run the bpf() command with the packed attr, return the fd or 0 it returns """
+    buf = ctypes.create_string_buffer(attr, BPF_ATTR_SIZE)
+    result = libc.syscall(BPF_SYSCALLS.get(os.uname()[4], BPF_SYSCALLS['x86_64']), command, buf, BPF_ATTR_SIZE)
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+def load_xdp_program(libc, code):
+    """ Load the XDP program code, the verifier log is part of the error if it is refused """
+    license = ctypes.create_string_buffer(b'GPL')
+    insns = ctypes.create_string_buffer(code, len(code))
+    try:
+        return bpf(libc, BPF_PROG_LOAD, BPF_PROG_LOAD_CODEC.pack(
+            BPF_PROG_TYPE_XDP, len(code) // EBPF_INSN_CODEC.size, ctypes.addressof(insns), ctypes.addressof(license),
+            0, 0, 0, 0, 0, b'vxlan_tool', 0, BPF_XDP))
+    except OSError as e:
+        log = ctypes.create_string_buffer(BPF_LOG_SIZE)
+        try:
+            bpf(libc, BPF_PROG_LOAD, BPF_PROG_LOAD_CODEC.pack(
+                BPF_PROG_TYPE_XDP, len(code) // EBPF_INSN_CODEC.size, ctypes.addressof(insns), ctypes.addressof(license),
+                1, BPF_LOG_SIZE, ctypes.addressof(log), 0, 0, b'vxlan_tool', 0, BPF_XDP))
+        except OSError:
+            pass
+        raise OSError(e.errno, "can't load the XDP program: %s\n%s" % (e.strerror, log.value.decode('ascii', 'replace')))
+
+def xdp_ring_codec(entry, count):
+    """ The codec of count consecutive ring entries of the entry format """
+    codec = XDP_RING_CODECS.get((entry, count))
+    if codec is None:
+        codec = XDP_RING_CODECS[(entry, count)] = Struct('=' + entry * count)
+    return codec
+
+class XdpRing(object):
+    """
+    One of the four rings of an AF_XDP socket mapped into the process. The
+    entries of a call are read and written with a single codec, two where
+    they wrap around the end of the ring.
+    """
+    __slots__ = ('map', 'producer', 'consumer', 'desc', 'entry', 'size', 'fields', 'head')
+
+    def __init__(self, fd, offsets, entry, pgoff, ours):
+        producer, consumer, desc, flags = offsets
+        self.entry = entry
+        self.size = calcsize('=' + entry)
+        self.fields = len(unpack('=' + entry, b'\0' * self.size))
+        self.map = mmap.mmap(fd, desc + XDP_RING_SIZE * self.size, mmap.MAP_SHARED,
+                             mmap.PROT_READ | mmap.PROT_WRITE, offset=pgoff)
+        self.producer = producer
+        self.consumer = consumer
+        self.desc = desc
+        """ Our own end of the ring, the producer of the fill and TX rings, the consumer of the others """
+        self.head = U32_NATIVE_CODEC.unpack_from(self.map, ours)[0]
+
+    def available(self):
+        """ Entries the kernel has produced that we haven't consumed yet """
+        return (U32_NATIVE_CODEC.unpack_from(self.map, self.producer)[0] - self.head) & 0xFFFFFFFF
+
+    def free(self):
+        """ Entries we can produce before the ring is full """
+        return XDP_RING_SIZE - ((self.head - U32_NATIVE_CODEC.unpack_from(self.map, self.consumer)[0]) & 0xFFFFFFFF)
+
+    def read(self, count):
+        """ Consume count entries, returned as one flat tuple of their fields """
+        start = self.head & (XDP_RING_SIZE - 1)
+        first = min(count, XDP_RING_SIZE - start)
+        values = xdp_ring_codec(self.entry, first).unpack_from(self.map, self.desc + start * self.size)
+        if first < count:
+            values += xdp_ring_codec(self.entry, count - first).unpack_from(self.map, self.desc)
+        self.head = (self.head + count) & 0xFFFFFFFF
+        U32_NATIVE_CODEC.pack_into(self.map, self.consumer, self.head)
+        return values
+
+    def write(self, values):
+        """ Produce the entries whose fields are flattened in the values list """
+        fields = self.fields
+        count = len(values) // fields
+        start = self.head & (XDP_RING_SIZE - 1)
+        first = min(count, XDP_RING_SIZE - start)
+        xdp_ring_codec(self.entry, first).pack_into(self.map, self.desc + start * self.size, *values[:first * fields])
+        if first < count:
+            xdp_ring_codec(self.entry, count - first).pack_into(self.map, self.desc, *values[first * fields:])
+        self.head = (self.head + count) & 0xFFFFFFFF
+        U32_NATIVE_CODEC.pack_into(self.map, self.producer, self.head)
+
+class XdpSocketIO(object):
+    """
+    AF_XDP capture and send, with the interface of PacketRingIO so that the
+    ring loops run on it unchanged. Frames are received straight into a
+    UMEM shared with the kernel, an XDP program redirects the frames we
+    handle on RX queue 0 to the socket and leaves all others to the kernel.
+    Forwarded frames are rewritten in the UMEM and sent from there, a frame
+    only goes back to the fill ring once it is dropped or its send is
+    completed. The program is attached in native mode and in generic (SKB)
+    mode where the driver has no XDP support, the socket is bound zero copy
+    and in copy mode where that isn't supported, so veth and virtio work.
+    Frames the TX ring has no room for are sent with send_s.
+    """
+    def __init__(self, interface, send_s, dmac, vxlan_udp_ports):
+        self.send_s = send_s
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        ifindex = self.libc.if_nametoindex(interface.encode('ascii'))
+        if ifindex == 0:
+            raise OSError(errno.ENODEV, "no interface '%s'" % interface)
+        self.s = socket.socket(AF_XDP, socket.SOCK_RAW, 0)
+        fd = self.s.fileno()
+
+        umem_size = XDP_FRAME_SIZE * XDP_FRAME_NR
+        self.umem_map = mmap.mmap(-1, umem_size, mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+        self.umem = (ctypes.c_ubyte * umem_size).from_buffer(self.umem_map)
+        self.rx_view = memoryview(self.umem)
+        self.s.setsockopt(SOL_XDP, XDP_UMEM_REG, XDP_UMEM_REG_CODEC.pack(ctypes.addressof(self.umem), umem_size, XDP_FRAME_SIZE, 0))
+        for option in (XDP_UMEM_FILL_RING, XDP_UMEM_COMPLETION_RING, XDP_RX_RING, XDP_TX_RING):
+            self.s.setsockopt(SOL_XDP, option, U32_NATIVE_CODEC.pack(XDP_RING_SIZE))
+        offsets = XDP_MMAP_OFFSETS_CODEC.unpack(self.s.getsockopt(SOL_XDP, XDP_MMAP_OFFSETS, XDP_MMAP_OFFSETS_CODEC.size))
+        self.rx = XdpRing(fd, offsets[0:4], XDP_DESC, XDP_PGOFF_RX_RING, offsets[1])
+        self.tx = XdpRing(fd, offsets[4:8], XDP_DESC, XDP_PGOFF_TX_RING, offsets[4])
+        self.fill = XdpRing(fd, offsets[8:12], XDP_ADDRESS, XDP_UMEM_PGOFF_FILL_RING, offsets[8])
+        self.completion = XdpRing(fd, offsets[12:16], XDP_ADDRESS, XDP_UMEM_PGOFF_COMPLETION_RING, offsets[13])
+        self.fill.write(range(0, umem_size, XDP_FRAME_SIZE))
+
+        for flags in (XDP_ZEROCOPY, XDP_COPY):
+            address = ctypes.create_string_buffer(SOCKADDR_XDP_CODEC.pack(AF_XDP, flags, ifindex, 0, 0))
+            if self.libc.bind(fd, address, SOCKADDR_XDP_CODEC.size) == 0:
+                break
+        else:
+            err = ctypes.get_errno()
+            raise OSError(err, "can't bind the AF_XDP socket: %s" % os.strerror(err))
+        self.copy = (flags == XDP_COPY)
+
+        self.map_fd = bpf(self.libc, BPF_MAP_CREATE, BPF_MAP_CREATE_CODEC.pack(BPF_MAP_TYPE_XSKMAP, 4, 4, 64, 0))
+        queue = ctypes.c_uint32(0)
+        socket_fd = ctypes.c_uint32(fd)
+        bpf(self.libc, BPF_MAP_UPDATE_ELEM, BPF_MAP_UPDATE_CODEC.pack(self.map_fd, ctypes.addressof(queue), ctypes.addressof(socket_fd), 0))
+        self.prog_fd = load_xdp_program(self.libc, build_xdp_redirect(self.map_fd, dmac, vxlan_udp_ports))
+        for mode in (XDP_FLAGS_DRV_MODE, XDP_FLAGS_SKB_MODE):
+            try:
+                """ The program stays attached as long as the link fd is open """
+                self.link_fd = bpf(self.libc, BPF_LINK_CREATE, BPF_LINK_CREATE_CODEC.pack(self.prog_fd, ifindex, BPF_XDP, mode))
+                break
+            except OSError as e:
+                if (mode == XDP_FLAGS_SKB_MODE) or (e.errno == errno.EBUSY):
+                    raise OSError(e.errno, "can't attach the XDP program to '%s': %s" % (interface, e.strerror))
+        self.generic = (mode == XDP_FLAGS_SKB_MODE)
+
+        self.addresses = ()
+        self.held = set()
+        self.pending = []
+        self.tx_room = 0
+        self.poller = select.poll()
+        self.poller.register(fd, select.POLLIN | select.POLLERR)
+
+    def complete(self):
+        """ Give the frames whose send completed back to the fill ring """
+        count = self.completion.available()
+        if count:
+            self.fill.write(self.completion.read(count))
+
+    def recv(self):
+        """
+        Return the (offset, length) in the UMEM of up to XDP_BATCH frames,
+        none if there were none and up to IDLE_POLL_MS were spent waiting,
+        as PacketRingIO.recv()
+        """
+        rx = self.rx
+        count = rx.available()
+        if count == 0:
+            self.complete()
+            self.poller.poll(IDLE_POLL_MS)
+            return []
+        descs = rx.read(min(count, XDP_BATCH))
+        self.addresses = descs[0::2]
+        return list(zip(self.addresses, descs[1::2]))
+
+    def release(self):
+        """ Hand the frames of the last recv() that aren't being sent back to the kernel """
+        held = self.held
+        if held:
+            self.fill.write([address for address in self.addresses if address not in held])
+            held.clear()
+        else:
+            self.fill.write(self.addresses)
+        self.addresses = ()
+
+    def send(self, offset, length):
+        """ Queue the length bytes at offset in the UMEM for sending """
+        if self.tx_room == 0:
+            self.flush()
+            self.tx_room = self.tx.free()
+            if self.tx_room == 0:
+                self.send_s.send(self.rx_view[offset:offset + length])
+                return
+        self.pending += (offset, length)
+        self.held.add(offset)
+        self.tx_room -= 1
+
+    def flush(self, flags=socket.MSG_DONTWAIT):
+        """ Have the kernel send all the queued frames, and take back those already sent """
+        if self.pending:
+            self.tx.write(self.pending)
+            self.pending = []
+            try:
+                self.s.send(b'', flags)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS, errno.EBUSY):
+                    raise
+        self.complete()
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_LINKTYPE_ETHERNET = 1
+PCAP_HEADER_CODEC = Struct('=I H H i I I I')
+PCAP_RECORD_CODEC = Struct('=I I I I')
+
+class ReplayDone(Exception):
+    """ Raised by PcapReader once all the frames are replayed """
+
+class PcapReader(object):
+    """
+    Stands in for the receive socket: the frames of a pcap file, loaded up
+    front so that reading the file isn't timed, are returned by recvfrom()
+    and recv_into() one at a time, loops times over. ReplayDone is raised
+    after the last one.
+    """
+    def __init__(self, path, loops=1):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if (len(data) < PCAP_HEADER_CODEC.size):
+            raise ValueError("%s: not a pcap file" % path)
+        """ The file is in the byte order of the host that wrote it """
+        for order in '<>':
+            if Struct(order + 'I').unpack_from(data, 0)[0] in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise ValueError("%s: not a pcap file, pcapng isn't supported" % path)
+        header = Struct(order + PCAP_HEADER_CODEC.format[1:]).unpack_from(data, 0)
+        if (header[6] != PCAP_LINKTYPE_ETHERNET):
+            raise ValueError("%s: link type %d, only Ethernet captures can be replayed" % (path, header[6]))
+        record = Struct(order + PCAP_RECORD_CODEC.format[1:])
+        self.frames = []
+        offset = PCAP_HEADER_CODEC.size
+        while (offset + record.size <= len(data)):
+            caplen = record.unpack_from(data, offset)[2]
+            offset += record.size
+            self.frames.append(data[offset:offset + caplen])
+            offset += caplen
+        self.loops = loops
+        self.index = 0
+
+    def next_frame(self):
+        if (self.index == len(self.frames)):
+            self.loops -= 1
+            if (self.loops <= 0) or (not self.frames):
+                raise ReplayDone()
+            self.index = 0
+        frame = self.frames[self.index]
+        self.index += 1
+        return frame
+
+    def recvfrom(self, size, flags=0):
+        return self.next_frame()[:size], None
+
+    def recv_into(self, buf, size=0, flags=0):
+        frame = self.next_frame()
+        buf[:len(frame)] = frame
+        return len(frame)
+
+    def close(self):
+        pass
+
+class PcapWriter(object):
+    """ Stands in for the send socket, the frames sent are written to a pcap file """
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(PCAP_HEADER_CODEC.pack(PCAP_MAGIC, 2, 4, 0, 0, RECV_BUF_SIZE, PCAP_LINKTYPE_ETHERNET))
+
+    def send(self, data, flags=0):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        now = time.time()
+        self.f.write(PCAP_RECORD_CODEC.pack(int(now), int((now % 1) * 1e6), len(data), len(data)))
+        self.f.write(data)
+        return len(data)
+
+    def close(self):
+        self.f.close()
+
+class NullSender(object):
+    """ Stands in for the send socket when replaying without an output file """
+    def send(self, data, flags=0):
+        return len(data)
+
+    def close(self):
+        pass
+
+def socket_frames(s, control, settings):
+    """
+    Frames received one recvfrom at a time, until the control socket
+    replaces settings. The socket is only waited on for IDLE_POLL_MS and
+    never read right after, settings are looked at before each frame.
+    """
+    while control.settings is settings:
+        try:
+            frame = s.recvfrom(RECV_BUF_SIZE, socket.MSG_DONTWAIT)[0]
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            wait_readable(s)
+            continue
+        yield frame
+
+def ring_frames(ring, control, settings):
+    """
+    Frames read in place from the RX ring, valid until the next one is
+    taken. Once the control socket replaces settings they end with the
+    block, which is given back.
+    """
+    view = ring.rx_view
+    while control.settings is settings:
+        frames = ring.recv()
+        if not frames:
+            continue
+        for offset, length in frames:
+            yield view[offset:offset + length]
+        ring.release()
+
+def forward_inplace_loop(recv_s, send_s, macaddr, swap_ip, control, vxlan_udp_ports, vxlan_gpe_udp_ports, io, stats):
+    """
+    Forward loop that receives into reusable buffers and sends the rewritten
+    frames from those same buffers, no per-packet copies are made. With a
+    PacketBatchIO io frames are received and sent in batches. Returns once
+    the control socket replaces the settings the loop started with.
+    """
+    dmac = None
+    if macaddr is not None:
+        dmac = pack('!B B', int(macaddr[4], 16), int(macaddr[5], 16))
+
+    settings = control.settings
+    firewall = settings.firewall
+    if io is not None:
+        bufs = io.bufs
+        lengths = io.lengths
+        while control.settings is settings:
+            count = io.recv()
+            if not count:
+                continue
+            received_bytes = sum(lengths[:count])
+            """ Only the first frame of a sampled batch is timed, send times the whole batch """
+            sampled = timer = stats.start_timer()
+            for i in range(count):
+                lengths[i] = forward_packet_inplace(bufs[i], lengths[i], dmac, swap_ip, firewall, vxlan_udp_ports, vxlan_gpe_udp_ports, stats, timer)
+                timer = None
+            if sampled is not None:
+                sampled.start()
+            sent = io.send(count)
+            if sampled is not None:
+                sampled.mark(STAGE_SEND)
+            stats.record(count, sent, sum(lengths[:count]), received_bytes)
+        return
+
+    buf = bytearray(RECV_BUF_SIZE)
+    view = memoryview(buf)
+    while control.settings is settings:
+        try:
+            received = recv_s.recv_into(buf, RECV_BUF_SIZE, socket.MSG_DONTWAIT)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            wait_readable(recv_s)
+            continue
+        timer = stats.start_timer()
+        length = forward_packet_inplace(buf, received, dmac, swap_ip, firewall, vxlan_udp_ports, vxlan_gpe_udp_ports, stats, timer)
+        """ Send it and make sure all the data is sent out """
+        sent = 0
+        while sent < length:
+            sent += send_s.send(view[sent:length])
+        if timer is not None:
+            timer.mark(STAGE_SEND)
+        stats.record(1, length and 1, length, received)
+
+def forward_ring_loop(ring, macaddr, swap_ip, control, vxlan_udp_ports, vxlan_gpe_udp_ports, stats):
+    """
+    Forward loop on top of PacketRingIO, frames are rewritten in the RX ring
+    and copied from there into the TX ring. Returns after the block during
+    which the control socket replaced the settings the loop started with.
+    """
+    dmac = None
+    if macaddr is not None:
+        dmac = pack('!B B', int(macaddr[4], 16), int(macaddr[5], 16))
+
+    settings = control.settings
+    firewall = settings.firewall
+    view = ring.rx_view
+    while control.settings is settings:
+        frames = ring.recv()
+        if not frames:
+            continue
+        sent = 0
+        received_bytes = 0
+        sent_bytes = 0
+        timer = stats.start_timer()
+        for offset, length in frames:
+            received_bytes += length
+            length = forward_packet_inplace(view[offset:offset + length], length, dmac, swap_ip, firewall, vxlan_udp_ports, vxlan_gpe_udp_ports, stats, timer)
+            if length:
+                ring.send(offset, length)
+                sent += 1
+                sent_bytes += length
+            if timer is not None:
+                timer.mark(STAGE_SEND)
+                timer = None
+        ring.flush()
+        ring.release()
+        stats.record(len(frames), sent, sent_bytes, received_bytes)
+
+""" The ethertypes of the frames the pipeline looks at, IPv4 (VxLAN) and NSH """
+PIPELINE_ETHERTYPES = (0x0800, 0x894f)
+
+class Stage(object):
+    """
+    One step of the per frame pipeline of the SF. compile(next) is called
+    once, when the pipeline is built for the settings, and returns the
+    function handle(packet, offsets, timer) doing the step. It passes the
+    frame on by calling next, the compiled stages after it, or drops it by
+    returning. offsets are None until the ParseStage, timer is the
+    StageTimer of a sampled frame. Whatever is fixed for the settings is
+    settled in compile(), handle() only looks at the frame.
+    """
+    def compile(self, next):
+        """ A stage that doesn't touch the frame is left out of the pipeline """
+        return next
+
+def discard_frame(packet, offsets, timer):
+    """ The end of every pipeline """
+    pass
+
+def compile_stages(stages, last=discard_frame):
+    """ The handle() running a frame through stages in order, and then through last """
+    handle = last
+    for stage in reversed(stages):
+        handle = stage.compile(handle)
+    return handle
+
+class FilterStage(Stage):
+    """
+    Lets Ethernet + IPv4 or NSH frames to our MAC through, dmac is the last
+    two bytes of it. The others are counted as dropped in stats, like
+    forward_packet_inplace() does.
+    """
+    def __init__(self, dmac, stats):
+        self.dmac = dmac
+        self.stats = stats
+
+    def compile(self, next):
+        dmac = self.dmac
+        drop = self.stats.drop
+        def handle(packet, offsets, timer):
+            if (len(packet) < 14):
+                drop(DROP_PARSE_ERROR)
+            elif (U16_CODEC.unpack_from(packet, 12)[0] not in PIPELINE_ETHERTYPES) or ((dmac is not None) and (packet[4:6] != dmac)):
+                drop()
+            else:
+                next(packet, offsets, timer)
+        return handle
+
+class DumpStage(Stage):
+    """ Queues the frames on the DumpWriter dump, before any stage changes them """
+    def __init__(self, dump):
+        self.dump = dump
+
+    def compile(self, next):
+        dump = self.dump.packet
+        def handle(packet, offsets, timer):
+            dump(packet)
+            next(packet, offsets, timer)
+        return handle
+
+class DetachStage(Stage):
+    """ Copies frames read in place from a ring out of it, for the stages that splice them """
+    def compile(self, next):
+        def handle(packet, offsets, timer):
+            next(packet.tobytes(), offsets, timer)
+        return handle
+
+class ParseStage(Stage):
+    """ Finds where all the headers start in one pass, the stages after it reuse the offsets """
+    def __init__(self, vxlan_udp_ports, vxlan_gpe_udp_ports, inner, stats):
+        self.vxlan_udp_ports = vxlan_udp_ports
+        self.vxlan_gpe_udp_ports = vxlan_gpe_udp_ports
+        self.inner = inner
+        self.stats = stats
+
+    def compile(self, next):
+        vxlan_udp_ports = self.vxlan_udp_ports
+        vxlan_gpe_udp_ports = self.vxlan_gpe_udp_ports
+        inner = self.inner
+        drop = self.stats.drop
+        def handle(packet, offsets, timer):
+            offsets = parse_frame(packet, len(packet), vxlan_udp_ports, vxlan_gpe_udp_ports, inner)
+            if offsets is None:
+                drop()
+                return
+            if offsets is FRAME_TRUNCATED:
+                drop(DROP_PARSE_ERROR)
+                return
+            next(packet, offsets, timer)
+        return handle
+
+class ProbeStage(Stage):
+    """ Measures the latency probes among the NSH frames """
+    def __init__(self, probes):
+        self.probes = probes
+
+    def compile(self, next):
+        record = self.probes.record
+        def handle(packet, offsets, timer):
+            if offsets.nsh is not None:
+                record(packet, len(packet), offsets.path)
+            next(packet, offsets, timer)
+        return handle
+
+class EthNshStage(Stage):
+    """ Hands Eth + NSH frames to a pipeline of their own, the stages after it see the frames with an outer IP """
+    def __init__(self, stages):
+        self.stages = stages
+
+    def compile(self, next):
+        eth_nsh = compile_stages(self.stages)
+        def handle(packet, offsets, timer):
+            if offsets.ip is None:
+                eth_nsh(packet, offsets, timer)
+            else:
+                next(packet, offsets, timer)
+        return handle
+
+class NshStage(Stage):
+    """
+    Only lets NSH frames through, plain VxLAN frames are only dumped. When
+    forwarding they are counted as dropped in stats, without stats they
+    aren't, having been dumped.
+    """
+    def __init__(self, stats=None):
+        self.stats = stats
+
+    def compile(self, next):
+        if self.stats is None:
+            def handle(packet, offsets, timer):
+                if offsets.nsh is not None:
+                    next(packet, offsets, timer)
+            return handle
+        drop = self.stats.drop
+        def handle(packet, offsets, timer):
+            if offsets.nsh is not None:
+                next(packet, offsets, timer)
+            else:
+                drop()
+        return handle
+
+class CountStage(Stage):
+    """ Counts the frames and bytes of each NSH path """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def compile(self, next):
+        count_path = self.stats.count_path
+        def handle(packet, offsets, timer):
+            count_path(offsets.path, len(packet))
+            next(packet, offsets, timer)
+        return handle
+
+class TimerStage(Stage):
+    """ Marks the end of stage on the timer of sampled frames """
+    def __init__(self, stage):
+        self.stage = stage
+
+    def compile(self, next):
+        stage = self.stage
+        def handle(packet, offsets, timer):
+            if timer is not None:
+                timer.mark(stage)
+            next(packet, offsets, timer)
+        return handle
+
+class FirewallStage(Stage):
+    """
+    Drops the frames a rule of the Firewall or DispatchTable firewall takes,
+    noting why on the dump with note. The frames of rst rules are handed to
+    reset, a ResetStage, or dropped without one. The FlowAction of the
+    frames passed on is left in their offsets.
+    """
+    def __init__(self, firewall, stats, note=None, reset=None):
+        self.firewall = firewall
+        self.stats = stats
+        self.note = note
+        self.reset = reset
+
+    def compile(self, next):
+        match = self.firewall.match_frame
+        drop = self.stats.drop
+        note = self.note
+        reset = None
+        if self.reset is not None:
+            reset = self.reset.compile(next)
+        def handle(packet, offsets, timer):
+            action = match(packet, offsets)
+            if action.forward:
+                offsets.action = action
+                next(packet, offsets, timer)
+                return
+            drop(DROP_BLOCKED)
+            if action.reset and (reset is not None):
+                reset(packet, offsets, timer, action.rule)
+            elif note is not None:
+                note("Packet dropped by firewall rule: " + str(action.rule))
+        return handle
+
+class ResetStage(Stage):
+    """
+    Answers the TCP frames an rst rule took with a reset on the symmetric
+    path carried in c3. Unlike the other stages compile() returns
+    handle(packet, offsets, timer, rule), which FirewallStage calls. The
+    reset is sent back encapsulated, patched into the template of its host
+    pair, when send_s is set. With inner the frame is turned into the
+    inner reset instead and passed on to next, which forwards it
+    decapsulated. The send functions return whether a reset went out, the
+    note only says so then.
+    """
+    def __init__(self, resets, send_s, swap_ip, inner, stats, note=None):
+        self.resets = resets
+        self.send_s = send_s
+        self.swap_ip = swap_ip
+        self.inner = inner
+        self.stats = stats
+        self.note = note
+
+    def compile(self, next):
+        note = self.note
+        if self.inner:
+            send = self.inner_reset(next)
+        elif self.send_s is not None:
+            send = self.encapsulated_reset()
+        else:
+            send = lambda packet, offsets, timer, reverse_nsp: False
+        def handle(packet, offsets, timer, rule):
+            """ MD type 2 has no context header, its c3 reads as 0 """
+            reverse_nsp = PacketView(packet, offsets).nsh_context.service_platform
+            sent = (reverse_nsp != 0) and send(packet, offsets, timer, reverse_nsp)
+            if note is not None:
+                note("Packet dropped by firewall rule: " + str(rule) + (" and RESET sent" if sent else ""))
+        return handle
+
+    def encapsulated_reset(self):
+        reply = self.resets.reply
+        send = self.send_s.send
+        swap_ip = self.swap_ip
+        stats = self.stats
+        def send_reset(packet, offsets, timer, reverse_nsp):
+            if ((offsets.path & 0xFF) <= 1):
+                return False
+            pkt = reply(packet, offsets, reverse_nsp, swap_ip)
+            if timer is not None:
+                timer.mark(STAGE_ENCODE)
+            if pkt is not None:
+                send(pkt)
+                stats.tx_packets += 1
+                stats.tx_bytes += len(pkt)
+                stats.resets += 1
+            if timer is not None:
+                timer.mark(STAGE_SEND)
+            return pkt is not None
+        return send_reset
+
+    def inner_reset(self, next):
+        stats = self.stats
+        def send_reset(packet, offsets, timer, reverse_nsp):
+            """ The frame is counted as blocked already, next must not drop it again for its nsi """
+            if (frame_tcp_offset(offsets) is None) or ((offsets.path & 0xFF) <= 1):
+                return False
+            view = PacketView(packet, offsets)
+
+            "We build the new inner IP header for the reset"
+            myinternalipheader = view.inner_ip
+            myinternalipheader, new_internalipheader = build_ipv4_header_reset(40, myinternalipheader.ip_proto, myinternalipheader.ip_saddr, myinternalipheader.ip_daddr, True, myinternalipheader)
+
+            "We build the new tcp header with the RESET=1, it ends the packet"
+            tcp_header, new_tcpheader = build_tcp_reset(view.tcp, myinternalipheader)
+            packet = packet[:offsets.inner_ip] + new_internalipheader + new_tcpheader
+
+            "We do the same but with MAC"
+            if (offsets.inner_eth is not None):
+                inner_offset = offsets.inner_eth
+                newethheader = build_ethernet_header_swap(view.inner_eth)
+                packet = packet[:inner_offset] + newethheader.build() + packet[inner_offset + 14:]
+            """ Only counted once sent, without a send socket or with an expired nsi next drops it """
+            tx_packets = stats.tx_packets
+            next(packet, offsets, timer)
+            if (stats.tx_packets == tx_packets):
+                return False
+            stats.resets += 1
+            return True
+        return send_reset
+
+class CopyStage(Stage):
+    """ Copies frames into a bytearray, for the stages that rewrite them in place """
+    def compile(self, next):
+        def handle(packet, offsets, timer):
+            next(bytearray(packet), offsets, timer)
+        return handle
+
+class ServiceIndexStage(Stage):
+    """
+    Decrements the nsi of the frames, those whose nsi is 1 or 0 are
+    dropped instead and counted in stats. Without decrement the nsi is
+    only checked.
+    """
+    def __init__(self, stats, decrement=True):
+        self.stats = stats
+        self.decrement = decrement
+
+    def compile(self, next):
+        drop = self.stats.drop
+        if not self.decrement:
+            def handle(packet, offsets, timer):
+                if ((offsets.path & 0xFF) > 1):
+                    next(packet, offsets, timer)
+                else:
+                    drop()
+            return handle
+        def handle(packet, offsets, timer):
+            if ((offsets.path & 0xFF) > 1):
+                U8_CODEC.pack_into(packet, offsets.nsh + 7, (offsets.path - 1) & 0xFF)
+                next(packet, offsets, timer)
+            else:
+                drop()
+        return handle
+
+class ContextStage(Stage):
+    """
+    Rewrites the MD type 1 context header of the paths a DispatchTable sets
+    it for, as the FlowAction FirewallStage put on the offsets says
+    """
+    def compile(self, next):
+        def handle(packet, offsets, timer):
+            context = offsets.action.context
+            if context is not None:
+                context_offset = frame_nsh_context_offset(offsets)
+                if context_offset is not None:
+                    rewrite_context(packet, context_offset, context)
+            next(packet, offsets, timer)
+        return handle
+
+class MacSwapStage(Stage):
+    """ Swaps the outer MACs, in place """
+    def compile(self, next):
+        def handle(packet, offsets, timer):
+            dst_mac, src_mac = MAC_PAIR_CODEC.unpack_from(packet, 0)
+            MAC_PAIR_CODEC.pack_into(packet, 0, src_mac, dst_mac)
+            next(packet, offsets, timer)
+        return handle
+
+class EncapStage(Stage):
+    """
+    Puts new outer IP + UDP headers from the EncapTemplates encaps around
+    everything from VxLAN on, as they are by now
+    """
+    def __init__(self, encaps, swap_ip):
+        self.encaps = encaps
+        self.swap_ip = swap_ip
+
+    def compile(self, next):
+        encapsulate = self.encaps.encapsulate
+        swap_ip = self.swap_ip
+        def handle(packet, offsets, timer):
+            ip = offsets.ip
+            udp = offsets.udp
+            next(packet[0:14] + encapsulate(bytes(packet[ip + 12:ip + 20]), bytes(packet[udp:udp + 4]), packet[offsets.vxlan:], swap_ip),
+                 offsets, timer)
+        return handle
+
+class DecapStage(Stage):
+    """ Strips everything up to the inner packet, which is sent back out with the outer MACs swapped """
+    def compile(self, next):
+        def handle(packet, offsets, timer):
+            inner_eth = offsets.inner_eth
+            if (inner_eth is not None):
+                # The new SourceMac should be the outer dest, and the new DestMac should be the inner dest
+                pkt = packet[inner_eth:inner_eth + 6] + packet[0:6] + packet[12:14] + packet[inner_eth + 14:]
+            else:
+                pkt = packet[6:12] + packet[0:6] + packet[12:14] + packet[offsets.nsh + offsets.nsh_length:]
+            next(pkt, offsets, timer)
+        return handle
+
+class SendStage(Stage):
+    """ Sends the frames out of send_s """
+    def __init__(self, send_s, stats):
+        self.send_s = send_s
+        self.stats = stats
+
+    def compile(self, next):
+        send = self.send_s.send
+        stats = self.stats
+        def handle(packet, offsets, timer):
+            """ Send it and make sure all the data is sent out """
+            stats.tx_bytes += len(packet)
+            pkt = packet
+            while pkt:
+                sent = send(pkt)
+                pkt = pkt[sent:]
+            stats.tx_packets += 1
+            next(packet, offsets, timer)
+        return handle
+
+def sf_stages(args, firewall, stats, dump, ring, send_s, dmac, resets, encaps, vxlan_udp_ports, vxlan_gpe_udp_ports):
+    """
+    The stages a frame received by the SF goes through for args and the
+    firewall in force. dump is the DumpWriter of printed frames, None if
+    frames aren't printed. New functions of the SF are added here, as
+    stages, the receive loop only runs frames through what this returns.
+    """
+    forward = ((args.do == "forward") and (send_s is not None))
+    note = None if dump is None else dump.note
+    timed = lambda stage: [TimerStage(stage)] if stats.sample else []
+    rewrites = ((firewall is not None) and firewall.rewrites)
+
+    stages = [FilterStage(dmac, stats)]
+    if dump is not None:
+        stages.append(DumpStage(dump))
+    if (ring is not None) and ((args.do == "forward") or args.metadata):
+        """ The forward and reset stages splice the frame, take it out of the ring """
+        stages.append(DetachStage())
+    """ Only the firewall, the resets it sends and forward_inner look past NSH """
+    stages.append(ParseStage(vxlan_udp_ports, vxlan_gpe_udp_ports,
+                             ((firewall is not None) and firewall.inner) or args.forward_inner, stats))
+    if stats.probes is not None:
+        stages.append(ProbeStage(stats.probes))
+
+    """ Eth + NSH, the NSH metadata is passed on as is unless the dispatch table rewrites it """
+    eth_nsh = []
+    if firewall is not None:
+        eth_nsh.append(FirewallStage(firewall, stats, note))
+    if forward:
+        eth_nsh += [CopyStage(), ServiceIndexStage(stats)]
+        if rewrites:
+            eth_nsh.append(ContextStage())
+        eth_nsh += [MacSwapStage(), SendStage(send_s, stats)]
+    stages += [EthNshStage(eth_nsh), NshStage(stats if forward else None)]
+
+    """ VxLAN/VxLAN-gpe + NSH """
+    if stats.paths is not None:
+        stages.append(CountStage(stats))
+    stages += timed(STAGE_DECODE)
+    if firewall is not None:
+        reset = None
+        if firewall.has_action(FIREWALL_RST):
+            reset = ResetStage(resets, send_s if forward else None, args.swap_ip, args.forward_inner, stats, note)
+        stages.append(FirewallStage(firewall, stats, note, reset))
+    stages += timed(STAGE_DECISION)
+    if not forward:
+        return stages
+    if args.forward_inner:
+        """ Just send the original, inner packet """
+        stages += [ServiceIndexStage(stats, decrement=False), DecapStage()]
+    else:
+        """ nsi minus one, everything else from VxLAN on is passed on as is but for rewritten context headers """
+        stages += [CopyStage(), ServiceIndexStage(stats)]
+        if rewrites:
+            stages.append(ContextStage())
+        stages += [MacSwapStage(), EncapStage(encaps, args.swap_ip)]
+    return stages + timed(STAGE_ENCODE) + [SendStage(send_s, stats)] + timed(STAGE_SEND)
+
+def run_workers(count, target, stats_options=()):
+    """
+    Fork count worker processes running target(index, stats), stats being
+    PacketStats(name, *stats_options). When a worker exits it writes its
+    counters to a pipe, the counters of all workers are returned once they
+    are gone. SIGTERM/SIGINT to the parent stop them.
+    """
+    children = {}
+    for index in range(count):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            stats = PacketStats("worker %d" % index, *stats_options)
+            status = 0
+            try:
+                target(index, stats)
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                stats.close()
+                data = json.dumps(stats.counters()).encode('utf-8')
+                while data:
+                    data = data[os.write(write_fd, data):]
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        os.close(write_fd)
+        children[pid] = read_fd
+
+    def stop_workers(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    results = []
+    for pid, read_fd in children.items():
+        """ Read up to EOF first, the counters may not fit into the pipe """
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(read_fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.close(read_fd)
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    break
+        if chunks:
+            results.append(json.loads(b''.join(chunks).decode('utf-8')))
+    return results
+
+ETH_FCS_LEN = 4
+IMIX_SIZES = (64, 594, 64, 594, 64, 1518, 64, 594, 64, 64, 594, 64)
+IP_SUM_ADDRS_CODEC = Struct('!HII')
+
+def mac_to_ints(mac):
+    return [int(x, 16) for x in mac.split(':')]
+
+"""
+Latency probes end with a trailer of their sender's stream, their sequence
+number in the stream for their nsp, their CLOCK_MONOTONIC send time in ns
+and PROBE_MAGIC, which is how receivers find them
+"""
+PROBE_TRAILER_CODEC = Struct('!IIQ4s')
+PROBE_MAGIC = b'NSHP'
+
+def probe_trailer_sum(stream, seq, timestamp, odd):
+    """
+    One's complement sum of the trailer fields as the checksum sees them,
+    byte swapped when the trailer starts at an odd offset
+    """
+    total = ((stream >> 16) + (stream & 0xFFFF) + (seq >> 16) + (seq & 0xFFFF) +
+             (timestamp >> 48) + ((timestamp >> 32) & 0xFFFF) + ((timestamp >> 16) & 0xFFFF) + (timestamp & 0xFFFF))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    if odd:
+        total = ((total & 0xFF) << 8) | (total >> 8)
+    return total
+
+class TrafficTemplate(object):
+    __slots__ = ('buf', 'length', 'ip_sum', 'udp_sum', 'outer_udp_sum', 'trailer_odd')
+
+class TrafficGenerator(object):
+    """
+    Load generator for send mode. One frame per frame size is built up front
+    with the inner IPs, inner UDP ports and nsp set to zero, every packet is
+    a copy of one of them with the fields of its flow written in and the
+    inner IP, inner UDP and outer UDP checksums updated for those fields
+    incrementally. The flows go through all combinations of the inner
+    address, port and nsp ranges, sender worker of workers takes every
+    workers-th flow and its share of the rate. Sending is paced per batch
+    to a packet rate or to a bit rate of the Ethernet frames. With
+    probe_every set every probe_every-th packet is a latency probe, copied
+    from a template with room for the probe trailer, of the next flow in
+    a sequence of its own.
+    """
+    def __init__(self, args, worker=0, workers=1):
+        self.worker = worker
+        self.workers = workers
+        self.nsi = args.nsi
+        self.ranges = [(int_from_bytes(socket.inet_aton(args.inner_source_ip)), args.inner_source_ip_count),
+                       (int_from_bytes(socket.inet_aton(args.inner_destination_ip)), args.inner_destination_ip_count),
+                       (args.inner_source_udp_port, args.inner_source_udp_port_count),
+                       (args.inner_destination_udp_port, args.inner_destination_udp_port_count),
+                       (args.nsp, args.nsp_count)]
+        self.flows = 1
+        for start, count in self.ranges:
+            self.flows *= count
+        self.flow = worker
+
+        self.number = args.number
+        if self.number is not None:
+            self.number = args.number // workers + (worker < args.number % workers)
+        self.duration = args.duration
+        self.pps = (args.pps or 0) / float(workers)
+        self.bps = (args.gbps or 0) * 1e9 / workers
+
+        if (args.type == "eth_nsh"):
+            self.nsh_offset = 14
+        else:
+            self.nsh_offset = 14 + IPV4_HEADER_LEN_BYTES + UDP_HEADER_LEN_BYTES + 8
+        self.ip_offset = self.nsh_offset + NSH_TYPE1_LEN * 4 + 14
+        self.udp_offset = self.ip_offset + IPV4_HEADER_LEN_BYTES
+        if (args.frame_size == "imix"):
+            sizes = IMIX_SIZES
+        else:
+            sizes = [int(args.frame_size or 64)]
+        templates = {}
+        for size in set(sizes):
+            templates[size] = self.build_template(args, size)
+        self.templates = [templates[size] for size in sizes]
+        self.next_template = 0
+
+        self.probe_every = args.probe_every
+        self.countdown = args.probe_every
+        if self.probe_every:
+            probes = {}
+            for size in set(sizes):
+                probes[size] = self.build_template(args, size, True)
+            self.probe_templates = [probes[size] for size in sizes]
+            self.probe_flow = worker
+            self.sequences = {}
+            self.clock = monotonic_clock()
+
+    def build_template(self, args, size, probe=False):
+        """
+        Frame of size bytes on the wire, the 4 bytes of FCS are added by the
+        NIC, for flow fields of zero. Frames are never shorter than the headers,
+        probes than the headers and the probe trailer, whose fields are zero.
+        """
+        payload = b'\x00' * max(size - ETH_FCS_LEN - self.udp_offset - UDP_HEADER_LEN_BYTES, 0)
+        if probe:
+            payload = payload[PROBE_TRAILER_CODEC.size:] + PROBE_TRAILER_CODEC.pack(0, 0, 0, PROBE_MAGIC)
+        inner_eth = ETHHEADER(*(mac_to_ints(args.inner_destination_mac) + mac_to_ints(args.inner_source_mac) + [0x08, 0x00]))
+        innerippack = build_udp_packet('0.0.0.0', '0.0.0.0', 0, 0, payload, False)
+        nsh = BASEHEADER(0, self.nsi)
+        context = CONTEXTHEADER(int_from_bytes(socket.inet_aton(args.outer_destination_ip)), 0x1234, 0x12345678, 0x87654321)
+        nshpack = nsh.build() + context.build() + inner_eth.build() + innerippack
+        outer_eth = mac_to_ints(args.outer_destination_mac) + mac_to_ints(args.outer_source_mac)
+        if (args.type == "eth_nsh"):
+            frame = ETHHEADER(*(outer_eth + [0x89, 0x4f])).build() + nshpack
+        else:
+            vxlan = VXLAN(0, 0, 0x04, 0x1234, 0)
+            frame = ETHHEADER(*(outer_eth + [0x08, 0x00])).build() + build_udp_packet(args.outer_source_ip, args.outer_destination_ip, args.outer_source_udp_port, 4790, vxlan.build() + nshpack, False)
+
+        template = TrafficTemplate()
+        template.buf = bytearray(frame)
+        template.length = len(frame)
+        template.ip_sum = U16_CODEC.unpack_from(frame, self.ip_offset + 10)[0]
+        template.udp_sum = U16_CODEC.unpack_from(frame, self.udp_offset + 6)[0]
+        template.outer_udp_sum = None
+        if (args.type != "eth_nsh"):
+            template.outer_udp_sum = U16_CODEC.unpack_from(frame, 40)[0]
+        """ The inner and outer UDP headers both start at even offsets """
+        template.trailer_odd = (len(frame) - PROBE_TRAILER_CODEC.size - self.udp_offset) & 1
+        return template
+
+    def fill(self, buf):
+        """ Write the next packet into buf and return its length """
+        template = self.templates[self.next_template]
+        probe = False
+        if self.probe_every:
+            self.countdown -= 1
+            if (self.countdown == 0):
+                self.countdown = self.probe_every
+                template = self.probe_templates[self.next_template]
+                probe = True
+        self.next_template = (self.next_template + 1) % len(self.templates)
+
+        """ Probes go through the flows on their own so that every flow gets some at any probe_every """
+        if probe:
+            flow = self.probe_flow
+            self.probe_flow = (flow + self.workers) % self.flows
+        else:
+            flow = self.flow
+            self.flow = (flow + self.workers) % self.flows
+        values = []
+        for start, count in self.ranges:
+            flow, index = divmod(flow, count)
+            values.append(start + index)
+        saddr, daddr, sport, dport, nsp = values
+
+        length = template.length
+        buf[:length] = template.buf
+        trailer = 0
+        if probe:
+            seq = self.sequences.get(nsp, 0)
+            self.sequences[nsp] = (seq + 1) & 0xFFFFFFFF
+            timestamp = self.clock()
+            PROBE_TRAILER_CODEC.pack_into(buf, length - PROBE_TRAILER_CODEC.size, self.worker, seq, timestamp, PROBE_MAGIC)
+            trailer = probe_trailer_sum(self.worker, seq, timestamp, template.trailer_odd)
+        addrs = (saddr >> 16) + (saddr & 0xFFFF) + (daddr >> 16) + (daddr & 0xFFFF)
+        ip_sum = add_internet_checksum(template.ip_sum, addrs)
+        udp_sum = add_internet_checksum(template.udp_sum, addrs + sport + dport + trailer) or 0xFFFF
+        U32_CODEC.pack_into(buf, self.nsh_offset + 4, ((nsp & 0xFFFFFF) << 8) | self.nsi)
+        IP_SUM_ADDRS_CODEC.pack_into(buf, self.ip_offset + 10, ip_sum, saddr, daddr)
+        UDP_CODEC.pack_into(buf, self.udp_offset, sport, dport, length - self.udp_offset, udp_sum)
+        if template.outer_udp_sum is not None:
+            added = (addrs + sport + dport + trailer + ((nsp >> 8) & 0xFFFF) + ((nsp & 0xFF) << 8) +
+                     ip_sum + (~template.ip_sum & 0xFFFF) + udp_sum + (~template.udp_sum & 0xFFFF))
+            U16_CODEC.pack_into(buf, 40, add_internet_checksum(template.outer_udp_sum, added) or 0xFFFF)
+        return length
+
+    def run(self, send_s, batch, stats):
+        """ Send until number packets are sent or duration is over, forever without either """
+        libc = None
+        if batch > 1:
+            libc = load_libc()
+        io = PacketBatchIO(None, send_s, batch, libc)
+        start = time.time()
+        sent = 0
+        sent_bytes = 0
+        while (self.number is None) or (sent < self.number):
+            count = batch
+            if self.number is not None:
+                count = min(batch, self.number - sent)
+
+            """ Hold the batch back until the rate allows it to go out, probes are stamped after the wait """
+            due = None
+            if self.pps:
+                due = start + sent / self.pps
+            elif self.bps:
+                due = start + sent_bytes * 8 / self.bps
+            if due is not None:
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            batch_bytes = 0
+            for i in range(count):
+                io.lengths[i] = self.fill(io.bufs[i])
+                batch_bytes += io.lengths[i]
+            io.send(count)
+            sent += count
+            sent_bytes += batch_bytes
+            stats.record(0, count, batch_bytes)
+            if self.duration and (time.time() - start >= self.duration):
+                break
+
+def generator_requested(args):
+    """ Whether send mode should run the load generator instead of sending one packet """
+    return bool(args.pps or args.gbps or args.frame_size or args.duration or args.probe_every or (args.workers != 1) or
+                (max(args.inner_source_ip_count, args.inner_destination_ip_count, args.inner_source_udp_port_count,
+                     args.inner_destination_udp_port_count, args.nsp_count) > 1))
+
 def getmac(interface):
   try:
     mac = open('/sys/class/net/'+interface+'/address').readline()
@@ -571,23 +4088,307 @@ def getmac(interface):
     mac = None
   return mac
 
+def format_ethheader(ethheader):
+    return "Eth Dst MAC: %.2x:%.2x:%.2x:%.2x:%.2x:%.2x, Src MAC: %.2x:%.2x:%.2x:%.2x:%.2x:%.2x, Ethertype: 0x%.4x" % (ethheader.dmac0, ethheader.dmac1, ethheader.dmac2, ethheader.dmac3, ethheader.dmac4, ethheader.dmac5, ethheader.smac0, ethheader.smac1, ethheader.smac2, ethheader.smac3, ethheader.smac4, ethheader.smac5, (ethheader.ethertype0<<8) | ethheader.ethertype1)
+
+def format_ipheader(ipheader):
+    return "IP Version: %s IP Header Length: %s, TTL: %s, Protocol: %s, Src IP: %s, Dst IP: %s" % (ipheader.ip_ver, ipheader.ip_ihl, ipheader.ip_ttl, ipheader.ip_proto, str(socket.inet_ntoa(pack('!I', ipheader.ip_saddr))), str(socket.inet_ntoa(pack('!I', ipheader.ip_daddr))))
+
+def format_udpheader(udpheader):
+    return "UDP Src Port: %s, Dst Port: %s, Length: %s, Checksum: %s" % (udpheader.udp_sport, udpheader.udp_dport, udpheader.udp_len, udpheader.udp_sum)
+
+def format_vxlanheader(vxlanheader):
+    return "VxLAN/VxLAN-gpe VNI: %s, flags: %.2x, Next: %s" % (vxlanheader.vni, vxlanheader.flags, vxlanheader.next_protocol)
+
+def format_nsh_baseheader(nshbaseheader):
+    return bcolors.OKGREEN + "NSH base nsp: %s, nsi: %s" % (nshbaseheader.service_path, nshbaseheader.service_index) + bcolors.ENDC
+
+def format_nsh_contextheader(nshcontextheader):
+    return bcolors.OKGREEN + "NSH context c1: 0x%.8x, c2: 0x%.8x, c3: 0x%.8x, c4: 0x%.8x" % (nshcontextheader.network_platform, nshcontextheader.network_shared, nshcontextheader.service_platform, nshcontextheader.service_shared) + bcolors.ENDC
+
 def print_ethheader(ethheader):
-    print("Eth Dst MAC: %.2x:%.2x:%.2x:%.2x:%.2x:%.2x, Src MAC: %.2x:%.2x:%.2x:%.2x:%.2x:%.2x, Ethertype: 0x%.4x" % (ethheader.dmac0, ethheader.dmac1, ethheader.dmac2, ethheader.dmac3, ethheader.dmac4, ethheader.dmac5, ethheader.smac0, ethheader.smac1, ethheader.smac2, ethheader.smac3, ethheader.smac4, ethheader.smac5, (ethheader.ethertype0<<8) | ethheader.ethertype1))
+    print(format_ethheader(ethheader))
 
 def print_ipheader(ipheader):
-    print("IP Version: %s IP Header Length: %s, TTL: %s, Protocol: %s, Src IP: %s, Dst IP: %s" % (ipheader.ip_ver, ipheader.ip_ihl, ipheader.ip_ttl, ipheader.ip_proto, str(socket.inet_ntoa(pack('!I', ipheader.ip_saddr))), str(socket.inet_ntoa(pack('!I', ipheader.ip_daddr)))))
+    print(format_ipheader(ipheader))
 
 def print_udpheader(udpheader):
-    print ("UDP Src Port: %s, Dst Port: %s, Length: %s, Checksum: %s" % (udpheader.udp_sport, udpheader.udp_dport, udpheader.udp_len, udpheader.udp_sum))
+    print(format_udpheader(udpheader))
 
 def print_vxlanheader(vxlanheader):
-    print("VxLAN/VxLAN-gpe VNI: %s, flags: %.2x, Next: %s" % (vxlanheader.vni, vxlanheader.flags, vxlanheader.next_protocol))
+    print(format_vxlanheader(vxlanheader))
 
 def print_nsh_baseheader(nshbaseheader):
-    print bcolors.OKGREEN + "NSH base nsp: %s, nsi: %s" % (nshbaseheader.service_path, nshbaseheader.service_index) + bcolors.ENDC
+    print(format_nsh_baseheader(nshbaseheader))
 
 def print_nsh_contextheader(nshcontextheader):
-    print bcolors.OKGREEN + "NSH context c1: 0x%.8x, c2: 0x%.8x, c3: 0x%.8x, c4: 0x%.8x" % (nshcontextheader.network_platform, nshcontextheader.network_shared, nshcontextheader.service_platform, nshcontextheader.service_shared) + bcolors.ENDC
+    print(format_nsh_contextheader(nshcontextheader))
+
+DUMP_TEXT = 'text'
+DUMP_JSON = 'json'
+DUMP_PCAP = 'pcap'
+DUMP_FORMATS = [DUMP_TEXT, DUMP_JSON, DUMP_PCAP]
+DUMP_QUEUE_SIZE = 4096
+
+def decode_dump_headers(frame, vxlan_udp_ports, vxlan_gpe_udp_ports):
+    """
+    The headers the dump shows for frame as (name, header) in frame order:
+    Eth + NSH frames show their Ethernet and NSH headers, VxLAN frames their
+    UDP and VxLAN headers and, on VxLAN-gpe, the NSH headers. The metadata
+    of MD type 2 NSH headers is shown as the list of its TLVs.
+    """
+    length = len(frame)
+    offsets = parse_frame(frame, length, vxlan_udp_ports, vxlan_gpe_udp_ports)
+    if (offsets is None) or (offsets is FRAME_TRUNCATED):
+        """ Other UDP frames only show their UDP header """
+        if (length < 34) or (U16_CODEC.unpack_from(frame, 12)[0] != 0x0800):
+            return []
+        ver_ihl, proto = IP_VER_PROTO_CODEC.unpack_from(frame, 14)
+        udp_offset = 14 + (ver_ihl & 0x0F) * 4
+        if (proto != 17) or (length < udp_offset + 8):
+            return []
+        udp = UDPHEADER()
+        decode_udp_at(frame, udp_offset, udp)
+        return [('udp', udp)]
+
+    headers = []
+    if (offsets.ip is None):
+        eth = ETHHEADER()
+        decode_eth(frame, 0, eth)
+        headers.append(('eth', eth))
+    else:
+        udp = UDPHEADER()
+        decode_udp_at(frame, offsets.udp, udp)
+        vxlan = VXLAN()
+        decode_vxlan_at(frame, offsets.vxlan, vxlan)
+        headers += [('udp', udp), ('vxlan', vxlan)]
+    if (offsets.nsh is not None):
+        base = BASEHEADER()
+        decode_nsh_baseheader(frame, offsets.nsh, base)
+        headers.append(('nsh_base', base))
+        if (offsets.md_type == NSH_MD_TYPE2):
+            tlvs = decode_nsh_tlvs(frame, offsets)
+            if tlvs:
+                headers.append(('nsh_tlvs', tlvs))
+        else:
+            context = CONTEXTHEADER()
+            decode_nsh_contextheader(frame, offsets.nsh + 8, context)
+            headers.append(('nsh_context', context))
+    return headers
+
+def format_nsh_tlvs(tlvs):
+    return "\n".join(bcolors.OKGREEN + "NSH TLV class: 0x%.4x, type: %d, value: %s" % (md_class, md_type, binascii.hexlify(value).decode('ascii')) + bcolors.ENDC
+                     for md_class, md_type, value in tlvs)
+
+DUMP_TEXT_FORMATTERS = {'eth': format_ethheader,
+                        'udp': format_udpheader,
+                        'vxlan': format_vxlanheader,
+                        'nsh_base': format_nsh_baseheader,
+                        'nsh_context': format_nsh_contextheader,
+                        'nsh_tlvs': format_nsh_tlvs}
+
+def dump_header_fields(name, header):
+    """ The fields of a header for the JSON dump """
+    if (name == 'eth'):
+        return {'dst': ':'.join('%.2x' % getattr(header, 'dmac%d' % i) for i in range(6)),
+                'src': ':'.join('%.2x' % getattr(header, 'smac%d' % i) for i in range(6)),
+                'ethertype': (header.ethertype0 << 8) | header.ethertype1}
+    if (name == 'udp'):
+        return {'sport': header.udp_sport, 'dport': header.udp_dport, 'len': header.udp_len}
+    if (name == 'vxlan'):
+        return {'vni': header.vni, 'flags': header.flags, 'next_protocol': header.next_protocol}
+    if (name == 'nsh_base'):
+        return {'nsp': header.service_path, 'nsi': header.service_index,
+                'md_type': header.md_type, 'next_protocol': header.next_protocol}
+    if (name == 'nsh_tlvs'):
+        return [{'class': md_class, 'type': md_type, 'value': binascii.hexlify(value).decode('ascii')}
+                for md_class, md_type, value in header]
+    return {'c1': header.network_platform, 'c2': header.network_shared,
+            'c3': header.service_platform, 'c4': header.service_shared}
+
+class DumpWriter(object):
+    """
+    Dumps frames from a background thread so that the packet loops never
+    wait for the terminal or the disk. packet() and note() only queue the
+    frame, or a message about it, on a bounded queue; the thread decodes
+    and writes them as text, JSON lines or pcap. One frame in sample is
+    dumped, at most rate per second when rate is set. Frames that find the
+    queue full are dropped and counted.
+    """
+    def __init__(self, output, format=DUMP_TEXT, sample=1, rate=0,
+                 vxlan_udp_ports=(), vxlan_gpe_udp_ports=(), queue_size=DUMP_QUEUE_SIZE):
+        self.output = output
+        self.format = format
+        self.sample = max(sample, 1)
+        self.countdown = 1
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+        self.vxlan_udp_ports = vxlan_udp_ports
+        self.vxlan_gpe_udp_ports = vxlan_gpe_udp_ports
+        self.queue = queue.Queue(queue_size)
+        self.selected = False
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.limited = 0
+        if (format == DUMP_PCAP):
+            output.write(PCAP_HEADER_CODEC.pack(PCAP_MAGIC, 2, 4, 0, 0, RECV_BUF_SIZE, PCAP_LINKTYPE_ETHERNET))
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def packet(self, frame):
+        """ Queue frame if it is sampled, frames are numbered in the order they are passed in """
+        self.received += 1
+        pktnum = self.received
+        self.selected = False
+        self.countdown -= 1
+        if (self.countdown > 0):
+            return
+        self.countdown = self.sample
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if (self.tokens < 1):
+                self.limited += 1
+                return
+            self.tokens -= 1
+        if isinstance(frame, memoryview):
+            frame = frame.tobytes()
+        try:
+            self.queue.put_nowait((now, pktnum, frame, None))
+            self.selected = True
+        except queue.Full:
+            self.dropped += 1
+
+    def note(self, text):
+        """ Queue a message about the last frame, if it was dumped """
+        if not self.selected:
+            return
+        try:
+            self.queue.put_nowait((None, None, None, text))
+        except queue.Full:
+            pass
+
+    def close(self):
+        """ Write out what is queued and stop the thread """
+        self.queue.put((None, None, None, None))
+        self.thread.join()
+        if (self.output is sys.stdout):
+            self.output.flush()
+        else:
+            self.output.close()
+
+    def counters(self):
+        return {'written': self.written, 'dropped': self.dropped, 'limited': self.limited}
+
+    def render(self, timestamp, pktnum, frame, text):
+        if (self.format == DUMP_PCAP):
+            if (frame is None):
+                return b''
+            return PCAP_RECORD_CODEC.pack(int(timestamp), int((timestamp % 1) * 1e6), len(frame), len(frame)) + frame
+        if (self.format == DUMP_JSON):
+            if (frame is None):
+                return json.dumps({'note': text}) + "\n"
+            record = {'time': timestamp, 'packet': pktnum, 'length': len(frame)}
+            for name, header in decode_dump_headers(frame, self.vxlan_udp_ports, self.vxlan_gpe_udp_ports):
+                record[name] = dump_header_fields(name, header)
+            return json.dumps(record, sort_keys=True) + "\n"
+        if (frame is None):
+            return bcolors.WARNING + text + bcolors.ENDC + "\n"
+        headers = decode_dump_headers(frame, self.vxlan_udp_ports, self.vxlan_gpe_udp_ports)
+        lines = [DUMP_TEXT_FORMATTERS[name](header) for name, header in headers]
+        if headers and (headers[0][0] == 'eth'):
+            lines.insert(0, "\n\nPacket #%d" % pktnum)
+        return "".join(line + "\n" for line in lines)
+
+    def serve(self):
+        while True:
+            timestamp, pktnum, frame, text = self.queue.get()
+            if (frame is None) and (text is None):
+                return
+            try:
+                self.output.write(self.render(timestamp, pktnum, frame, text))
+                if (frame is not None):
+                    self.written += 1
+                if self.queue.empty():
+                    self.output.flush()
+            except (IOError, error) as e:
+                """ A bad frame or a closed output must not stop the dump """
+                if isinstance(e, IOError) and (e.errno == errno.EPIPE):
+                    return
+
+def open_dump(args, worker, workers, vxlan_udp_ports, vxlan_gpe_udp_ports):
+    """ The DumpWriter for the --dump-* options, writing to stdout without --dump-file """
+    path = worker_path(args.dump_file, worker, workers)
+    if (path is None):
+        if (args.dump_format == DUMP_PCAP):
+            print("Error: --dump-format pcap needs --dump-file")
+            sys.exit(-1)
+        output = sys.stdout
+    else:
+        output = open(path, 'wb' if (args.dump_format == DUMP_PCAP) else 'w')
+    return DumpWriter(output, args.dump_format, args.dump_sample, args.dump_rate,
+                      vxlan_udp_ports, vxlan_gpe_udp_ports, args.dump_queue)
+
+def load_firewall(args):
+    """
+    The Firewall for --rules-file, --rule and --block, None without rules.
+    With --dispatch-file the DispatchTable read from it, the Firewall then
+    only sees the paths the table doesn't list. Both track connections in
+    args.connections, the Conntrack of --conntrack, which outlives them.
+    Raises IOError or ValueError for a missing file or a bad rule.
+    """
+    rules = []
+    if (args.rules_file is not None):
+        rules += load_firewall_rules(args.rules_file)
+    rules += args.rules
+    if (args.block != 0):
+        rules.append("%s proto tcp dport %d" % (FIREWALL_RST if args.metadata else FIREWALL_DROP, args.block))
+    if (not rules) and (args.dispatch_file is None):
+        return None
+    flows = None
+    if (args.flow_cache > 0):
+        flows = FlowCache(args.flow_cache, args.flow_timeout)
+    firewall = None
+    if rules:
+        firewall = Firewall(rules, flows, args.connections)
+    if (args.dispatch_file is not None):
+        """ The entries are read like rules, one per line, # starts a comment """
+        return DispatchTable(load_firewall_rules(args.dispatch_file), firewall, flows, args.connections)
+    return firewall
+
+def build_firewall(args):
+    """ load_firewall() exiting on errors """
+    try:
+        return load_firewall(args)
+    except (IOError, ValueError) as e:
+        print("Error: bad firewall rules or dispatch table: {}".format(e))
+        sys.exit(-1)
+
+def open_replay(args):
+    """
+    The PcapReader and the sender standing in for the sockets for --replay,
+    None, None without it
+    """
+    if (args.replay is None):
+        return None, None
+    if (args.do not in ("dump", "forward")):
+        print("Error: only dump and forward can be replayed")
+        sys.exit(-1)
+    if ((args.workers != 1) or (args.io != "socket") or (args.batch != 1)):
+        print("Error: --replay runs a single worker reading with --io socket and --batch 1")
+        sys.exit(-1)
+    try:
+        reader = PcapReader(args.replay, args.replay_loops)
+        if (args.replay_output is None):
+            return reader, NullSender()
+        return reader, PcapWriter(args.replay_output)
+    except (IOError, ValueError) as e:
+        print("Error: can't replay: {}".format(e))
+        sys.exit(-1)
 
 def main():
     parser = argparse.ArgumentParser(description='This is a VxLAN/VxLAN-gpe + NSH dump and forward tool, you can use it to dump and forward VxLAN/VxLAN-gpe + NSH packets, it can also act as an NSH-aware SF for SFC test when you use --forward option, in that case, it will automatically decrease nsi by one.', prog='vxlan_tool.py')
@@ -621,6 +4422,28 @@ def main():
                         help='Specify inner destination UDP port for packet send')
     parser.add_argument('-n', '--number', type=int,
                         help='Specify number of packet to send')
+    parser.add_argument('--nsp', type=int, default=23,
+                        help='Specify the nsp for packet send')
+    parser.add_argument('--nsi', type=int, default=45,
+                        help='Specify the nsi for packet send')
+    parser.add_argument('--inner-source-ip-count', type=int, default=1,
+                        help='Send flows from this many consecutive inner source IP addresses')
+    parser.add_argument('--inner-destination-ip-count', type=int, default=1,
+                        help='Send flows to this many consecutive inner destination IP addresses')
+    parser.add_argument('--inner-source-udp-port-count', type=int, default=1,
+                        help='Send flows from this many consecutive inner source UDP ports')
+    parser.add_argument('--inner-destination-udp-port-count', type=int, default=1,
+                        help='Send flows to this many consecutive inner destination UDP ports')
+    parser.add_argument('--nsp-count', type=int, default=1,
+                        help='Send flows on this many consecutive nsps')
+    parser.add_argument('--pps', type=float,
+                        help='Send at this many packets per second')
+    parser.add_argument('--gbps', type=float,
+                        help='Send at this many Gbit/s of Ethernet frames')
+    parser.add_argument('--frame-size',
+                        help="Size of the sent Ethernet frames in bytes including FCS, or 'imix' for 7:4:1 frames of 64, 594 and 1518 bytes")
+    parser.add_argument('--duration', type=float,
+                        help='Send for this many seconds')
     parser.add_argument('--no-swap-ip', dest='swap_ip', default=True, action='store_false',
                         help="won't swap ip if provided")
     parser.add_argument('-v', '--verbose', choices=['on', 'off'],
@@ -632,16 +4455,143 @@ def main():
                         help='Acts as a firewall dropping packets that match this TCP dst port')
     parser.add_argument('--metadata', '-md', action="store_true",
                         help='Will send a TCP RST packet to the client when blocking')
+    parser.add_argument('--rule', dest='rules', action='append', default=[],
+                        help="Firewall rule, e.g. 'drop proto tcp dst 10.0.0.0/8 dport 80-89 nsp 23', may be repeated")
+    parser.add_argument('--rules-file',
+                        help='Read firewall rules from this file, one per line, the first matching rule wins')
+    parser.add_argument('--dispatch-file',
+                        help="Serve many service paths, each (nsp, nsi) with the actions of its line in this file, e.g. '23 255 count, block 80, set c1 7, forward'")
+    parser.add_argument('--flow-cache', type=int, default=65536,
+                        help='Cache the firewall verdict of up to this many flows, 0 to look up every packet')
+    parser.add_argument('--flow-timeout', type=float, default=30.0,
+                        help='Seconds after which an idle flow is dropped from the flow cache')
+    parser.add_argument('--conntrack', type=int, default=0,
+                        help='Track up to this many inner TCP connections for the firewall, rules can then match their state and rst rules reset a connection once, 0 to track none')
+    parser.add_argument('--conntrack-timeout', type=float, default=CONNTRACK_TIMEOUTS[CT_ESTABLISHED],
+                        help='Seconds an established connection without packets is tracked for')
+    parser.add_argument('--no-prefilter', dest='prefilter', default=True, action='store_false',
+                        help="Don't attach the BPF filter that drops the frames we don't handle in the kernel")
+    parser.add_argument('--io', choices=['socket', 'ring', 'xdp'], default='socket',
+                        help='Receive with recvfrom on the socket, from a PACKET_MMAP TPACKET_V3 ring or, when forwarding, from an AF_XDP socket on queue 0')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Run this many worker processes sharing the interface through PACKET_FANOUT, 0 for one per CPU')
+    parser.add_argument('--stats-file',
+                        help='Periodically write the packet counters to this file, suffixed with .N per worker')
+    parser.add_argument('--stats-socket',
+                        help='Serve the packet counters to clients connecting to this UNIX socket, suffixed with .N per worker')
+    parser.add_argument('--control-socket',
+                        help='Take commands changing the rules and -v of the running loop from this UNIX socket, suffixed with .N per worker, send help for the list')
+    parser.add_argument('--stats-format', choices=['prometheus', 'json'], default='prometheus',
+                        help='Format of the exported packet counters')
+    parser.add_argument('--stats-interval', type=float, default=5.0,
+                        help='Seconds between two writes of --stats-file')
+    parser.add_argument('--stage-sample', type=int, default=0,
+                        help='Time the processing stages of every N-th packet, 0 to not time them')
+    parser.add_argument('--probe-every', type=int, default=0,
+                        help='Make every N-th packet of the load generator a latency probe, 0 for no probes')
+    parser.add_argument('--probe-stats', default=False, action='store_true',
+                        help='Measure the latency, loss and reordering of the latency probes received, per nsp')
+    parser.add_argument('--dump-format', choices=DUMP_FORMATS, default=DUMP_TEXT,
+                        help='Dump the packets as text, JSON lines or to a pcap file')
+    parser.add_argument('--dump-file',
+                        help='Dump the packets to this file instead of stdout, suffixed with .N per worker')
+    parser.add_argument('--dump-sample', type=int, default=1,
+                        help='Dump one packet in this many')
+    parser.add_argument('--dump-rate', type=float, default=0,
+                        help='Dump at most this many packets per second, 0 for no limit')
+    parser.add_argument('--dump-queue', type=int, default=DUMP_QUEUE_SIZE,
+                        help='Packets waiting to be dumped beyond this many are dropped from the dump')
+    parser.add_argument('--replay',
+                        help='Read the frames from this pcap file instead of the interface and report the time taken per packet')
+    parser.add_argument('--replay-output',
+                        help='Write the frames forwarded while replaying to this pcap file')
+    parser.add_argument('--replay-loops', type=int, default=1,
+                        help='Replay the pcap file this many times')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='Receive and send up to this many packets per system call when forwarding or generating, batch statistics are printed on exit')
 
 
     args = parser.parse_args()
+
+    """ Made once, the connections are kept when the control socket changes the rules """
+    args.connections = None
+    if (args.conntrack > 0):
+        args.connections = Conntrack(args.conntrack, args.conntrack_timeout)
+    args.firewall = build_firewall(args)
+    args.replay_frames, args.replay_sender = open_replay(args)
+
+    args.generate = ((args.do == "send") and generator_requested(args))
+    if (args.io == "xdp") and ((args.do != "forward") or (args.workers != 1)):
+        print("Error: --io xdp takes the frames from the kernel, it only runs a single forwarding worker")
+        sys.exit(-1)
+    if ((args.do == "send") and (not args.generate)):
+        run(args, None)
+
+    """ Per packet path and stage counters are only kept when they are exported """
+    detailed = ((args.stats_file is not None) or (args.stats_socket is not None))
+    stats_options = (detailed, args.stage_sample, args.probe_stats)
+
+    if (args.workers != 1):
+        """ One process per CPU, flows are spread over them by PACKET_FANOUT, or by the generator """
+        workers = args.workers or multiprocessing.cpu_count()
+        fanout_group = None
+        if (args.do != "send"):
+            fanout_group = os.getpid() & 0xFFFF
+        total = PacketStats("total")
+        for counters in run_workers(workers, lambda index, stats: run(args, stats, fanout_group, index, workers),
+                                    stats_options):
+            worker_stats = PacketStats(counters['name'])
+            worker_stats.add(counters)
+            print(worker_stats.report())
+            total.add(counters)
+        print(total.report())
+        sys.exit(0)
+
+    if args.generate:
+        name = "generator"
+    elif (args.replay is not None):
+        name = "replay"
+    elif (args.io in ("ring", "xdp")):
+        name = args.io
+    elif (args.batch > 1):
+        name = "batch %d" % args.batch
+    else:
+        name = "socket"
+    stats = PacketStats(name, *stats_options)
+    try:
+        run(args, stats)
+    except ReplayDone:
+        pass
+    finally:
+        stats.close()
+        if (args.replay_sender is not None):
+            args.replay_sender.close()
+        print(stats.report())
+        if (args.replay is not None) and stats.rx_packets:
+            print("  %.0f ns/packet" % ((stats.stop - stats.start) * 1e9 / stats.rx_packets))
+
+def run(args, stats, fanout_group=None, worker=0, workers=1):
+    """
+    Open the sockets and run the send, forward or dump loop, joining the
+    PACKET_FANOUT group fanout_group when running as worker of several
+    workers
+    """
     macaddr = None
+    send_s = None
 
     try:
-        s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
-        if args.interface is not None:
+        if (args.replay_frames is not None):
+            """ The capture and the output file stand in for the sockets """
+            s = args.replay_frames
+            send_s = args.replay_sender
+        else:
+            s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
+        if (args.interface is not None) and (args.replay_frames is None):
             s.bind((args.interface, 0))
-        if ((args.do == "forward") or (args.do == "send")):
+        if fanout_group is not None:
+            s.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                         U32_NATIVE_CODEC.pack(fanout_group | ((PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_DEFRAG) << 16)))
+        if (((args.do == "forward") or (args.do == "send")) and (send_s is None)):
             if args.interface is None:
                 print("Error: you must specify the interface by -i or --interface for forward and send")
                 sys.exit(-1)
@@ -674,7 +4624,7 @@ def main():
                 args.inner_source_udp_port = args.outer_source_udp_port
             if (args.inner_destination_udp_port is None):
                 args.inner_destination_udp_port = 25
-            if (args.number is None):
+            if (args.number is None) and (not args.generate):
                 args.number = 10
 
     except OSError as e:
@@ -683,6 +4633,12 @@ def main():
 
     do_print = ((args.do != "forward") or (args.verbose == "on"))
 
+    if (stats is not None) and ((args.stats_file is not None) or (args.stats_socket is not None)):
+        stats.exporter = StatsExporter(stats, worker_path(args.stats_file, worker, workers),
+                                       worker_path(args.stats_socket, worker, workers),
+                                       args.stats_format, args.stats_interval)
+        stats.exporter.start()
+
     vxlan_gpe_udp_ports = [4790, 6633]
     vxlan_udp_ports = [4789] + vxlan_gpe_udp_ports
 
@@ -694,6 +4650,12 @@ def main():
     nshbase_length = 8
     nshcontext_length = 16
 
+    """ Send flows of VxLAN/VxLAN-gpe + NSH packets at a rate """
+    if (args.do == "send") and args.generate:
+        generator = TrafficGenerator(args, worker, workers)
+        generator.run(send_s, args.batch, stats)
+        return
+
     """ Send VxLAN/VxLAN-gpe + NSH packet """
     if (args.do == "send"):
         myethheader = ETHHEADER()
@@ -734,8 +4696,8 @@ def main():
         mynshbaseheader.length = NSH_TYPE1_LEN
         mynshbaseheader.md_type = NSH_MD_TYPE1
         mynshbaseheader.next_protocol = NSH_NEXT_PROTO_ETH
-        mynshbaseheader.service_path = 23
-        mynshbaseheader.service_index = 45
+        mynshbaseheader.service_path = args.nsp
+        mynshbaseheader.service_index = args.nsi
 
         """ Set NSH context header """
         mynshcontextheader.network_platform = int_from_bytes(socket.inet_aton(args.outer_destination_ip))
@@ -810,224 +4772,94 @@ def main():
             args.number -= 1
         sys.exit(0)
 
-    # receive a packet
-    pktnum=0
-    while True:
-        packet = s.recvfrom(65565)
+    filter_dmac = None
+    if macaddr is not None:
+        filter_dmac = (int(macaddr[4], 16) << 8) | int(macaddr[5], 16)
+    if args.prefilter and (args.replay_frames is None):
+        """ Only let the frames the loops below look at reach user space """
+        attach_prefilter(s, build_prefilter(filter_dmac, vxlan_udp_ports, args.do == "forward"))
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    ring = None
+    if (args.io == "ring"):
+        if (args.do == "forward"):
+            ring = PacketRingIO(s, send_s, args.interface)
+        else:
+            ring = PacketRingIO(s)
+    elif (args.io == "xdp"):
+        try:
+            ring = XdpSocketIO(args.interface, send_s, filter_dmac, vxlan_udp_ports)
+        except (OSError, IOError, socket.error) as e:
+            print("Error: {}".format(e))
+            sys.exit(-1)
+    batch_io = None
+    if (args.do == "forward") and (args.batch > 1) and (ring is None):
+        """ Made once, the buffers of a large batch take milliseconds to set up """
+        batch_io = PacketBatchIO(s, send_s, args.batch, load_libc())
+
+    resets = TcpResetTemplates(FlowCache(RESET_TEMPLATES, args.flow_timeout))
+    encaps = EncapTemplates(FlowCache(ENCAP_TEMPLATES, args.flow_timeout))
+
+    """ Only the last two bytes of our MAC are matched """
+    dmac = None
+    if macaddr is not None:
+        dmac = pack('!B B', int(macaddr[4], 16), int(macaddr[5], 16))
+
+    control = ControlServer(args, RuntimeSettings(args.firewall, args.verbose == "on"), stats,
+                            worker_path(args.control_socket, worker, workers))
+    control.start()
+
+    if (args.replay_frames is not None):
+        """ Only time the frames, not the setup """
+        stats.start = time.time()
 
-        #packet string from tuple
-        packet = packet[0]
-
-        myethheader = ETHHEADER()
-        myinsertedethheader = ETHHEADER()
-        has_inserted_eth = False
-
-        """ Decode ethernet header """
-        decode_eth(packet, 0, myethheader)
-
-        if ((myethheader.ethertype0 != 0x08) or (myethheader.ethertype1 != 0x00)):
-            if ((myethheader.ethertype0 != 0x89) or (myethheader.ethertype1 != 0x4f)):
-                continue
-        if (macaddr is not None):
-            if ((myethheader.dmac4 != int(macaddr[4], 16)) or (myethheader.dmac5 != int(macaddr[5], 16))):
-                continue
-
-        """ Check if the received packet was ETH + NSH """
-        if ((myethheader.ethertype0 == 0x89) or (myethheader.ethertype1 == 0x4f)):
-            pktnum = pktnum + 1
-            print("\n\nPacket #%d" % pktnum)
-
-            """ Eth + NSH """
-            mynshbaseheader = BASEHEADER()
-            mynshcontextheader = CONTEXTHEADER()
-            offset = eth_length
-            decode_nsh_baseheader(packet, offset, mynshbaseheader)
-            decode_nsh_contextheader(packet, offset + nshbase_length, mynshcontextheader)
-
-            """ Print ethernet header """
-            print_ethheader(myethheader)
-
-            """ Print NSH base header """
-            print_nsh_baseheader(mynshbaseheader)
-
-            """ Print NSH context header """
-            print_nsh_contextheader(mynshcontextheader)
-
-            """ Check if Firewall checking is enabled, and block/drop if its the same TCP port """
-            if (args.block != 0):
-                mytcpheader = TCPHEADER()
-                decode_tcp(packet, 0, mytcpheader)
-
-                if (mytcpheader.tcp_dport == args.block):
-                    print bcolors.WARNING + "TCP packet dropped on port: " + str(args.block) + bcolors.ENDC
-                    continue
-
-            if ((args.do == "forward") and (args.interface is not None)):
-                """ nsi minus one for send """
-                mynshbaseheader.service_index = mynshbaseheader.service_index - 1
-
-                """ Build Ethernet header """
-                newethheader = build_ethernet_header_swap(myethheader)
-
-                """ Build Ethernet packet """
-                pkt = newethheader.build() + mynshbaseheader.build() + mynshcontextheader.build() + packet[eth_length+nshbase_length+nshcontext_length:]
-
-                """ Send it and make sure all the data is sent out """
-                while pkt:
-                    sent = send_s.send(pkt)
-                    pkt = pkt[sent:]
+    try:
+        """ Each loop below returns once the control socket changes the settings, the loop for the new ones is picked """
+        while True:
+            settings = control.settings
+            firewall = settings.firewall
+            stats.flow_cache = None
+            stats.conntrack = None
+            stats.dispatch = None
+            if (firewall is not None):
+                stats.flow_cache = firewall.flows
+                stats.conntrack = firewall.conntrack
+                if isinstance(firewall, DispatchTable):
+                    stats.dispatch = firewall
+            do_print = ((args.do != "forward") or settings.verbose)
+
+            """ Plain forwarding doesn't need the decoded headers, rewrite in place """
+            if ((args.do == "forward") and (not do_print) and (not args.forward_inner) and
+                ((firewall is None) or (not firewall.has_action(FIREWALL_RST)))):
+                if ring is not None:
+                    forward_ring_loop(ring, macaddr, args.swap_ip, control, vxlan_udp_ports, vxlan_gpe_udp_ports, stats)
+                else:
+                    forward_inplace_loop(s, send_s, macaddr, args.swap_ip, control, vxlan_udp_ports, vxlan_gpe_udp_ports, batch_io, stats)
                 continue
 
-        pktnum = pktnum + 1
-#        if (do_print):
-#            print("\n\nPacket #%d" % pktnum)
-
-        """ Print ethernet header """
-#        if (do_print):
-#           print_ethheader(myethheader)
-
-        myipheader = IP4HEADER()
-
-        """ Decode IP header """
-        decode_ip(packet, myipheader)
-
-        """ Print IP header """
-#        if (do_print):
-#            print_ipheader(myipheader)
-
-        if (myipheader.ip_proto != 17):
-            continue
-
-        myudpheader = UDPHEADER()
-
-        """ Decode UDP header """
-        decode_udp(packet, myudpheader)
-
-        """ Print UDP header """
-        if (do_print):
-            print_udpheader(myudpheader)
-
-        if (myudpheader.udp_dport not in vxlan_udp_ports):
-            continue
-
-        myvxlanheader = VXLAN()
-
-        """ Decode VxLAN/VxLAN-gpe header """
-        decode_vxlan(packet, myvxlanheader)
-
-        """ Print VxLAN/VxLAN-gpe header """
-        if (do_print):
-            print_vxlanheader(myvxlanheader)
-
-        mynshbaseheader = BASEHEADER()
-
-        mynshcontextheader = CONTEXTHEADER()
-
-        """ Print NSH header """
-        if (myudpheader.udp_dport in vxlan_gpe_udp_ports):
-            offset = eth_length + ip_length + udp_length + vxlan_length
-            """ Decode inserted ethernet header before NSH """
-            decode_eth(packet, offset, myinsertedethheader)
-            if ((myinsertedethheader.ethertype0 == 0x89) and (myinsertedethheader.ethertype1 == 0x4f)):
-                has_inserted_eth = True
-                offset += eth_length
-
-            decode_nsh_baseheader(packet, offset, mynshbaseheader)
-            offset += nshbase_length
-            decode_nsh_contextheader(packet, offset, mynshcontextheader)
-            offset += nshcontext_length
-
-            """ Print NSH base header """
-            if (do_print):
-                print_nsh_baseheader(mynshbaseheader)
-
-            """ Print NSH context header """
-            if (do_print):
-                print_nsh_contextheader(mynshcontextheader)
-
-            """ Check if Firewall checking is enabled, and block/drop if its the same TCP port """
-            if (args.block != 0):
-                mytcpheader = TCPHEADER()
-                decode_tcp(packet, eth_length, mytcpheader)
-                if ((args.metadata) and (mynshcontextheader.service_platform != 0) and (args.block == mytcpheader.tcp_dport)):
-                    print bcolors.WARNING + "TCP packet dropped: " + str(args.block) + " and RESET sent" + bcolors.ENDC
-
-                    "The nsp from the symmetric RSP is stored in the nsp field of NSH"
-                    mynshbaseheader.service_path = mynshcontextheader.service_platform
-
-                    "We do the same but with IP"
-                    myinternalipheader = IP4HEADER()
-                    decode_internal_ip(packet, eth_length, myinternalipheader)
-                    myinternalipheader, new_internalipheader = build_ipv4_header_reset(40, myinternalipheader.ip_proto, myinternalipheader.ip_saddr, myinternalipheader.ip_daddr, True)
-                    old_internalipheader = packet[(88+eth_length):(108+eth_length)]
-                    packet_aux = packet[:(88+eth_length)] + new_internalipheader + packet[(108+eth_length):]
-                    packet = packet_aux
-
-                    "We build the new tcp header with the RESET=1"
-                    tcp_header, new_tcpheader = build_tcp_reset(mytcpheader, myinternalipheader)
-                    old_tcpheader = packet[(108+eth_length):(128+eth_length)]
-                    "We create an auxiliar variable because strings are immutable"
-                    packet_aux = packet[:(108+eth_length)] + new_tcpheader
-                    "We replace the packet with the new tcp header and save the original one"
-                    packet = packet_aux
-
-                    "We do the same but with MAC"
-                    inner_internal_ethheader = ETHHEADER()
-                    inner_offset = eth_length + ip_length + udp_length + vxlan_length + eth_length + nshbase_length + nshcontext_length
-                    decode_eth(packet, inner_offset, inner_internal_ethheader)
-                    newethheader = build_ethernet_header_swap(inner_internal_ethheader)
-                    new_ether_header = newethheader.build()
-                    old_ether_header = packet[(74+eth_length):(88+eth_length)]
-                    packet_aux = packet[:inner_offset] + new_ether_header + packet[inner_offset + eth_length:]
-                    packet = packet_aux 
-
-                else:
-                    if ((args.block == mytcpheader.tcp_dport)):
-                        print bcolors.WARNING + "TCP packet dropped on port: " + str(args.block) + bcolors.ENDC
-                        continue
-
-            if ((args.do == "forward") and (args.interface is not None) and (mynshbaseheader.service_index > 1)):
-                """ Build Ethernet header """
-                newethheader = build_ethernet_header_swap(myethheader)
-
-                """ Build the packet, either encapsulated, or the original inner packet """
-                pkt = None
-                if args.forward_inner:
-                    """ Just build the original, inner packet """
-                    inner_offset = eth_length + ip_length + udp_length + vxlan_length + nshbase_length + nshcontext_length
-                    inner_ethheader = ETHHEADER()
-                    # Get the inner ethernet header
-                    decode_eth(packet[inner_offset:], inner_ethheader)
-                    # The new SourceMac should be the outer dest, and the new DestMac should be the inner dest
-                    # This call sets the new SourceMac to be the outer dest
-                    newethheader = build_ethernet_header_swap(myethheader)
-                    # Now set the DestMac to be the inner dest
-                    newethheader.dmac0 = inner_ethheader.dmac0
-                    newethheader.dmac1 = inner_ethheader.dmac1
-                    newethheader.dmac2 = inner_ethheader.dmac2
-                    newethheader.dmac3 = inner_ethheader.dmac3
-                    newethheader.dmac4 = inner_ethheader.dmac4
-                    newethheader.dmac5 = inner_ethheader.dmac5
-                    pkt = newethheader.build() + packet[inner_offset + eth_length:]
-                else:
-                    """ Build IP packet"""
-                    if (myudpheader.udp_dport in vxlan_gpe_udp_ports):
-                        """ nsi minus one """
-                        mynshbaseheader.service_index = mynshbaseheader.service_index - 1
-                        if (has_inserted_eth is True):
-                            ippack = build_udp_packet(str(socket.inet_ntoa(pack('!I', myipheader.ip_saddr))), str(socket.inet_ntoa(pack('!I', myipheader.ip_daddr))), myudpheader.udp_sport, myudpheader.udp_dport, myvxlanheader.build() + myinsertedethheader.build() + mynshbaseheader.build() + mynshcontextheader.build() + packet[offset:], args.swap_ip)
-                        else:
-                            ippack = build_udp_packet(str(socket.inet_ntoa(pack('!I', myipheader.ip_saddr))), str(socket.inet_ntoa(pack('!I', myipheader.ip_daddr))), myudpheader.udp_sport, myudpheader.udp_dport, myvxlanheader.build() + mynshbaseheader.build() + mynshcontextheader.build() + packet[offset:], args.swap_ip)
-                    else:
-                        ippack = build_udp_packet(str(socket.inet_ntoa(pack('!I', myipheader.ip_saddr))), str(socket.inet_ntoa(pack('!I', myipheader.ip_daddr))), myudpheader.udp_sport, myudpheader.udp_dport, packet[eth_length+ip_length+udp_length:], args.swap_ip)
-
-                    """ Build Ethernet packet """
-                    pkt = newethheader.build() + ippack
-
-                """ Send it and make sure all the data is sent out """
-                while pkt:
-                    sent = send_s.send(pkt)
-                    pkt = pkt[sent:]
+            if ring is not None:
+                frames = ring_frames(ring, control, settings)
+            else:
+                frames = socket_frames(s, control, settings)
+
+            """ Frames are dumped from a thread, the pipeline only queues them """
+            dump = None
+            if do_print:
+                if stats.dump is None:
+                    stats.dump = open_dump(args, worker, workers, vxlan_udp_ports, vxlan_gpe_udp_ports)
+                dump = stats.dump
+
+            """ What is done to a frame is settled once here, the loop only hands the frames over """
+            process = compile_stages(sf_stages(args, firewall, stats, dump, ring, send_s, dmac, resets, encaps,
+                                               vxlan_udp_ports, vxlan_gpe_udp_ports))
+
+            # receive a packet
+            for packet in frames:
+                stats.record(1, 0, 0, len(packet))
+                process(packet, None, stats.start_timer())
+    finally:
+        control.stop()
 
 if __name__ == "__main__":
     main()